@@ -0,0 +1,112 @@
+"""
+Logging asincrono e riepiloghi periodici per i loop di telemetria.
+
+`setup_async_logging()` sostituisce gli handler del root logger con un
+QueueHandler non bloccante: formattazione finale e I/O (file, console)
+avvengono nel thread del QueueListener, fuori dal loop di campionamento. Se
+la coda è piena il record viene scartato e contato invece di bloccare.
+
+`PeriodicSummary` rimpiazza le righe INFO per singolo messaggio con una
+riga ogni `period` secondi ("N messaggi inviati negli ultimi 60s ...").
+Su flash del telefono e SD dei gateway la scrittura per messaggio costa sia
+in latenza sia in usura.
+
+Modulo condiviso tra iot-gateway e atlas-mobile (solo stdlib).
+"""
+
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler che non blocca mai: a coda piena scarta e conta."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_async_logging(level, handlers, fmt="%(asctime)s - %(levelname)s - %(message)s",
+                        queue_size=10000):
+    """Configura il root logger con I/O in background; ritorna il QueueHandler."""
+    formatter = logging.Formatter(fmt)
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Svuota la coda all'uscita: i record di shutdown non vanno persi
+    atexit.register(listener.stop)
+    return queue_handler
+
+
+class PeriodicSummary:
+    """Conta invii, byte, errori e latenze; logga un riepilogo per periodo."""
+
+    def __init__(self, logger, label, period=60.0, clock=time.monotonic, max_samples=10000):
+        self.logger = logger
+        self.label = label
+        self.period = float(period)
+        self.clock = clock
+        self.max_samples = int(max_samples)
+        self._lock = threading.Lock()
+        self._reset(clock())
+
+    def _reset(self, now):
+        self._start = now
+        self._count = 0
+        self._bytes = 0
+        self._errors = 0
+        self._latencies = []
+
+    def record(self, count=1, nbytes=0):
+        with self._lock:
+            self._count += count
+            self._bytes += nbytes
+        self.maybe_log()
+
+    def error(self):
+        with self._lock:
+            self._errors += 1
+        self.maybe_log()
+
+    def latency(self, seconds):
+        with self._lock:
+            if len(self._latencies) < self.max_samples:
+                self._latencies.append(seconds)
+        self.maybe_log()
+
+    def maybe_log(self):
+        now = self.clock()
+        with self._lock:
+            elapsed = now - self._start
+            if elapsed < self.period:
+                return
+            count, nbytes, errors = self._count, self._bytes, self._errors
+            latencies = sorted(self._latencies)
+            self._reset(now)
+        message = f"{count} {self.label} negli ultimi {elapsed:.0f}s ({nbytes} byte"
+        if errors:
+            message += f", {errors} errori"
+        message += ")"
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+            message += f", latenza PUBACK p50 {p50 * 1000:.0f}ms p99 {p99 * 1000:.0f}ms"
+        self.logger.info(message)
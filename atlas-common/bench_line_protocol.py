@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark dell'encoder line protocol.
+
+Confronta `line_protocol` con le funzioni storiche di atlas-mobile
+(`.replace()` a catena, copiate qui come riferimento) su un ciclo tipico di
+mobile_sensors.py e su un lotto di punti del gateway, verificando prima che
+l'output sia identico.
+
+Lo speedup per caso è quello stampato dallo script: varia molto tra
+macchine ed esecuzioni, quindi conviene ripetere la misura più volte invece
+di fidarsi di un numero singolo.
+
+Uso: python3 atlas-common/bench_line_protocol.py [--number N]
+"""
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import line_protocol  # noqa: E402
+
+
+# ----------------------------
+# Implementazione storica (mobile_sensors.py)
+# ----------------------------
+def _legacy_escape_measurement(value):
+    return str(value).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,")
+
+
+def _legacy_escape_tag(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(" ", "\\ ")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+    )
+
+
+def _legacy_format_fields(fields):
+    parts = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        key = _legacy_escape_tag(key)
+        if isinstance(value, bool):
+            parts.append(f"{key}={str(value).lower()}")
+        elif isinstance(value, int):
+            parts.append(f"{key}={value}i")
+        elif isinstance(value, float):
+            parts.append(f"{key}={value}")
+        else:
+            escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
+            parts.append(f'{key}="{escaped}"')
+    return ",".join(parts)
+
+
+def _legacy_format_line_protocol(measurement, tags, fields, timestamp_ns):
+    measurement = _legacy_escape_measurement(measurement)
+    tags_part = ",".join(
+        f"{_legacy_escape_tag(k)}={_legacy_escape_tag(v)}" for k, v in (tags or {}).items() if v is not None
+    )
+    fields_part = _legacy_format_fields(fields or {})
+    if not fields_part:
+        return None
+    if tags_part:
+        measurement = f"{measurement},{tags_part}"
+    return f"{measurement} {fields_part} {timestamp_ns}"
+
+
+def _legacy_encode_many(points):
+    lines = []
+    for point in points:
+        line = _legacy_format_line_protocol(*point)
+        if line:
+            lines.append(line)
+    return "\n".join(lines)
+
+
+# ----------------------------
+# Carichi di prova
+# ----------------------------
+TS = 1_767_225_600_000_000_000
+
+MOBILE_CYCLE = [
+    ("mobile_battery", {"status": "DISCHARGING"}, {"percentage": 81.0, "temperature": 31.4}, TS),
+    ("mobile_telemetry", {"status": "DISCHARGING"},
+     {"iteration": 1234, "battery_percent": 81.0, "battery_temp": 31.4}, TS),
+    ("cpu", {"cpu": "cpu-total"}, {"usage_active": 12.345678}, TS),
+    ("mem", None, {"used_percent": 63.2101}, TS),
+    ("disk", {"path": "/data/data/com.termux/files/home"}, {"used_percent": 71.9}, TS),
+    ("system", None, {"uptime": 345678, "load1": 2.31}, TS),
+    ("temp", {"sensor": "battery"}, {"temp": 31.4}, TS),
+]
+
+GATEWAY_BATCH = [
+    ("sensors", {"device": "gateway atlas,core", "sensor": f"probe_{i % 8}"},
+     {"value": 20.0 + i / 100.0, "ok": True, "label": 'say "hi"'}, TS + i)
+    for i in range(200)
+]
+
+
+def _bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    per_call_us = seconds / number * 1e6
+    return label, per_call_us
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark encoder line protocol")
+    parser.add_argument("--number", type=int, default=2000, help="Iterazioni per misura")
+    args = parser.parse_args()
+
+    for name, points in (("mobile cycle", MOBILE_CYCLE), ("gateway batch", GATEWAY_BATCH)):
+        legacy = _legacy_encode_many(points)
+        new = line_protocol.encode_many(points)
+        if legacy != new:
+            print(f"[FAIL] output diverso per {name}")
+            return 1
+
+    results = []
+    for name, points, number in (
+        ("mobile cycle (7 righe)", MOBILE_CYCLE, args.number),
+        ("gateway batch (200 righe)", GATEWAY_BATCH, max(1, args.number // 20)),
+    ):
+        _, legacy_us = _bench("legacy", lambda: _legacy_encode_many(points), number)
+        _, new_us = _bench("line_protocol", lambda: line_protocol.encode_many(points), number)
+        results.append((name, legacy_us, new_us))
+
+    escape_value = "device with spaces,commas=and\\backslash"
+    _, legacy_esc = _bench("legacy", lambda: _legacy_escape_tag(escape_value), args.number * 10)
+    _, new_esc = _bench("cache", lambda: line_protocol.escape_field_key(escape_value), args.number * 10)
+    results.append(("chiave campo (cache)", legacy_esc, new_esc))
+
+    print(f"{'caso':<28}{'legacy (us)':>14}{'nuovo (us)':>14}{'speedup':>10}")
+    for name, legacy_us, new_us in results:
+        print(f"{name:<28}{legacy_us:>14.2f}{new_us:>14.2f}{legacy_us / new_us:>9.2f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,76 @@
+"""
+Filtro deadband (report-by-exception) per campi line-protocol.
+
+Un campo con una regola viene pubblicato solo se si è spostato più della
+soglia assoluta (`abs`) o relativa (`rel`, frazione dell'ultimo valore
+inviato) rispetto all'ultimo valore pubblicato. Ogni `heartbeat` secondi il
+campo viene comunque ripubblicato, così i pannelli Grafana restano popolati.
+I campi senza regola passano sempre. Se non resta nessun campo il punto va
+scartato.
+
+Modulo condiviso tra iot-gateway e atlas-mobile (solo stdlib).
+"""
+
+import threading
+import time
+
+
+class DeadbandFilter:
+    """
+    Regole indicizzate per `"<nome>.<campo>"`, es.::
+
+        {"mobile_battery.percentage": {"abs": 1}, "disk.used_percent": {"rel": 0.01}}
+
+    Lo stato (ultimo valore e istante di invio) è tenuto per serie, cioè per
+    nome + tag, e per campo.
+    """
+
+    def __init__(self, rules=None, heartbeat=300.0, clock=time.monotonic):
+        self.rules = {}
+        for key, rule in (rules or {}).items():
+            rule = rule or {}
+            self.rules[key] = (
+                float(rule["abs"]) if rule.get("abs") is not None else None,
+                float(rule["rel"]) if rule.get("rel") is not None else None,
+            )
+        self.heartbeat = float(heartbeat)
+        self.clock = clock
+        self.passed = 0
+        self.suppressed = 0
+        self._lock = threading.Lock()
+        # (nome, tag) -> {campo: (ultimo valore, istante invio)}
+        self._last = {}
+
+    def filter(self, name, fields, tags=None):
+        """Ritorna i soli campi da pubblicare (dict vuoto = punto soppresso)."""
+        if not self.rules or not fields:
+            return fields
+        now = self.clock()
+        series_key = (name, tuple(sorted((tags or {}).items())))
+        out = {}
+        with self._lock:
+            last = self._last.setdefault(series_key, {})
+            for key, value in fields.items():
+                rule = self.rules.get(f"{name}.{key}")
+                if rule is None or value is None or isinstance(value, (bool, str)):
+                    out[key] = value
+                    continue
+                previous = last.get(key)
+                if previous is None or self._moved(rule, previous[0], value) \
+                        or now - previous[1] >= self.heartbeat:
+                    last[key] = (value, now)
+                    out[key] = value
+                    self.passed += 1
+                else:
+                    self.suppressed += 1
+        return out
+
+    @staticmethod
+    def _moved(rule, previous, value):
+        abs_threshold, rel_threshold = rule
+        delta = abs(value - previous)
+        if abs_threshold is not None and delta > abs_threshold:
+            return True
+        if rel_threshold is not None and delta > rel_threshold * abs(previous):
+            return True
+        return abs_threshold is None and rel_threshold is None
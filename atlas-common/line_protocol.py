@@ -0,0 +1,226 @@
+"""
+Encoder InfluxDB line protocol condiviso.
+
+- Escape con `.replace()` a catena solo sui valori dinamici (misurato più
+  veloce di `str.translate` con tabelle multi-carattere in CPython, vedi
+  benchmark) e cache delle chiavi di campo già viste.
+- Prefissi `measurement,tagset` precalcolati e in cache: per le serie
+  statiche (stesso measurement e stessi tag ad ogni ciclo) l'escape dei tag
+  avviene una sola volta.
+- `encode_many()` codifica un lotto di punti in un unico payload.
+
+Regole di escape (come le vecchie funzioni di atlas-mobile): backslash,
+spazio e virgola nel measurement; anche `=` in chiavi/valori dei tag e nelle
+chiavi dei campi; backslash e doppi apici nei valori stringa.
+Tipi dei campi: bool -> true/false, int -> `<n>i`, float -> repr (o
+`digits` decimali fissi), il resto come stringa quotata. I campi None
+vengono saltati; senza campi il punto non viene emesso (None).
+
+Decodifica: `decode()` restituisce (measurement, tag, campi, timestamp) di
+una riga; `measurement_of()` estrae solo il measurement senza parsing
+completo, per scartare in fretta le righe che non interessano.
+
+Modulo condiviso tra iot-gateway e atlas-mobile (solo stdlib). Benchmark:
+`python3 atlas-common/bench_line_protocol.py`.
+"""
+
+_PREFIX_CACHE_MAX = 4096
+_prefix_cache = {}
+_key_cache = {}
+
+
+def escape_measurement(value):
+    return str(value).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,")
+
+
+def escape_tag(value):
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace(" ", "\\ ")
+        .replace(",", "\\,")
+        .replace("=", "\\=")
+    )
+
+
+def escape_string(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def escape_field_key(key):
+    escaped = _key_cache.get(key)
+    if escaped is None:
+        escaped = escape_tag(key)
+        if len(_key_cache) < _PREFIX_CACHE_MAX:
+            _key_cache[key] = escaped
+    return escaped
+
+
+def prefix(measurement, tags=None):
+    """`measurement[,k=v...]` già escaped, in cache per (measurement, tag)."""
+    cache_key = (measurement, tuple(tags.items()) if tags else ())
+    cached = _prefix_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    parts = [escape_measurement(measurement)]
+    for key, value in cache_key[1]:
+        if value is not None:
+            parts.append(f"{escape_tag(key)}={escape_tag(value)}")
+    cached = ",".join(parts)
+    if len(_prefix_cache) >= _PREFIX_CACHE_MAX:
+        # Tag ad alta cardinalità: meglio ricominciare che crescere senza limite
+        _prefix_cache.clear()
+    _prefix_cache[cache_key] = cached
+    return cached
+
+
+def format_fields(fields, digits=None):
+    """Campi `k=v` separati da virgola; `digits` arrotonda i float (default repr)."""
+    parts = []
+    for key, value in fields.items():
+        if value is None:
+            continue
+        key = escape_field_key(key)
+        kind = type(value)
+        if kind is float:
+            if digits is None:
+                parts.append(f"{key}={value!r}")
+            else:
+                parts.append(f"{key}={value:.{digits}f}")
+        elif kind is int:
+            parts.append(f"{key}={value}i")
+        elif kind is bool:
+            parts.append(f"{key}=true" if value else f"{key}=false")
+        elif isinstance(value, bool):
+            parts.append(f"{key}={str(value).lower()}")
+        elif isinstance(value, int):
+            parts.append(f"{key}={int(value)}i")
+        elif isinstance(value, float):
+            value = float(value)
+            parts.append(f"{key}={value!r}" if digits is None else f"{key}={value:.{digits}f}")
+        else:
+            parts.append(f'{key}="{escape_string(value)}"')
+    return ",".join(parts)
+
+
+def encode_prefixed(series_prefix, fields, timestamp_ns, digits=None):
+    """Riga da un prefisso già calcolato con `prefix()`."""
+    fields_part = format_fields(fields, digits) if fields else ""
+    if not fields_part:
+        return None
+    return f"{series_prefix} {fields_part} {timestamp_ns}"
+
+
+def encode(measurement, tags, fields, timestamp_ns, digits=None):
+    return encode_prefixed(prefix(measurement, tags), fields, timestamp_ns, digits)
+
+
+def encode_many(points):
+    """Codifica (measurement, tags, fields, timestamp_ns) in un payload multi-riga."""
+    lines = []
+    append = lines.append
+    for measurement, tags, fields, timestamp_ns in points:
+        line = encode_prefixed(prefix(measurement, tags), fields, timestamp_ns)
+        if line is not None:
+            append(line)
+    return "\n".join(lines)
+
+
+_UNESCAPE = {" ", ",", "=", "\\", '"'}
+_TRUE = {"t", "T", "true", "True", "TRUE"}
+_FALSE = {"f", "F", "false", "False", "FALSE"}
+
+
+def _unescape(text):
+    if "\\" not in text:
+        return text
+    out = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == "\\" and i + 1 < len(text) and text[i + 1] in _UNESCAPE:
+            out.append(text[i + 1])
+            i += 2
+            continue
+        out.append(char)
+        i += 1
+    return "".join(out)
+
+
+def _split(text, sep, quotes=False):
+    """Divide su `sep` non escaped (e fuori dai doppi apici con `quotes`)."""
+    if "\\" not in text and not (quotes and '"' in text):
+        return text.split(sep)
+    parts = []
+    start = 0
+    i = 0
+    quoted = False
+    while i < len(text):
+        char = text[i]
+        if char == "\\":
+            i += 2
+            continue
+        if quotes and char == '"':
+            quoted = not quoted
+        elif char == sep and not quoted:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _split_pair(pair):
+    pieces = _split(pair, "=")
+    if len(pieces) < 2:
+        return pair, "", ""
+    return pieces[0], "=", "=".join(pieces[1:])
+
+
+def _field_value(raw):
+    if raw.startswith('"'):
+        if len(raw) < 2 or not raw.endswith('"'):
+            raise ValueError(f"stringa non chiusa: {raw}")
+        return raw[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    if raw.endswith(("i", "u")):
+        return int(raw[:-1])
+    if raw in _TRUE:
+        return True
+    if raw in _FALSE:
+        return False
+    return float(raw)
+
+
+def measurement_of(line):
+    """Measurement (unescaped) di una riga, senza decodificare tag e campi."""
+    if "\\" not in line:
+        end = len(line)
+        for sep in (",", " "):
+            index = line.find(sep)
+            if 0 <= index < end:
+                end = index
+        return line[:end]
+    return _unescape(_split(_split(line, " ")[0], ",")[0])
+
+
+def decode(line):
+    """(measurement, tag, campi, timestamp_ns o None); ValueError se malformata."""
+    line = line.strip()
+    parts = _split(line, " ", quotes=True)
+    if len(parts) < 2 or not parts[0] or not parts[1]:
+        raise ValueError(f"riga line protocol non valida: {line!r}")
+    series = _split(parts[0], ",")
+    tags = {}
+    for pair in series[1:]:
+        key, sep, value = pair.partition("=") if "\\" not in pair else _split_pair(pair)
+        if not sep:
+            raise ValueError(f"tag non valido: {pair!r}")
+        tags[_unescape(key)] = _unescape(value)
+    fields = {}
+    for pair in _split(parts[1], ",", quotes=True):
+        key, sep, value = pair.partition("=") if "\\" not in pair else _split_pair(pair)
+        if not sep:
+            raise ValueError(f"campo non valido: {pair!r}")
+        fields[_unescape(key)] = _field_value(value)
+    timestamp = int(parts[2]) if len(parts) > 2 and parts[2] else None
+    return _unescape(series[0]), tags, fields, timestamp
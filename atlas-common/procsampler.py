@@ -0,0 +1,242 @@
+"""
+Campionamento di /proc a basso costo, senza psutil.
+
+`ProcSampler` tiene aperti i file di /proc (un fd per file) e li rilegge con
+`os.pread` dall'offset 0: niente open/close per ciclo e nessun oggetto file
+Python. Il parsing estrae solo i campi che servono (es. 4 chiavi di
+meminfo invece dell'intero file in un dict). I contatori cumulativi (CPU,
+interfacce di rete, dischi) sono convertiti in delta tra due chiamate
+successive: la prima chiamata di ciascun metodo restituisce solo lo stato
+iniziale ({} per i delta).
+
+Se un file non è leggibile (Android nega /proc/stat alle app da Android 8)
+il metodo corrispondente restituisce None e il chiamante usa il proprio
+fallback.
+
+Modulo condiviso tra iot-gateway e atlas-mobile (solo stdlib).
+"""
+
+import os
+import time
+
+SECTOR_BYTES = 512
+
+
+def _meminfo_kb(data, key):
+    start = data.find(key)
+    if start < 0:
+        return None
+    end = data.find(b"\n", start)
+    try:
+        return int(data[start + len(key):end].split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+class ProcSampler:
+    def __init__(self, root="/proc", interfaces=None, disks=None, clock=time.monotonic):
+        self.root = root
+        # None = tutte le interfacce tranne lo loopback / tutti i dischi
+        # tranne loop e ram
+        self.interfaces = set(interfaces) if interfaces else None
+        self.disks = set(disks) if disks else None
+        self.clock = clock
+        self._fds = {}
+        self._failed = set()
+        self._prev_cpu = None
+        self._prev_net = None
+        self._prev_disk = None
+
+    def close(self):
+        for fd in self._fds.values():
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._fds.clear()
+
+    def _read(self, name):
+        """Contenuto di /proc/<name> (bytes) o None se non leggibile."""
+        if name in self._failed:
+            return None
+        fd = self._fds.get(name)
+        try:
+            if fd is None:
+                fd = os.open(os.path.join(self.root, name), os.O_RDONLY)
+                self._fds[name] = fd
+            chunks = []
+            offset = 0
+            while True:
+                chunk = os.pread(fd, 65536, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+            return b"".join(chunks)
+        except OSError:
+            # Permessi (SELinux) o file assente: non si riprova ad ogni ciclo
+            self._failed.add(name)
+            if fd is not None:
+                self._fds.pop(name, None)
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+            return None
+
+    def cpu(self):
+        """{"cpu-total": %, "cpu0": %, ...} dall'ultima chiamata, o None."""
+        data = self._read("stat")
+        if data is None:
+            return None
+        current = {}
+        for line in data.split(b"\n"):
+            if not line.startswith(b"cpu"):
+                break
+            parts = line.split()
+            try:
+                values = [int(x) for x in parts[1:9]]
+            except ValueError:
+                continue
+            if len(values) < 4:
+                continue
+            idle = values[3] + (values[4] if len(values) > 4 else 0)
+            name = parts[0].decode()
+            current["cpu-total" if name == "cpu" else name] = (sum(values), idle)
+        previous, self._prev_cpu = self._prev_cpu, current
+        if previous is None:
+            return {}
+        usage = {}
+        for name, (total, idle) in current.items():
+            if name not in previous:
+                continue
+            delta_total = total - previous[name][0]
+            delta_idle = idle - previous[name][1]
+            if delta_total <= 0:
+                continue
+            usage[name] = min(100.0, max(0.0, 100.0 * (delta_total - delta_idle) / delta_total))
+        return usage
+
+    def memory(self):
+        """{"total", "available", "used"} in byte e "used_percent", o None."""
+        data = self._read("meminfo")
+        if data is None:
+            return None
+        total = _meminfo_kb(data, b"MemTotal:")
+        if not total:
+            return None
+        available = _meminfo_kb(data, b"MemAvailable:")
+        if available is None:
+            available = sum(
+                _meminfo_kb(data, key) or 0 for key in (b"MemFree:", b"Buffers:", b"Cached:")
+            )
+        used = total - available
+        return {
+            "total": total * 1024,
+            "available": available * 1024,
+            "used": used * 1024,
+            "used_percent": used / total * 100.0,
+        }
+
+    def uptime(self):
+        data = self._read("uptime")
+        if data is None:
+            return None
+        try:
+            return float(data.split()[0])
+        except (ValueError, IndexError):
+            return None
+
+    def loadavg(self):
+        """(load1, load5, load15) o None."""
+        data = self._read("loadavg")
+        if data is None:
+            return None
+        try:
+            parts = data.split()
+            return float(parts[0]), float(parts[1]), float(parts[2])
+        except (ValueError, IndexError):
+            return None
+
+    def _rates(self, current, previous, elapsed):
+        rates = {}
+        for name, counters in current.items():
+            before = previous.get(name)
+            if before is None:
+                continue
+            rates[name] = {
+                key: max(0, value - before[key]) / elapsed for key, value in counters.items()
+            }
+        return rates
+
+    def net(self):
+        """Contatori e byte/pacchetti al secondo per interfaccia, o None.
+
+        {iface: (contatori, rate)}; rate è {} alla prima chiamata.
+        """
+        data = self._read("net/dev")
+        if data is None:
+            return None
+        now = self.clock()
+        current = {}
+        for line in data.split(b"\n")[2:]:
+            name, sep, rest = line.partition(b":")
+            if not sep:
+                continue
+            name = name.strip().decode()
+            if self.interfaces is not None:
+                if name not in self.interfaces:
+                    continue
+            elif name == "lo":
+                continue
+            fields = rest.split()
+            if len(fields) < 16:
+                continue
+            current[name] = {
+                "bytes_recv": int(fields[0]),
+                "packets_recv": int(fields[1]),
+                "err_in": int(fields[2]),
+                "drop_in": int(fields[3]),
+                "bytes_sent": int(fields[8]),
+                "packets_sent": int(fields[9]),
+                "err_out": int(fields[10]),
+                "drop_out": int(fields[11]),
+            }
+        previous, self._prev_net = self._prev_net, (now, current)
+        rates = {}
+        if previous is not None and now > previous[0]:
+            rates = self._rates(current, previous[1], now - previous[0])
+        return {name: (counters, rates.get(name, {})) for name, counters in current.items()}
+
+    def diskio(self):
+        """Contatori e operazioni/byte al secondo per disco, o None.
+
+        {disco: (contatori, rate)}; rate è {} alla prima chiamata.
+        """
+        data = self._read("diskstats")
+        if data is None:
+            return None
+        now = self.clock()
+        current = {}
+        for line in data.split(b"\n"):
+            fields = line.split()
+            if len(fields) < 14:
+                continue
+            name = fields[2].decode()
+            if self.disks is not None:
+                if name not in self.disks:
+                    continue
+            elif name.startswith(("loop", "ram")):
+                continue
+            current[name] = {
+                "reads": int(fields[3]),
+                "read_bytes": int(fields[5]) * SECTOR_BYTES,
+                "writes": int(fields[7]),
+                "write_bytes": int(fields[9]) * SECTOR_BYTES,
+                "io_time": int(fields[12]),
+            }
+        previous, self._prev_disk = self._prev_disk, (now, current)
+        rates = {}
+        if previous is not None and now > previous[0]:
+            rates = self._rates(current, previous[1], now - previous[0])
+        return {name: (counters, rates.get(name, {})) for name, counters in current.items()}
@@ -0,0 +1,168 @@
+"""
+Coda store-and-forward su SQLite (WAL) per i periodi senza broker.
+
+Ogni riga è un payload line-protocol già pronto, con il topic di
+destinazione (None = topic di default di chi pubblica). L'occupazione è
+limitata a `max_bytes`: oltre soglia vengono scartati i record più vecchi
+(ring buffer). Dopo la riconnessione un thread dedicato rinvia il backlog
+unendo righe consecutive dello stesso topic in payload fino a
+`replay_batch_bytes`, al massimo `replay_rate` messaggi e
+`replay_bandwidth` byte al secondo, così il replay non affama la telemetria
+live. Le righe vengono cancellate solo dopo il PUBACK. Eventuali duplicati
+(PUBACK perso) sono innocui: in InfluxDB lo stesso punto (serie +
+timestamp) sovrascrive.
+
+`publish_fn(topic, payload)` deve restituire un `MQTTMessageInfo` di paho.
+
+Modulo condiviso tra iot-gateway e atlas-mobile (solo stdlib).
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# paho.mqtt.client.MQTT_ERR_SUCCESS (il modulo resta solo stdlib)
+_MQTT_ERR_SUCCESS = 0
+
+
+class SpoolQueue:
+    def __init__(self, path, publish_fn, max_bytes=64 * 1024 * 1024,
+                 replay_batch_bytes=65536, replay_rate=5.0, replay_bandwidth=0,
+                 ack_timeout=10.0):
+        self.path = path
+        self.publish_fn = publish_fn
+        self.max_bytes = int(max_bytes)
+        self.replay_batch_bytes = int(replay_batch_bytes)
+        self.replay_rate = float(replay_rate)
+        self.replay_bandwidth = float(replay_bandwidth)
+        self.ack_timeout = float(ack_timeout)
+        self.dropped = 0
+        self.replayed = 0
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._pending = threading.Event()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS spool ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, payload TEXT NOT NULL, size INTEGER NOT NULL, "
+            "topic TEXT)"
+        )
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(spool)")]
+        if "topic" not in columns:
+            # Spool creati prima della colonna topic
+            self._db.execute("ALTER TABLE spool ADD COLUMN topic TEXT")
+        row = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM spool").fetchone()
+        self.records, self.bytes = row
+        if self.records:
+            self._pending.set()
+        threading.Thread(target=self._replay_loop, name="spool-replay", daemon=True).start()
+
+    def append(self, payload, topic=None):
+        size = len(payload.encode("utf-8"))
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO spool (payload, size, topic) VALUES (?, ?, ?)", (payload, size, topic)
+            )
+            self.records += 1
+            self.bytes += size
+            if self.bytes > self.max_bytes:
+                self._evict()
+        self._pending.set()
+
+    def set_connected(self, connected):
+        if connected:
+            self._connected.set()
+        else:
+            self._connected.clear()
+
+    def _evict(self):
+        # Libera fino al 90% della soglia per non rientrare qui ad ogni append
+        target = self.max_bytes * 0.9
+        dropped = 0
+        while self.bytes > target and self.records > 1:
+            rows = self._db.execute(
+                "SELECT id, size FROM spool ORDER BY id LIMIT 256"
+            ).fetchall()
+            last_id = None
+            for row_id, size in rows:
+                if self.bytes <= target or self.records <= 1:
+                    break
+                last_id = row_id
+                self.bytes -= size
+                self.records -= 1
+                dropped += 1
+            if last_id is None:
+                break
+            self._db.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+        if dropped:
+            self.dropped += dropped
+            logger.warning(f"Spool pieno: scartati {dropped} record più vecchi")
+
+    def _peek(self):
+        """Righe consecutive con lo stesso topic fino a `replay_batch_bytes`."""
+        with self._lock:
+            cursor = self._db.execute("SELECT id, payload, size, topic FROM spool ORDER BY id")
+            last_id = None
+            batch_topic = None
+            parts = []
+            total = 0
+            for row_id, payload, size, topic in cursor:
+                if parts and (topic != batch_topic or total + size > self.replay_batch_bytes):
+                    break
+                batch_topic = topic
+                parts.append(payload)
+                total += size + 1
+                last_id = row_id
+            cursor.close()
+        return last_id, batch_topic, parts
+
+    def _ack(self, last_id):
+        with self._lock:
+            # Conta solo le righe ancora presenti (l'eviction può averne tolte)
+            count, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM spool WHERE id <= ?", (last_id,)
+            ).fetchone()
+            self._db.execute("DELETE FROM spool WHERE id <= ?", (last_id,))
+            self.records -= count
+            self.bytes -= size
+            self.replayed += count
+
+    def _replay_loop(self):
+        while True:
+            self._pending.wait()
+            self._connected.wait()
+            last_id, topic, parts = self._peek()
+            if last_id is None:
+                self._pending.clear()
+                continue
+            payload = "\n".join(parts)
+            info = self.publish_fn(topic, payload)
+            if info.rc == _MQTT_ERR_SUCCESS:
+                try:
+                    info.wait_for_publish(timeout=self.ack_timeout)
+                except (RuntimeError, ValueError):
+                    pass
+            if info.is_published():
+                self._ack(last_id)
+                logger.debug("Spool: rinviati %d record (%d byte), in coda %d",
+                             len(parts), len(payload), self.records)
+                if not self.records:
+                    logger.info("Spool svuotato: backlog rinviato al broker")
+            else:
+                logger.warning(f"Spool: replay non confermato (rc={info.rc}), riprovo")
+                time.sleep(1.0)
+            pause = 1.0 / self.replay_rate if self.replay_rate > 0 else 0.0
+            if self.replay_bandwidth > 0:
+                pause = max(pause, len(payload) / self.replay_bandwidth)
+            if pause > 0:
+                time.sleep(pause)
@@ -11,6 +11,16 @@ Caratteristiche:
 - Segnala blocchi di private key
 - Segnala password hardcoded
 
+Prestazioni:
+- Prefiltro per categoria (`PATTERN_PREFILTERS`): una regex economica di
+  parole chiave (es. "AKIA", "eyJ", "passw", cifre-punto-cifra) scorre il file
+  intero una volta e individua le righe candidate; una regex gira solo sulle
+  righe candidate per la sua categoria, le altre righe non vengono toccate.
+- Le regex candidate di una riga sono fuse in un'unica regex con gruppi
+  nominati (un lookahead per pattern, in cache per combinazione): una sola
+  chiamata `match` per riga, con gli stessi match delle ricerche separate.
+- Benchmark e verifica dei risultati: `python3 bench_script.py`.
+
 Nota:
 - Questo script NON sostituisce la revisione umana, ma ti crea una "todo list" rapida.
 """
@@ -21,9 +31,11 @@ import argparse
 import os
 import re
 import sys
+from bisect import bisect_right
 from dataclasses import dataclass
+from itertools import accumulate
 from pathlib import Path
-from typing import Iterable, Iterator, List, Optional, Tuple
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 # ----------------------------
@@ -180,6 +192,213 @@ def compile_patterns() -> List[Tuple[str, re.Pattern]]:
     return compiled
 
 
+# ----------------------------
+# Prefiltro a parole chiave + regex combinate
+# ----------------------------
+
+# Per ogni categoria: regex (solo parole chiave letterali o quasi) che DEVE
+# trovare qualcosa nella riga perché la regex della categoria possa matchare.
+# Stessi flag del pattern: con IGNORECASE le equivalenze Unicode ("ſ" ~ "s",
+# "K" ~ "k") valgono per entrambe. Le parole dei prefiltri `(?i)` sono in
+# minuscolo: girano senza flag sul testo in minuscolo (stessi offset, molto
+# più veloce) se il testo non contiene `_CASEFOLD_SPECIAL`. Condizione
+# necessaria, non sufficiente: la regex resta l'unico giudice. Categorie
+# senza voce girano su ogni riga.
+PATTERN_PREFILTERS: Dict[str, str] = {
+    "PRIVATE_KEY_BLOCK": r"-----BEGIN ",
+    "IPV4_HARDCODED": r"\d\.\d",
+    "TAILSCALE_LIKE_IP": r"100\.\d",
+    "HARDCODED_SECRET_ASSIGNMENT": r"(?i)token|secret|key|bearer|passw|pwd",
+    "HARDCODED_BEARER_TOKEN": r"(?i)authorization",
+    "JWT_TOKEN": r"eyJ",
+    "AWS_ACCESS_KEY_ID": r"AKIA",
+    "AWS_SECRET_ACCESS_KEY_LIKE": r"(?i)secret",
+    "GITHUB_TOKEN": r"ghp_|github_pat_",
+    "STRIPE_SECRET_KEY": r"sk_(?:live|test)_",
+    "SUSPICIOUS_LONG_SECRET": r"(?i)secret|token|key|password",
+}
+
+_GLOBAL_FLAGS = re.compile(r"^\(\?([aiLmsux]+)\)")
+
+# Gli unici caratteri non ASCII che con IGNORECASE matchano lettere ASCII
+# o che `lower()` trasforma in lettere ASCII / in più caratteri. Senza di
+# loro `(?i)parola` su `text` equivale a `parola` su `text.lower()`.
+_CASEFOLD_SPECIAL = re.compile("[\u0130\u0131\u017f\u212a]")
+
+
+def namespace_groups(source: str, prefix: str, verbose: bool) -> str:
+    """
+    Rende unici i gruppi di `source` dentro una regex combinata: ogni gruppo
+    catturante (anche anonimo) diventa `(?P<{prefix}gN>...)` e i
+    backreference `\\N` / `(?P=nome)` puntano al gruppo rinominato.
+    """
+    out: List[str] = []
+    names: Dict[str, str] = {}
+    count = 0
+    i = 0
+    in_class = False
+    while i < len(source):
+        c = source[i]
+        if c == "\\":
+            j = i + 1
+            while not in_class and j < len(source) and source[j].isdigit() and j - i <= 2:
+                j += 1
+            if j > i + 1 and source[i + 1] != "0":
+                out.append(f"(?P={prefix}g{source[i + 1:j]})")
+                i = j
+            else:
+                out.append(source[i:i + 2])
+                i += 2
+            continue
+        if in_class:
+            out.append(c)
+            if c == "]":
+                in_class = False
+            i += 1
+            continue
+        if c == "[":
+            # `]` subito dopo `[` o `[^` è un letterale
+            j = i + 1
+            if source.startswith("^", j):
+                j += 1
+            if source.startswith("]", j):
+                j += 1
+            out.append(source[i:j])
+            in_class = True
+            i = j
+            continue
+        if verbose and c == "#":
+            end = source.find("\n", i)
+            end = len(source) if end < 0 else end
+            out.append(source[i:end])
+            i = end
+            continue
+        if c == "(":
+            if source.startswith("(?P<", i):
+                end = source.index(">", i)
+                count += 1
+                names[source[i + 4:end]] = f"{prefix}g{count}"
+                out.append(f"(?P<{prefix}g{count}>")
+                i = end + 1
+                continue
+            if source.startswith("(?P=", i):
+                end = source.index(")", i)
+                out.append(f"(?P={names[source[i + 4:end]]})")
+                i = end + 1
+                continue
+            if not source.startswith("(?", i):
+                count += 1
+                out.append(f"(?P<{prefix}g{count}>")
+                i += 1
+                continue
+        out.append(c)
+        i += 1
+    return "".join(out)
+
+
+class PatternScanner:
+    """
+    Pattern di `compile_patterns()` con prefiltro a parole chiave e regex
+    combinate per insieme di categorie candidate.
+
+    La regex combinata è `(?:(?=.*?(?P<pN>...))|)` ripetuta per ogni
+    candidata: ogni lookahead trova il primo match del proprio pattern a
+    partire da inizio riga, cioè lo stesso risultato di `rx.search(line)`,
+    anche quando i match di categorie diverse si sovrappongono (IP e
+    100.x.x.x, Bearer e JWT). I gruppi interni sono rinominati per pattern;
+    per i pattern con gruppi, solo sulle righe che matchano, si rifà la
+    `search` originale per avere lo stesso Match (group(3), lastindex).
+    """
+
+    def __init__(self, patterns: List[Tuple[str, re.Pattern]]):
+        self.patterns = list(patterns)
+        # (prefiltro, variante senza IGNORECASE per il testo in minuscolo)
+        self._prefilters: List[Optional[Tuple[re.Pattern, Optional[re.Pattern]]]] = []
+        for category, _ in self.patterns:
+            source = PATTERN_PREFILTERS.get(category)
+            if source is None:
+                self._prefilters.append(None)
+                continue
+            prefilter = re.compile(source)
+            lowered = None
+            if prefilter.flags & re.IGNORECASE:
+                lowered = re.compile(_GLOBAL_FLAGS.sub("", source))
+            self._prefilters.append((prefilter, lowered))
+        self._combined: Dict[Tuple[int, ...], re.Pattern] = {}
+
+    def candidate_lines(self, text: str) -> List[Tuple[int, Tuple[int, ...]]]:
+        """
+        (indice di riga in `text.splitlines()`, pattern candidati) per le sole
+        righe in cui almeno un prefiltro trova qualcosa, in ordine di riga.
+        Ogni prefiltro scorre il testo intero e salta alla riga successiva al
+        primo riscontro: il lavoro in Python è proporzionale alle righe
+        candidate, non alle righe del file.
+        """
+        starts = list(accumulate(map(len, text.splitlines(keepends=True)), initial=0))
+        n_lines = len(starts) - 1
+        lowered_text = None
+        if text.isascii() or not _CASEFOLD_SPECIAL.search(text):
+            lowered_text = text.lower()
+        per_line: Dict[int, List[int]] = {}
+        for i, prefilters in enumerate(self._prefilters):
+            if prefilters is None:
+                for line_idx in range(n_lines):
+                    per_line.setdefault(line_idx, []).append(i)
+                continue
+            prefilter, lowered = prefilters
+            haystack = text
+            if lowered is not None and lowered_text is not None:
+                prefilter, haystack = lowered, lowered_text
+            m = prefilter.search(haystack)
+            while m:
+                line_idx = bisect_right(starts, m.start()) - 1
+                per_line.setdefault(line_idx, []).append(i)
+                if line_idx + 1 >= n_lines:
+                    break
+                m = prefilter.search(haystack, starts[line_idx + 1])
+        return [(line_idx, tuple(sorted(per_line[line_idx]))) for line_idx in sorted(per_line)]
+
+    def _compile_combined(self, indexes: Tuple[int, ...]) -> re.Pattern:
+        parts = []
+        for i in indexes:
+            source = self.patterns[i][1].pattern
+            flags = ""
+            global_flags = _GLOBAL_FLAGS.match(source)
+            if global_flags:
+                flags = global_flags.group(1)
+                source = source[global_flags.end():]
+            source = namespace_groups(source, f"p{i}_", "x" in flags)
+            if flags:
+                # In verbose un commento finale non deve inghiottire la ")"
+                newline = "\n" if "x" in flags else ""
+                source = f"(?{flags}:{source}{newline})"
+            parts.append(f"(?:(?=.*?(?P<p{i}>{source}))|)")
+        return re.compile("".join(parts))
+
+    def search_line(self, line: str, candidates: Tuple[int, ...]) -> Iterator[Tuple[str, str, Optional[re.Match]]]:
+        """
+        (categoria, testo del match, Match originale o None) per ogni pattern
+        candidato che matcha la riga; il Match c'è solo per i pattern con gruppi.
+        """
+        if len(candidates) == 1:
+            # Un solo candidato: la search originale (ottimizzazioni sui letterali)
+            category, rx = self.patterns[candidates[0]]
+            m = rx.search(line)
+            if m:
+                yield category, m.group(0), m
+            return
+        combined = self._combined.get(candidates)
+        if combined is None:
+            combined = self._combined[candidates] = self._compile_combined(candidates)
+        m = combined.match(line)
+        for i in candidates:
+            match_text = m.group(f"p{i}")
+            if match_text is None:
+                continue
+            category, rx = self.patterns[i]
+            yield category, match_text, rx.search(line) if rx.groups else None
+
+
 # ----------------------------
 # Helpers per scan
 # ----------------------------
@@ -219,6 +438,10 @@ def should_skip_path(path: Path, root: Path, exclude_dirs: set, exclude_suffixes
     return False
 
 
+# Byte "testuali" per is_probably_binary (tab/newline/carriage + ASCII stampabile)
+_TEXT_BYTES = bytes([9, 10, 13]) + bytes(range(32, 127))
+
+
 def is_probably_binary(data: bytes) -> bool:
     """
     Heuristica semplice: se troviamo tanti null byte, o byte non testuali, probabilmente è binario.
@@ -229,8 +452,9 @@ def is_probably_binary(data: bytes) -> bool:
     if b"\x00" in data:
         return True
     # Se troppi byte fuori range "testuale" (tolleriamo tab/newline/carriage)
-    text_like = sum(1 for b in data[:4096] if (32 <= b <= 126) or b in (9, 10, 13))
-    ratio = text_like / max(1, len(data[:4096]))
+    sample = data[:4096]
+    text_like = len(sample) - len(sample.translate(None, _TEXT_BYTES))
+    ratio = text_like / max(1, len(sample))
     return ratio < 0.80
 
 
@@ -274,9 +498,85 @@ def iter_files(root: Path, exclude_dirs: set, exclude_suffixes: set) -> Iterator
             yield p
 
 
-def scan_file(path: Path, patterns: List[Tuple[str, re.Pattern]], max_size: int) -> List[Finding]:
+def make_finding(path: Path, idx: int, line: str, category: str, match_text: str,
+                 m: Optional[re.Match]) -> Optional[Finding]:
+    """
+    Finding per un match di `category` (None se è un placeholder da ignorare).
+    `m` è il Match della regex della categoria, se ha gruppi.
+    """
+    if category == "HARDCODED_SECRET_ASSIGNMENT":
+        # gruppo 3/4: dipende dalla regex
+        # regex: (name)(quote?)(value)
+        try:
+            val = m.group(3)
+        except IndexError:
+            val = match_text
+
+        if is_placeholder_secret(val):
+            return None
+
+        # Segnala come HARD-CODED
+        return Finding(
+            file=str(path),
+            line=idx,
+            category=category + " (LIKELY_HARDCODED)",
+            match=sanitize_value(val),
+            context=sanitize_value(line)
+        )
+
+    if category in {"SUSPICIOUS_LONG_SECRET", "AWS_SECRET_ACCESS_KEY_LIKE"}:
+        # cerca un valore "lungo"
+        # prendiamo ultimo gruppo se esiste
+        val = None
+        if m is not None and m.lastindex:
+            val = m.group(m.lastindex)
+        if val and is_placeholder_secret(val):
+            return None
+
+        return Finding(
+            file=str(path),
+            line=idx,
+            category=category + " (POSSIBLY_HARDCODED)",
+            match=sanitize_value(val or match_text),
+            context=sanitize_value(line)
+        )
+
+    # IP: segnala sempre (sono infra disclosure)
+    if category in {"IPV4_HARDCODED", "TAILSCALE_LIKE_IP"}:
+        return Finding(
+            file=str(path),
+            line=idx,
+            category=category,
+            match=match_text,
+            context=sanitize_value(line)
+        )
+
+    # Tutto il resto
+    return Finding(
+        file=str(path),
+        line=idx,
+        category=category,
+        match=sanitize_value(match_text),
+        context=sanitize_value(line)
+    )
+
+
+_scanners: Dict[int, PatternScanner] = {}
+
+
+def scan_file(path: Path, patterns, max_size: int) -> List[Finding]:
+    """
+    `patterns`: PatternScanner oppure la lista di `compile_patterns()`
+    (in quel caso lo scanner viene creato una volta e riusato).
+    """
     findings: List[Finding] = []
 
+    if not isinstance(patterns, PatternScanner):
+        scanner = _scanners.get(id(patterns))
+        if scanner is None or scanner.patterns != list(patterns):
+            scanner = _scanners[id(patterns)] = PatternScanner(patterns)
+        patterns = scanner
+
     try:
         st = path.stat()
         if st.st_size > max_size:
@@ -303,77 +603,19 @@ def scan_file(path: Path, patterns: List[Tuple[str, re.Pattern]], max_size: int)
 
     lines = text.splitlines()
 
-    for idx, line in enumerate(lines, start=1):
+    # Prefiltro sul file intero: solo le righe candidate, solo i pattern
+    # candidati per ciascuna
+    for line_idx, candidates in patterns.candidate_lines(text):
+        line = lines[line_idx]
+
         # Evita di scandire linee mega-lunghe (minimizza rumore)
         if len(line) > 5000:
             continue
 
-        for category, rx in patterns:
-            m = rx.search(line)
-            if not m:
-                continue
-
-            # Per alcune regex prendiamo gruppo "valore"
-            match_text = m.group(0)
-
-            if category == "HARDCODED_SECRET_ASSIGNMENT":
-                # gruppo 3/4: dipende dalla regex
-                # regex: (name)(quote?)(value)
-                try:
-                    val = m.group(3)
-                except IndexError:
-                    val = match_text
-
-                if is_placeholder_secret(val):
-                    continue
-
-                # Segnala come HARD-CODED
-                findings.append(Finding(
-                    file=str(path),
-                    line=idx,
-                    category=category + " (LIKELY_HARDCODED)",
-                    match=sanitize_value(val),
-                    context=sanitize_value(line)
-                ))
-                continue
-
-            if category in {"SUSPICIOUS_LONG_SECRET", "AWS_SECRET_ACCESS_KEY_LIKE"}:
-                # cerca un valore "lungo"
-                # prendiamo ultimo gruppo se esiste
-                val = None
-                if m.lastindex:
-                    val = m.group(m.lastindex)
-                if val and is_placeholder_secret(val):
-                    continue
-
-                findings.append(Finding(
-                    file=str(path),
-                    line=idx,
-                    category=category + " (POSSIBLY_HARDCODED)",
-                    match=sanitize_value(val or match_text),
-                    context=sanitize_value(line)
-                ))
-                continue
-
-            # IP: segnala sempre (sono infra disclosure)
-            if category in {"IPV4_HARDCODED", "TAILSCALE_LIKE_IP"}:
-                findings.append(Finding(
-                    file=str(path),
-                    line=idx,
-                    category=category,
-                    match=match_text,
-                    context=sanitize_value(line)
-                ))
-                continue
-
-            # Tutto il resto
-            findings.append(Finding(
-                file=str(path),
-                line=idx,
-                category=category,
-                match=sanitize_value(match_text),
-                context=sanitize_value(line)
-            ))
+        for category, match_text, m in patterns.search_line(line, candidates):
+            finding = make_finding(path, line_idx + 1, line, category, match_text, m)
+            if finding is not None:
+                findings.append(finding)
 
     return findings
 
@@ -438,7 +680,7 @@ def main() -> int:
     exclude_dirs = set(DEFAULT_EXCLUDE_DIRS) | set(args.exclude_dir)
     exclude_suffixes = set(DEFAULT_EXCLUDE_SUFFIXES)
 
-    patterns = compile_patterns()
+    patterns = PatternScanner(compile_patterns())
 
     findings: List[Finding] = []
 
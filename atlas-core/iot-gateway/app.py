@@ -1,14 +1,34 @@
 #!/usr/bin/env python3
 import os
+import sys
 import paho.mqtt.client as mqtt
 import json
+import importlib
 import time
 import random
 import psutil
 import yaml
 import logging
+import queue
+import sqlite3
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
 from datetime import datetime
 
+# Moduli condivisi: nell'immagine Docker sono copiati accanto ad app.py,
+# nel repo stanno in atlas-common/
+_COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'atlas-common')
+if os.path.isdir(_COMMON_DIR):
+    sys.path.append(_COMMON_DIR)
+
+from asynclog import PeriodicSummary, setup_async_logging
+from deadband import DeadbandFilter
+from diagnostics import RemoteProfiler
+from spoolqueue import SpoolQueue
+from procsampler import ProcSampler
+import line_protocol
+
 def _to_bool(value):
     if isinstance(value, bool):
         return value
@@ -57,6 +77,11 @@ config['mqtt']['tls']['enabled'] = _resolve_env(
     'GATEWAY_MQTT_TLS_ENABLED',
     cast=_to_bool
 )
+# Topic diagnostica: default accanto al topic comandi
+config['mqtt']['topics'].setdefault(
+    'diagnostics',
+    config['mqtt']['topics']['commands'].rsplit('/', 1)[0] + '/diagnostics'
+)
 config['logging']['level'] = _resolve_env(
     config['logging']['level'],
     'GATEWAY_LOG_LEVEL'
@@ -66,21 +91,647 @@ config['logging']['file'] = _resolve_env(
     'GATEWAY_LOG_FILE'
 )
 
-# Setup logging
-logging.basicConfig(
-    level=getattr(logging, config['logging']['level']),
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
+# Setup logging: I/O su file/console nel thread del QueueListener
+log_handler = setup_async_logging(
+    getattr(logging, config['logging']['level']),
+    [
         logging.FileHandler(config['logging']['file']),
         logging.StreamHandler()
     ]
 )
 logger = logging.getLogger(__name__)
+# Riepilogo periodico al posto di una riga INFO per ogni publish
+publish_summary = PeriodicSummary(
+    logger,
+    "messaggi di telemetria inviati",
+    period=config['logging'].get('summary_interval', 60)
+)
+
+# Modalità load generator: N device virtuali al posto del singolo gateway
+if '--loadgen' in sys.argv[1:] or os.getenv('GATEWAY_MODE') == 'loadgen':
+    from loadgen import run_loadgen
+    sys.exit(run_loadgen(config))
+
+class TickScheduler:
+    """
+    Scheduler a deadline fisse su clock monotono, con una cadenza per voce.
+
+    Le deadline di ogni voce sono calcolate come multipli del suo intervallo a
+    partire dal tick precedente, quindi il tempo speso a campionare/pubblicare
+    non si accumula (niente drift). Se un ciclo sfora oltre la deadline
+    successiva i tick persi vengono saltati (contati in `overruns`) invece di
+    recuperarli a raffica. `set_interval()` sveglia subito il thread in attesa.
+    """
+
+    def __init__(self):
+        self.overruns = 0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        # nome -> [intervallo, prossima deadline, ultimo tick]
+        self._entries = {}
+
+    def add(self, name, interval):
+        with self._lock:
+            self._entries[name] = [float(interval), None, None]
+        self._wake.set()
+
+    def set_interval(self, interval, name=None):
+        with self._lock:
+            if name is not None and name not in self._entries:
+                raise KeyError(name)
+            for key, entry in self._entries.items():
+                if name is not None and key != name:
+                    continue
+                entry[0] = float(interval)
+                if entry[2] is not None:
+                    entry[1] = entry[2] + entry[0]
+        self._wake.set()
+
+    def intervals(self):
+        with self._lock:
+            return {name: entry[0] for name, entry in self._entries.items()}
+
+    def wait(self):
+        """Blocca fino alla prossima deadline; ritorna (tick, voci scadute)."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                for entry in self._entries.values():
+                    if entry[1] is None:
+                        entry[1] = now
+                deadline = min((entry[1] for entry in self._entries.values()), default=None)
+            remaining = 3600.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self._wake.wait(remaining):
+                self._wake.clear()
+        due = []
+        with self._lock:
+            now = time.monotonic()
+            for name, entry in self._entries.items():
+                interval, next_deadline, _ = entry
+                if next_deadline > now:
+                    continue
+                due.append(name)
+                entry[2] = next_deadline
+                entry[1] = next_deadline + interval
+                if entry[1] <= now:
+                    skipped = int((now - entry[1]) // interval) + 1
+                    self.overruns += skipped
+                    entry[1] += skipped * interval
+        return deadline, due
+
+
+class LineBatcher:
+    """
+    Accumula record line-protocol e li invia come un unico messaggio MQTT.
+
+    Il flush avviene quando il buffer raggiunge `max_bytes` oppure quando il
+    record più vecchio ha atteso `linger` secondi (thread di flush dedicato).
+    Con `linger=0` ogni `add()` viene inviato subito (comportamento storico).
+
+    Ordine: un lotto chiuso (per dimensione, linger o flush esplicito) entra
+    nella coda `_ready` sotto lo stesso lock che protegge il buffer, quindi
+    nell'ordine di arrivo dei record; chi pubblica svuota la coda in FIFO
+    tenendo `_flush_lock`. Qualunque thread faccia il flush, i messaggi
+    escono nell'ordine dei record.
+    Il payload è una sequenza di righe separate da newline, già gestita da
+    Telegraf `mqtt_consumer` con `data_format = "influx"`.
+    """
+
+    def __init__(self, publish_fn, max_bytes=16384, linger=0.0):
+        self.publish_fn = publish_fn
+        self.max_bytes = int(max_bytes)
+        self.linger = float(linger)
+        self._lines = []
+        self._size = 0
+        self._first_at = None
+        self._sampled_at = None
+        self._cond = threading.Condition()
+        # Lotti chiusi in attesa di publish, in ordine di chiusura
+        self._ready = deque()
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+        if self.linger > 0:
+            threading.Thread(target=self._linger_loop, daemon=True).start()
+
+    @property
+    def buffered(self):
+        return len(self._lines)
+
+    def add(self, lines, sampled_at=None):
+        """Accoda righe; `sampled_at` (monotono) è l'istante di campionamento."""
+        with self._cond:
+            for line in lines:
+                size = len(line.encode('utf-8')) + 1
+                if self._lines and self._size + size > self.max_bytes:
+                    self._take()
+                if not self._lines:
+                    self._first_at = time.monotonic()
+                    self._cond.notify()
+                if sampled_at is not None and (self._sampled_at is None or sampled_at < self._sampled_at):
+                    self._sampled_at = sampled_at
+                self._lines.append(line)
+                self._size += size
+            if self._size >= self.max_bytes or self.linger <= 0:
+                self._take()
+        self._drain()
+
+    def flush(self):
+        with self._cond:
+            self._take()
+        self._drain()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self.flush()
+
+    def _take(self):
+        # Con `_cond` acquisito: chiude il lotto corrente nella coda _ready
+        if self._lines:
+            self._ready.append((self._lines, self._sampled_at))
+        self._lines = []
+        self._size = 0
+        self._first_at = None
+        self._sampled_at = None
+
+    def _drain(self):
+        # Un solo thread pubblica alla volta, sempre il lotto più vecchio:
+        # un lotto chiuso dopo non può uscire prima
+        with self._flush_lock:
+            while True:
+                with self._cond:
+                    if not self._ready:
+                        return
+                    lines, sampled_at = self._ready.popleft()
+                self.publish_fn(lines, sampled_at)
+
+    def _linger_loop(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if self._first_at is None:
+                        self._cond.wait()
+                        continue
+                    remaining = self._first_at + self.linger - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                if self._stopped:
+                    return
+                self._take()
+            self._drain()
+
+
+class LatencyHistogram:
+    """Istogramma a bucket fissi (ms): memoria costante, percentili per bucket."""
+
+    BOUNDS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buckets = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000.0
+        for idx, bound in enumerate(self.BOUNDS_MS):
+            if ms <= bound:
+                break
+        else:
+            idx = len(self.BOUNDS_MS)
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, pct):
+        """Limite superiore del bucket che contiene il percentile (ms)."""
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for idx, bucket in enumerate(self.buckets):
+            seen += bucket
+            if seen >= rank and bucket:
+                return float(self.BOUNDS_MS[idx]) if idx < len(self.BOUNDS_MS) else self.max
+        return self.max
+
+
+class GatewayMetrics:
+    """
+    Metriche interne del gateway, emesse come `atlas_gateway_internal`.
+
+    Latenza campione -> PUBACK, publish ed errori sono per intervallo di
+    emissione (azzerati ad ogni riga); inflight, code e risorse di processo
+    sono valori istantanei.
+    """
+
+    # PUBACK arrivati prima di `track()` tenuti in attesa; oltre si scartano
+    # i più vecchi (publish non tracciati, mid riusati dopo il wrap a 65535)
+    EARLY_ACKS_MAX = 256
+    # Publish senza PUBACK da più di così sono considerati persi: paho
+    # riusa i mid dopo 65535 e una voce vecchia darebbe una latenza falsa
+    PENDING_TTL = 300.0
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = LatencyHistogram()
+        self.published = 0
+        self.acked = 0
+        self.publish_errors = 0
+        # mid -> (istante di campionamento, istante del publish), monotoni
+        self._pending = {}
+        self.pending_dropped = 0
+        # mid -> istante (monotono) del PUBACK non ancora tracciato
+        self._acked_early = {}
+        self._overruns_seen = 0
+        self._process = psutil.Process()
+        self._process.cpu_percent(interval=None)
+
+    def track(self, mid, sampled_at):
+        """
+        Registra un publish riuscito; ritorna la latenza se il PUBACK era già
+        arrivato (o None).
+
+        Va chiamata dopo `client.publish()`, non attorno: paho invoca
+        on_publish tenendo il proprio mutex dei messaggi in uscita, e tenere
+        `lock` durante il publish invertirebbe l'ordine dei due lock. Il
+        PUBACK può quindi precedere `track()`: lo riconcilia `_acked_early`.
+        """
+        with self.lock:
+            self.published += 1
+            acked_at = self._acked_early.pop(mid, None)
+            if sampled_at is None:
+                return None
+            if acked_at is None:
+                # pop: un mid riusato va in fondo, l'ordine resta quello di publish
+                self._pending.pop(mid, None)
+                self._pending[mid] = (sampled_at, time.monotonic())
+                return None
+            return self._record(acked_at - sampled_at)
+
+    def publish_error(self):
+        with self.lock:
+            self.publish_errors += 1
+
+    def on_publish(self, mid):
+        """Registra il PUBACK; ritorna la latenza campione -> PUBACK (o None)."""
+        now = time.monotonic()
+        with self.lock:
+            pending = self._pending.pop(mid, None)
+            if pending is None:
+                # Publish non (ancora) tracciato: track() lo ritrova qui
+                if len(self._acked_early) >= self.EARLY_ACKS_MAX:
+                    del self._acked_early[next(iter(self._acked_early))]
+                self._acked_early[mid] = now
+                return None
+            return self._record(now - pending[0])
+
+    def on_disconnect(self):
+        """I PUBACK dei publish in volo non arriveranno più: li scarta."""
+        with self.lock:
+            self.pending_dropped += len(self._pending)
+            self._pending.clear()
+            self._acked_early.clear()
+
+    def _expire_pending(self, now):
+        # Con `lock` acquisito; _pending è in ordine di publish
+        while self._pending:
+            mid, (_, published_at) = next(iter(self._pending.items()))
+            if now - published_at < self.PENDING_TTL:
+                break
+            del self._pending[mid]
+            self.pending_dropped += 1
+
+    def _record(self, latency):
+        # Con `lock` acquisito
+        self.acked += 1
+        self.latency.record(latency)
+        return latency
+
+    def line(self, device_id, timestamp_ns, overruns, extra):
+        with self.lock:
+            self._expire_pending(time.monotonic())
+            latency = self.latency
+            fields = {
+                'published': self.published,
+                'acked': self.acked,
+                'publish_errors': self.publish_errors,
+                'inflight': len(self._pending),
+                'inflight_dropped': self.pending_dropped,
+                'latency_count': latency.count,
+                'loop_overruns': overruns - self._overruns_seen,
+            }
+            if latency.count:
+                fields['latency_mean_ms'] = latency.total / latency.count
+                fields['latency_p50_ms'] = latency.percentile(50)
+                fields['latency_p95_ms'] = latency.percentile(95)
+                fields['latency_p99_ms'] = latency.percentile(99)
+                fields['latency_max_ms'] = latency.max
+            self._overruns_seen = overruns
+            self.published = 0
+            self.acked = 0
+            self.publish_errors = 0
+            self.pending_dropped = 0
+            latency.reset()
+        try:
+            with self._process.oneshot():
+                fields['rss_bytes'] = self._process.memory_info().rss
+                fields['cpu_percent'] = self._process.cpu_percent(interval=None)
+                fields['threads'] = self._process.num_threads()
+        except psutil.Error:
+            pass
+        fields.update(extra)
+        return line_protocol.encode(
+            'atlas_gateway_internal', {'device': device_id}, fields, timestamp_ns, digits=3
+        )
+
+
+# Registry dei collector: nome -> funzione(options) che ritorna un valore
+# (campo `value`) oppure un dict di campi line-protocol
+COLLECTORS = {}
+
+
+def register_collector(name):
+    def decorator(func):
+        COLLECTORS[name] = func
+        return func
+    return decorator
+
+
+@register_collector('temperature')
+def collect_temperature(options):
+    try:
+        temps = psutil.sensors_temperatures()
+        if temps and 'coretemp' in temps and len(temps['coretemp']) > 0:
+            return temps['coretemp'][0].current
+    except Exception:
+        pass
+    return 20.0 + random.uniform(-2, 2)
+
+
+@register_collector('cpu_usage')
+def collect_cpu_usage(options):
+    # Delta dall'ultima chiamata (campione precedente), non blocca
+    return psutil.cpu_percent(interval=None)
+
+
+# Collector senza psutil: /proc con file tenuti aperti (atlas-common).
+# Nel container /proc/stat, meminfo e loadavg sono quelli dell'host,
+# /proc/net/dev quello del network namespace del container.
+proc_sampler = ProcSampler()
+
+
+def _selected(items, options, key):
+    wanted = options.get(key)
+    return {name: value for name, value in items.items() if not wanted or name in wanted}
+
+
+@register_collector('proc_cpu')
+def collect_proc_cpu(options):
+    usage = proc_sampler.cpu()
+    if not usage or 'cpu-total' not in usage:
+        return None
+    fields = {'usage_active': usage['cpu-total']}
+    if options.get('percpu', False):
+        for name, value in usage.items():
+            if name != 'cpu-total':
+                fields[f"{name}_usage_active"] = value
+    return fields
+
+
+@register_collector('proc_mem')
+def collect_proc_mem(options):
+    memory = proc_sampler.memory()
+    if memory is None:
+        return None
+    return {
+        'used_percent': memory['used_percent'],
+        'used_bytes': memory['used'],
+        'available_bytes': memory['available'],
+    }
+
+
+@register_collector('proc_load')
+def collect_proc_load(options):
+    fields = {}
+    load = proc_sampler.loadavg()
+    if load is not None:
+        fields['load1'], fields['load5'], fields['load15'] = load
+    uptime = proc_sampler.uptime()
+    if uptime is not None:
+        fields['uptime'] = int(uptime)
+    return fields or None
+
+
+@register_collector('proc_net')
+def collect_proc_net(options):
+    interfaces = proc_sampler.net()
+    if not interfaces:
+        return None
+    fields = {}
+    for name, (counters, rates) in _selected(interfaces, options, 'interfaces').items():
+        if rates:
+            fields[f"{name}_bytes_recv_per_s"] = rates['bytes_recv']
+            fields[f"{name}_bytes_sent_per_s"] = rates['bytes_sent']
+        fields[f"{name}_err"] = counters['err_in'] + counters['err_out']
+        fields[f"{name}_drop"] = counters['drop_in'] + counters['drop_out']
+    return fields or None
+
+
+@register_collector('proc_diskio')
+def collect_proc_diskio(options):
+    disks = proc_sampler.diskio()
+    if not disks:
+        return None
+    fields = {}
+    for name, (counters, rates) in _selected(disks, options, 'disks').items():
+        if rates:
+            fields[f"{name}_read_bytes_per_s"] = rates['read_bytes']
+            fields[f"{name}_write_bytes_per_s"] = rates['write_bytes']
+            fields[f"{name}_iops"] = rates['reads'] + rates['writes']
+    return fields or None
+
+
+def resolve_collector(spec):
+    """Risolve un collector registrato o un plugin esterno `modulo:funzione`."""
+    if spec in COLLECTORS:
+        return COLLECTORS[spec]
+    if ':' in spec:
+        module_name, func_name = spec.split(':', 1)
+        return getattr(importlib.import_module(module_name), func_name)
+    raise KeyError(f"collector sconosciuto: {spec}")
+
+
+class Sensor:
+    """Sensore configurato: collector, cadenza, timeout e ultimo job."""
+
+    def __init__(self, name, options, default_interval):
+        self.name = name
+        self.options = options
+        self.collect = resolve_collector(options.get('collector', name))
+        self.interval = float(options.get('interval', default_interval))
+        self.timeout = float(options.get('timeout', min(2.0, self.interval)))
+        self.future = None
+        self.timeouts = 0
+        self.skipped = 0
+        self.errors = 0
+
+    @property
+    def busy(self):
+        return self.future is not None and not self.future.done()
+
+    def fields(self, value):
+        return value if isinstance(value, dict) else {'value': value}
+
+
+def sensor_line(device_id, sensor, fields, timestamp_ns):
+    # Prefisso `sensors,device=..,sensor=..` in cache: escape solo al primo uso
+    series = line_protocol.prefix('sensors', {'device': device_id, 'sensor': sensor})
+    return line_protocol.encode_prefixed(series, fields, timestamp_ns, digits=2)
+
+
+class WindowAggregator:
+    """
+    Statistiche per finestra (min/max/mean/last/count) per ogni campo numerico.
+
+    Lo stato è incrementale: cinque valori per serie (sensore, campo),
+    indipendentemente da quanti campioni arrivano nella finestra. `drain()`
+    restituisce i campi aggregati e azzera la finestra.
+    """
+
+    def __init__(self, window):
+        self.window = float(window)
+        self._lock = threading.Lock()
+        # (sensore, campo) -> [min, max, somma, count, last]
+        self._series = {}
+
+    def add(self, sensor, fields):
+        with self._lock:
+            for key, val in fields.items():
+                if isinstance(val, bool) or not isinstance(val, (int, float)):
+                    continue
+                stats = self._series.get((sensor, key))
+                if stats is None:
+                    self._series[(sensor, key)] = [val, val, val, 1, val]
+                    continue
+                if val < stats[0]:
+                    stats[0] = val
+                if val > stats[1]:
+                    stats[1] = val
+                stats[2] += val
+                stats[3] += 1
+                stats[4] = val
+
+    def drain(self):
+        with self._lock:
+            series = self._series
+            self._series = {}
+        result = {}
+        for (sensor, key), (v_min, v_max, v_sum, count, last) in series.items():
+            fields = result.setdefault(sensor, {})
+            fields[f"{key}_min"] = float(v_min)
+            fields[f"{key}_max"] = float(v_max)
+            fields[f"{key}_mean"] = v_sum / count
+            fields[f"{key}_last"] = float(last)
+            fields[f"{key}_count"] = count
+        return result
+
+
+def run_collector(sensor):
+    profiler.checkpoint()
+    return sensor.collect(sensor.options)
+
+
+def load_sensors(sensors_config):
+    sensors_config = dict(sensors_config or {})
+    default_interval = (sensors_config.get('temperature') or {}).get('interval', 5)
+    # Compatibilità: cpu_usage era sempre pubblicata con la temperatura
+    sensors_config.setdefault('cpu_usage', {'interval': default_interval})
+    sensors = {}
+    for name, options in sensors_config.items():
+        try:
+            sensors[name] = Sensor(name, options or {}, default_interval)
+        except Exception as e:
+            logger.error(f"Sensore {name} disabilitato: {e}")
+    return sensors
+
 
 # Variabili globali
-current_interval = config['sensors']['temperature']['interval']
+sensors = load_sensors(config.get('sensors'))
+scheduler = TickScheduler()
+for _sensor in sensors.values():
+    scheduler.add(_sensor.name, _sensor.interval)
+
+# Report-by-exception: regole per `<sensore>.<campo>`
+deadband_cfg = config.get('deadband') or {}
+deadband = DeadbandFilter(
+    deadband_cfg.get('fields'),
+    heartbeat=deadband_cfg.get('heartbeat', 300)
+)
+
+# Aggregazione edge opzionale: campiona ai ritmi dei sensori ma pubblica
+# solo le statistiche di finestra
+AGGREGATION_TICK = '_aggregation'
+aggregation_cfg = config.get('aggregation') or {}
+aggregator = None
+if aggregation_cfg.get('enabled', False):
+    aggregator = WindowAggregator(aggregation_cfg.get('window', 60))
+    scheduler.add(AGGREGATION_TICK, aggregator.window)
+    logger.info(f"Aggregazione attiva: finestra {aggregator.window}s")
+
+# Metriche interne (atlas_gateway_internal) sullo stesso topic di telemetria
+INTERNAL_TICK = '_internal'
+self_metrics_cfg = config.get('self_metrics') or {}
+metrics = GatewayMetrics()
+if self_metrics_cfg.get('enabled', True):
+    scheduler.add(INTERNAL_TICK, self_metrics_cfg.get('interval', 60))
+collector_pool = ThreadPoolExecutor(
+    max_workers=max(1, len(sensors)),
+    thread_name_prefix='collector'
+)
 connection_established = False
 
+def publish_payload(payload):
+    return client.publish(config['mqtt']['topics']['telemetry'], payload, qos=1)
+
+# Profiling remoto (cProfile/tracemalloc) su comando MQTT
+profiler = RemoteProfiler(
+    lambda payload: client.publish(config['mqtt']['topics']['diagnostics'], payload, qos=1),
+    config['mqtt']['client_id'],
+    max_duration=(config.get('diagnostics') or {}).get('max_duration', 300)
+)
+
+def spool_publish(topic, payload):
+    # Gira nel thread di replay dello spool
+    profiler.checkpoint()
+    return publish_payload(payload)
+
+# Spool su disco per le disconnessioni dal broker
+spool_cfg = config.get('spool') or {}
+spool = None
+if spool_cfg.get('enabled', True):
+    try:
+        spool = SpoolQueue(
+            spool_cfg.get('path', '/app/spool/telemetry.db'),
+            spool_publish,
+            max_bytes=spool_cfg.get('max_bytes', 64 * 1024 * 1024),
+            replay_batch_bytes=spool_cfg.get('replay_batch_bytes', 65536),
+            replay_rate=spool_cfg.get('replay_rate', 5.0),
+            replay_bandwidth=spool_cfg.get('replay_bandwidth', 0)
+        )
+        logger.info(f"Spool attivo: {spool.path} ({spool.records} record in coda)")
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Spool disabilitato: {e}")
+
 # Callback connessione MQTT
 def on_connect(client, userdata, flags, reason_code, properties=None):
     global connection_established
@@ -89,19 +740,54 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
         connection_established = True
         client.subscribe(config['mqtt']['topics']['commands'])
         logger.info(f"Sottoscritto a {config['mqtt']['topics']['commands']}")
+        if spool is not None:
+            spool.set_connected(True)
     else:
         logger.error(f"Connessione fallita, codice: {reason_code}")
 
+def on_publish(client, userdata, mid, reason_code=None, properties=None):
+    profiler.checkpoint()
+    latency = metrics.on_publish(mid)
+    if latency is not None:
+        publish_summary.latency(latency)
+
+def on_disconnect(client, userdata, flags, reason_code, properties=None):
+    global connection_established
+    connection_established = False
+    metrics.on_disconnect()
+    if spool is not None:
+        spool.set_connected(False)
+    if getattr(reason_code, "value", reason_code) != 0:
+        logger.warning(f"Disconnesso dal broker ({reason_code}), telemetria in spool")
+
 # Callback ricezione messaggi
 def on_message(client, userdata, msg):
-    global current_interval
+    profiler.checkpoint()
     logger.info(f"Comando ricevuto su {msg.topic}: {msg.payload.decode()}")
     try:
         command = json.loads(msg.payload.decode())
         if command.get('action') == 'set_interval':
-            new_interval = command['value']
-            current_interval = new_interval
-            logger.info(f"✅ Intervallo telemetria cambiato a {new_interval}s")
+            new_interval = float(command['value'])
+            if new_interval <= 0:
+                raise ValueError(f"intervallo non valido: {new_interval}")
+            # Senza `sensor` l'intervallo vale per tutti i sensori
+            target = command.get('sensor')
+            for name in ([target] if target else sensors):
+                scheduler.set_interval(new_interval, name)
+            logger.info(f"✅ Intervallo telemetria ({target or 'tutti'}) cambiato a {new_interval}s")
+        elif command.get('action') == 'profile_start':
+            profiler.start_profile(command.get('duration', 30), command.get('top', 25))
+        elif command.get('action') == 'profile_stop':
+            # Pubblica il report fuori dal thread di rete di paho
+            threading.Thread(target=profiler.stop_profile, daemon=True).start()
+        elif command.get('action') == 'tracemalloc_start':
+            profiler.start_tracemalloc(
+                command.get('duration', 60),
+                command.get('top', 25),
+                command.get('frames', 5)
+            )
+        elif command.get('action') == 'tracemalloc_stop':
+            threading.Thread(target=profiler.stop_tracemalloc, daemon=True).start()
         else:
             logger.warning(f"Azione sconosciuta: {command.get('action')}")
     except Exception as e:
@@ -113,7 +799,9 @@ client = mqtt.Client(
     client_id=config['mqtt']['client_id']
 )
 client.on_connect = on_connect
+client.on_disconnect = on_disconnect
 client.on_message = on_message
+client.on_publish = on_publish
 
 # Configura TLS se abilitato
 if config['mqtt'].get('tls', {}).get('enabled', False):
@@ -127,11 +815,17 @@ if config['mqtt'].get('tls', {}).get('enabled', False):
 
 # Connetti al broker
 logger.info(f"Connessione a {config['mqtt']['broker']}:{config['mqtt']['port']}")
-client.connect(
-    config['mqtt']['broker'],
-    config['mqtt']['port'],
-    60
-)
+try:
+    client.connect(
+        config['mqtt']['broker'],
+        config['mqtt']['port'],
+        60
+    )
+except OSError as e:
+    # Con lo spool attivo si parte comunque: il loop di paho ritenta
+    if spool is None:
+        raise
+    logger.warning(f"Broker non raggiungibile ({e}), telemetria in spool")
 client.loop_start()
 
 # Attendi connessione
@@ -141,48 +835,158 @@ for _ in range(timeout):
         break
     time.sleep(1)
 else:
-    logger.error("Timeout connessione al broker")
-    exit(1)
+    if spool is None:
+        logger.error("Timeout connessione al broker")
+        exit(1)
+    logger.warning("Timeout connessione al broker, avvio in modalità spool")
+
+def publish_batch(lines, sampled_at=None):
+    # Chiamata anche dal thread di linger del LineBatcher
+    profiler.checkpoint()
+    payload = "\n".join(lines)
+    if spool is not None and not connection_established:
+        # Non passa da paho: la sua coda in memoria si perde al restart
+        spool.append(payload)
+        logger.debug("Telemetria in spool: %d righe, %d record in coda", len(lines), spool.records)
+        return
+    # Fuori da metrics.lock: vedi GatewayMetrics.track()
+    result = publish_payload(payload)
+    if result.rc == mqtt.MQTT_ERR_SUCCESS:
+        latency = metrics.track(result.mid, sampled_at)
+        if latency is not None:
+            publish_summary.latency(latency)
+        publish_summary.record(1, len(payload))
+    else:
+        metrics.publish_error()
+        publish_summary.error()
+        logger.error(f"Errore invio telemetria: {result.rc}")
+        if spool is not None:
+            spool.append(payload)
+
+
+batch_cfg = config.get('batching') or {}
+batcher = LineBatcher(
+    publish_batch,
+    max_bytes=batch_cfg.get('max_bytes', 16384),
+    linger=batch_cfg.get('linger', 0)
+)
+
+def merge_loop():
+    """
+    Raccoglie i risultati dei collector di ogni tick e li unisce in un unico
+    batch con il timestamp del tick. Gira fuori dal loop di campionamento:
+    l'attesa di un collector lento non sposta i tick successivi.
+    """
+    device_id = config['mqtt']['client_id']
+    while True:
+        item = merge_queue.get()
+        if item is None:
+            return
+        profiler.checkpoint()
+        timestamp_ns, started, pending = item
+        lines = []
+        if pending is None:
+            # Fine finestra di aggregazione
+            for name, fields in aggregator.drain().items():
+                line = sensor_line(device_id, name, fields, timestamp_ns)
+                if line:
+                    lines.append(line)
+        for sensor in pending or ():
+            remaining = started + sensor.timeout - time.monotonic()
+            try:
+                value = sensor.future.result(timeout=max(0.0, remaining))
+            except FuturesTimeout:
+                sensor.timeouts += 1
+                logger.warning(f"Timeout sensore {sensor.name} ({sensor.timeout}s)")
+                continue
+            except Exception as e:
+                sensor.errors += 1
+                logger.error(f"Errore sensore {sensor.name}: {e}")
+                continue
+            if value is None:
+                continue
+            fields = sensor.fields(value)
+            if aggregator is not None:
+                aggregator.add(sensor.name, fields)
+                continue
+            fields = deadband.filter(sensor.name, fields)
+            if not fields:
+                continue
+            line = sensor_line(device_id, sensor.name, fields, timestamp_ns)
+            if line:
+                lines.append(line)
+        if not lines:
+            continue
+        logger.debug("Batch: %d righe", len(lines))
+        # Accoda al batch: il publish MQTT avviene a soglia byte/linger
+        batcher.add(lines, started)
+
+
+def internal_metrics_line(timestamp_ns):
+    # Coda messaggi di paho: non c'è API pubblica, lettura best-effort
+    paho_queued = len(getattr(client, '_out_messages', ()))
+    extra = {
+        'paho_queued': paho_queued,
+        'batch_buffered': batcher.buffered,
+        'merge_queue': merge_queue.qsize(),
+        'sensor_timeouts': sum(sensor.timeouts for sensor in sensors.values()),
+        'sensor_skipped': sum(sensor.skipped for sensor in sensors.values()),
+        'deadband_suppressed': deadband.suppressed,
+        'log_dropped': log_handler.dropped,
+    }
+    if spool is not None:
+        extra['spool_records'] = spool.records
+        extra['spool_bytes'] = spool.bytes
+        extra['spool_dropped'] = spool.dropped
+    return metrics.line(config['mqtt']['client_id'], timestamp_ns, scheduler.overruns, extra)
+
+
+merge_queue = queue.Queue()
+merge_thread = threading.Thread(target=merge_loop, name='merge', daemon=True)
+merge_thread.start()
+
+# Prima chiamata non bloccante: inizializza il riferimento per i delta CPU
+psutil.cpu_percent(interval=None)
 
 # Loop principale telemetria
 try:
     while True:
-        # Leggi sensori con fallback
-        try:
-            temps = psutil.sensors_temperatures()
-            if temps and 'coretemp' in temps and len(temps['coretemp']) > 0:
-                temp = temps['coretemp'][0].current
-            else:
-                temp = 20.0 + random.uniform(-2, 2)
-        except:
-            temp = 20.0 + random.uniform(-2, 2)
-        
-        cpu = psutil.cpu_percent(interval=1)
-        
-        # Costruisci payload in Line Protocol
-        timestamp_ns = int(time.time() * 1e9)
-        device_id = config['mqtt']['client_id']
-        
-        lines = [
-            f"sensors,device={device_id},sensor=temperature value={temp:.2f} {timestamp_ns}",
-            f"sensors,device={device_id},sensor=cpu_usage value={cpu:.2f} {timestamp_ns}"
-        ]
-        payload = "\n".join(lines)
-        
-        # Pubblica su MQTT
-        topic = config['mqtt']['topics']['telemetry']
-        result = client.publish(topic, payload, qos=1)
-        
-        if result.rc == mqtt.MQTT_ERR_SUCCESS:
-            logger.info(f"Telemetria inviata: temp={temp:.1f}°C, cpu={cpu:.1f}%")
-        else:
-            logger.error(f"Errore invio telemetria: {result.rc}")
-        
-        time.sleep(current_interval)
-        
+        _, due = scheduler.wait()
+        profiler.checkpoint()
+        timestamp_ns = time.time_ns()
+        started = time.monotonic()
+
+        # Campionamento concorrente: un collector lento non ritarda gli altri
+        pending = []
+        window_closed = False
+        for name in due:
+            if name == AGGREGATION_TICK:
+                window_closed = True
+                continue
+            if name == INTERNAL_TICK:
+                batcher.add([internal_metrics_line(timestamp_ns)])
+                continue
+            sensor = sensors[name]
+            if sensor.busy:
+                sensor.skipped += 1
+                logger.warning(f"Sensore {name} ancora occupato, campione saltato")
+                continue
+            sensor.future = collector_pool.submit(run_collector, sensor)
+            pending.append(sensor)
+
+        if pending:
+            merge_queue.put((timestamp_ns, started, pending))
+        if window_closed:
+            # In coda dopo i campioni del tick: chiude la finestra in ordine
+            merge_queue.put((timestamp_ns, started, None))
+
 except KeyboardInterrupt:
     logger.info("Shutdown richiesto")
 finally:
+    merge_queue.put(None)
+    merge_thread.join(timeout=5)
+    collector_pool.shutdown(wait=False)
+    batcher.stop()
     client.loop_stop()
     client.disconnect()
     logger.info("Gateway disconnesso")
@@ -0,0 +1,270 @@
+"""
+Profiling remoto del gateway via comandi MQTT.
+
+- `cProfile` per una durata limitata. Il comportamento dipende
+  dall'interprete:
+  - fino a Python 3.11 il profiler è per-thread: ogni thread che chiama
+    `checkpoint()` abilita il proprio `cProfile.Profile` e, al primo
+    `checkpoint()` dopo la fine della sessione, lo disabilita e ne
+    costruisce le statistiche nel proprio thread; `stop_profile()` attende
+    queste consegne (al più `collect_timeout` secondi), le unisce e riporta
+    in `threads_missing` i thread che non hanno risposto. In app.py sono
+    coperti il loop principale, i collector, il thread di merge, il thread
+    di rete paho (dai callback on_publish/on_message), il thread di linger
+    del LineBatcher (da publish_batch) e il replay dello spool (dalla sua
+    funzione di publish); un thread entra nel profilo solo dal primo
+    checkpoint dopo l'avvio, quindi un thread inattivo per tutta la
+    sessione non compare. Gli altri thread (timer, thread di stop) non
+    sono profilati;
+  - da Python 3.12 cProfile usa `sys.monitoring`: può essere attivo un solo
+    profiler per processo (un secondo `enable()` solleva ValueError) e vede
+    già tutti i thread. Si usa quindi un unico profiler abilitato da
+    `start_profile()` e `checkpoint()` non fa nulla.
+  Se il profiler non può essere abilitato (es. un altro strumento di
+  profiling o coverage già attivo) la sessione è marcata come fallita e il
+  report riporta l'errore, senza propagare l'eccezione ai loop.
+- `tracemalloc`: snapshot all'avvio e alla fine, differenza per sito di
+  allocazione (vale per tutti i thread).
+
+I risultati (top-N) sono JSON compresso gzip e vengono pubblicati sul topic
+di diagnostica: `mosquitto_sub -N -C 1 -t <topic> | gunzip`.
+"""
+
+import cProfile
+import gzip
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+# Da Python 3.12 un solo profiler cProfile per processo, su tutti i thread
+PROCESS_WIDE_PROFILER = sys.version_info >= (3, 12)
+
+
+class RemoteProfiler:
+    def __init__(self, publish_fn, device_id, max_duration=300.0, collect_timeout=15.0):
+        self.publish_fn = publish_fn
+        self.device_id = device_id
+        self.max_duration = float(max_duration)
+        self.collect_timeout = float(collect_timeout)
+        self._lock = threading.Lock()
+        self._collected_cond = threading.Condition(self._lock)
+        self._profile_until = None
+        self._profile_started = None
+        self._profile_top = 25
+        self._profiles = []
+        self._threads = []
+        self._collected = []
+        self._collecting = False
+        self._profile_error = None
+        self._session = 0
+        self._local = threading.local()
+        self._profile_timer = None
+        self._alloc_baseline = None
+        self._alloc_started = None
+        self._alloc_top = 25
+        self._alloc_timer = None
+
+    def _bounded(self, duration):
+        return max(1.0, min(float(duration), self.max_duration))
+
+    # --- cProfile ---
+
+    def start_profile(self, duration=30, top=25):
+        duration = self._bounded(duration)
+        with self._lock:
+            if self._profile_until is not None or self._collecting:
+                raise RuntimeError("profiling già in corso")
+            self._session += 1
+            self._profiles = []
+            self._threads = []
+            self._collected = []
+            self._collecting = True
+            self._profile_error = None
+            if PROCESS_WIDE_PROFILER:
+                profile = cProfile.Profile()
+                try:
+                    profile.enable()
+                except ValueError as e:
+                    self._collecting = False
+                    raise RuntimeError(f"profiler non disponibile: {e}") from e
+                self._profiles.append(profile)
+            self._profile_top = int(top)
+            self._profile_started = time.monotonic()
+            self._profile_until = self._profile_started + duration
+            self._profile_timer = threading.Timer(duration, self.stop_profile)
+            self._profile_timer.daemon = True
+            self._profile_timer.start()
+        logger.info(f"Profiling cProfile avviato per {duration:.0f}s")
+
+    def checkpoint(self):
+        """Abilita/disabilita il profiler nel thread corrente (chiamata a ogni iterazione)."""
+        if PROCESS_WIDE_PROFILER:
+            return
+        session, profile = getattr(self._local, 'profile', (None, None))
+        until = self._profile_until
+        active = until is not None and time.monotonic() < until
+        if active and session == self._session:
+            return
+        if profile is not None:
+            # Fine sessione (o sessione nuova): il thread chiude il proprio
+            # profiler e ne costruisce le statistiche, che stop_profile() unisce
+            self._local.profile = (None, None)
+            self._hand_in(session, profile)
+        if not active:
+            return
+        profile = cProfile.Profile()
+        with self._lock:
+            if self._profile_until is None:
+                return
+            session = self._session
+            self._profiles.append(profile)
+            self._threads.append(threading.current_thread().name)
+            self._local.profile = (session, profile)
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Altro profiler attivo: sessione fallita, il loop continua
+            with self._lock:
+                if self._session == session and profile in self._profiles:
+                    index = self._profiles.index(profile)
+                    del self._profiles[index]
+                    del self._threads[index]
+                    if self._profile_error is None:
+                        self._profile_error = str(e)
+                    self._collected_cond.notify_all()
+            self._local.profile = (session, None)
+            logger.error(f"Profiling non disponibile in questo thread: {e}")
+
+    def _hand_in(self, session, profile):
+        profile.disable()
+        stats = pstats.Stats(profile)
+        with self._lock:
+            # Statistiche di una sessione già chiusa (thread arrivato dopo il
+            # timeout di stop_profile): scartate
+            if session == self._session and self._collecting:
+                self._collected.append((threading.current_thread().name, stats))
+                self._collected_cond.notify_all()
+
+    def stop_profile(self):
+        with self._lock:
+            if self._profile_until is None:
+                return
+            if self._profile_timer is not None:
+                self._profile_timer.cancel()
+            elapsed = time.monotonic() - self._profile_started
+            self._profile_until = None
+        if PROCESS_WIDE_PROFILER:
+            with self._lock:
+                profiles = self._profiles
+                for profile in profiles:
+                    profile.disable()
+                collected = [(None, pstats.Stats(profile)) for profile in profiles]
+                threads = [thread.name for thread in threading.enumerate()]
+                missing = []
+                error = self._profile_error
+                self._collecting = False
+        else:
+            # Ogni thread consegna le proprie statistiche al suo prossimo
+            # checkpoint(): i thread fermi oltre collect_timeout sono esclusi
+            # e riportati in `threads_missing`
+            with self._collected_cond:
+                self._collected_cond.wait_for(
+                    lambda: len(self._collected) >= len(self._profiles), self.collect_timeout
+                )
+                collected = self._collected
+                threads = [name for name, _ in collected]
+                missing = list(self._threads)
+                for name in threads:
+                    missing.remove(name)
+                error = self._profile_error
+                self._collecting = False
+                self._collected = []
+                self._profiles = []
+        stats = None
+        for _, thread_stats in collected:
+            if stats is None:
+                stats = thread_stats
+            else:
+                stats.add(thread_stats)
+        rows = []
+        if stats is not None:
+            entries = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+            for (filename, line, func), (cc, nc, tt, ct, _) in entries[:self._profile_top]:
+                rows.append({
+                    'function': f"{filename}:{line}({func})",
+                    'calls': nc,
+                    'primitive_calls': cc,
+                    'tottime': round(tt, 6),
+                    'cumtime': round(ct, 6),
+                })
+        body = {'threads': sorted(threads), 'top': rows}
+        if missing:
+            body['threads_missing'] = sorted(missing)
+            logger.warning(f"Profiling: statistiche mancanti per i thread {', '.join(sorted(missing))}")
+        if error is not None:
+            body['error'] = error
+        self._publish('cprofile', elapsed, body)
+
+    # --- tracemalloc ---
+
+    def start_tracemalloc(self, duration=60, top=25, frames=5):
+        duration = self._bounded(duration)
+        with self._lock:
+            if self._alloc_baseline is not None:
+                raise RuntimeError("tracemalloc già in corso")
+            tracemalloc.start(int(frames))
+            self._alloc_baseline = tracemalloc.take_snapshot()
+            self._alloc_started = time.monotonic()
+            self._alloc_top = int(top)
+            self._alloc_timer = threading.Timer(duration, self.stop_tracemalloc)
+            self._alloc_timer.daemon = True
+            self._alloc_timer.start()
+        logger.info(f"tracemalloc avviato per {duration:.0f}s")
+
+    def stop_tracemalloc(self):
+        with self._lock:
+            if self._alloc_baseline is None:
+                return
+            if self._alloc_timer is not None:
+                self._alloc_timer.cancel()
+            baseline = self._alloc_baseline
+            elapsed = time.monotonic() - self._alloc_started
+            self._alloc_baseline = None
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        snapshot = snapshot.filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        rows = []
+        for stat in snapshot.compare_to(baseline, 'traceback')[:self._alloc_top]:
+            rows.append({
+                'traceback': [f"{frame.filename}:{frame.lineno}" for frame in stat.traceback],
+                'size': stat.size,
+                'size_diff': stat.size_diff,
+                'count': stat.count,
+                'count_diff': stat.count_diff,
+            })
+        self._publish('tracemalloc', elapsed, {'traced_current': current, 'traced_peak': peak, 'top': rows})
+
+    def _publish(self, kind, elapsed, body):
+        report = {
+            'device': self.device_id,
+            'kind': kind,
+            'duration': round(elapsed, 3),
+            'timestamp': time.time(),
+        }
+        report.update(body)
+        payload = gzip.compress(json.dumps(report).encode('utf-8'))
+        try:
+            self.publish_fn(payload)
+            logger.info(f"Report {kind} pubblicato ({len(payload)} byte compressi)")
+        except Exception as e:
+            logger.error(f"Errore pubblicazione report {kind}: {e}")
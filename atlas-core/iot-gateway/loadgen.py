@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Load generator multi-device per il gateway IoT.
+
+Simula N dispositivi virtuali (da centinaia a decine di migliaia) in un solo
+processo: ogni device ha il proprio tag `device=`, la propria cadenza e un
+jitter per tick, e pubblica line protocol su `devices/<device>/telemetry`.
+I device sono coroutine asyncio multiplexate su `connections` client paho
+integrati nello stesso event loop (nessun thread di rete per client).
+
+Ogni `report_interval` secondi vengono loggati rate di publish/PUBACK,
+percentili di latenza PUBACK ed errori: servono a dimensionare Mosquitto e la
+pipeline Telegraf/InfluxDB dell'edge-hub prima di aggiungere dispositivi.
+
+Una connessione persa (o non stabilita entro il timeout iniziale) viene
+ritentata con backoff esponenziale; nel frattempo i tick dei suoi device
+sono contati come `skipped` e restano fuori da rate e latenze, così i
+numeri descrivono solo il carico effettivamente inviato.
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+import paho.mqtt.client as mqtt
+
+import line_protocol
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncioHelper:
+    """Aggancia il socket di un client paho all'event loop asyncio."""
+
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, client.loop_read)
+        self.misc = self.loop.create_task(self.misc_loop())
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self.misc is not None:
+            self.misc.cancel()
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    async def misc_loop(self):
+        # Keepalive e retry QoS: quello che farebbe loop_forever()
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                break
+
+
+class LoadStats:
+    """Contatori e latenze PUBACK della finestra di report corrente."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.window_start = self.started
+        self.published = 0
+        self.acked = 0
+        self.errors = 0
+        self.skipped = 0
+        self.disconnects = 0
+        self.reconnects = 0
+        self.connect_failures = 0
+        self.total_published = 0
+        self.total_acked = 0
+        self.total_errors = 0
+        self.total_skipped = 0
+        self.latencies = []
+
+    def snapshot(self):
+        now = time.monotonic()
+        elapsed = max(now - self.window_start, 1e-9)
+        latencies = sorted(self.latencies)
+        report = {
+            'elapsed': elapsed,
+            'publish_rate': self.published / elapsed,
+            'ack_rate': self.acked / elapsed,
+            'errors': self.errors,
+            'skipped': self.skipped,
+            'p50': _percentile(latencies, 50),
+            'p95': _percentile(latencies, 95),
+            'p99': _percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        }
+        self.window_start = now
+        self.published = 0
+        self.acked = 0
+        self.errors = 0
+        self.skipped = 0
+        self.latencies = []
+        return report
+
+
+def _percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def _fmt_ms(value):
+    return "n/a" if value is None else f"{value * 1000:.1f}ms"
+
+
+class LoadConnection:
+    """Un client MQTT condiviso da un sottoinsieme di device virtuali."""
+
+    RECONNECT_MIN = 1.0
+    RECONNECT_MAX = 30.0
+
+    def __init__(self, loop, config, index, stats):
+        self.loop = loop
+        self.stats = stats
+        self.connected = asyncio.Event()
+        self._pending = {}
+        self._closing = False
+        self._reconnect_task = None
+        self._delay = self.RECONNECT_MIN
+        self.client_id = f"{config['mqtt']['client_id']}-lg{index}"
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, client_id=self.client_id)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_publish = self.on_publish
+        # Il limite di inflight lo impone il broker: niente coda lato client
+        self.client.max_inflight_messages_set(0)
+        tls_config = config['mqtt'].get('tls', {})
+        if tls_config.get('enabled', False):
+            self.client.tls_set(
+                ca_certs=tls_config['ca_cert'],
+                certfile=tls_config.get('certfile'),
+                keyfile=tls_config.get('keyfile')
+            )
+        AsyncioHelper(loop, self.client)
+
+    @property
+    def inflight(self):
+        return len(self._pending)
+
+    def connect(self, host, port):
+        try:
+            self.client.connect(host, port, 60)
+        except OSError as e:
+            self.stats.connect_failures += 1
+            logger.error(f"Connessione {self.client_id} fallita: {e}")
+            self.schedule_reconnect()
+
+    def close(self):
+        self._closing = True
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+        self.client.disconnect()
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        if getattr(reason_code, "value", reason_code) == 0:
+            self._delay = self.RECONNECT_MIN
+            self.connected.set()
+        else:
+            self.stats.connect_failures += 1
+            logger.error(f"Connessione {self.client_id} rifiutata: {reason_code}")
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties=None):
+        self.connected.clear()
+        # I messaggi in volo non riceveranno mai PUBACK su questa sessione
+        self.stats.errors += len(self._pending)
+        self.stats.total_errors += len(self._pending)
+        self._pending.clear()
+        if self._closing:
+            return
+        self.stats.disconnects += 1
+        logger.warning(f"Connessione {self.client_id} persa: {reason_code}")
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self._closing or (self._reconnect_task is not None and not self._reconnect_task.done()):
+            return
+        self._reconnect_task = self.loop.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        # Backoff esponenziale con jitter: le connessioni non ritornano in blocco
+        while not self._closing and not self.connected.is_set():
+            await asyncio.sleep(self._delay * random.uniform(0.5, 1.0))
+            self._delay = min(self._delay * 2, self.RECONNECT_MAX)
+            try:
+                self.client.reconnect()
+            except OSError as e:
+                self.stats.connect_failures += 1
+                logger.warning(f"Riconnessione {self.client_id} fallita: {e}")
+                continue
+            self.stats.reconnects += 1
+            try:
+                await asyncio.wait_for(self.connected.wait(), timeout=self.RECONNECT_MAX)
+            except asyncio.TimeoutError:
+                self.stats.connect_failures += 1
+
+    def on_publish(self, client, userdata, mid, reason_code=None, properties=None):
+        sent_at = self._pending.pop(mid, None)
+        if sent_at is None:
+            return
+        self.stats.acked += 1
+        self.stats.total_acked += 1
+        self.stats.latencies.append(time.monotonic() - sent_at)
+
+    def publish(self, topic, payload, qos):
+        if not self.connected.is_set():
+            # Connessione giù: il tick non è carico inviato, fuori dalle rate
+            self.stats.skipped += 1
+            self.stats.total_skipped += 1
+            return
+        info = self.client.publish(topic, payload, qos=qos)
+        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+            self.stats.errors += 1
+            self.stats.total_errors += 1
+            return
+        self.stats.published += 1
+        self.stats.total_published += 1
+        if qos > 0:
+            self._pending[info.mid] = time.monotonic()
+        else:
+            self.stats.acked += 1
+            self.stats.total_acked += 1
+
+
+async def _device_loop(conn, device_id, topic, interval, jitter, qos):
+    """Cadenza a deadline fisse con jitter per tick, come il loop del gateway."""
+    temp = 20.0 + random.uniform(-2, 2)
+    # Prefissi della serie calcolati una volta per device, non ad ogni tick
+    temp_series = line_protocol.prefix('sensors', {'device': device_id, 'sensor': 'temperature'})
+    cpu_series = line_protocol.prefix('sensors', {'device': device_id, 'sensor': 'cpu_usage'})
+    # Fase casuale: i device non devono pubblicare tutti nello stesso istante
+    deadline = time.monotonic() + random.uniform(0, interval)
+    while True:
+        delay = deadline + random.uniform(-jitter, jitter) * interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        deadline += interval
+        temp += random.uniform(-0.2, 0.2)
+        timestamp_ns = time.time_ns()
+        payload = (
+            f"{temp_series} value={temp:.2f} {timestamp_ns}\n"
+            f"{cpu_series} value={random.uniform(0, 100):.2f} {timestamp_ns}"
+        )
+        conn.publish(topic, payload, qos)
+
+
+async def _report_loop(stats, connections, report_interval):
+    while True:
+        await asyncio.sleep(report_interval)
+        report = stats.snapshot()
+        inflight = sum(c.inflight for c in connections)
+        logger.info(
+            f"Loadgen: publish {report['publish_rate']:.1f}/s, "
+            f"PUBACK {report['ack_rate']:.1f}/s, "
+            f"latenza p50={_fmt_ms(report['p50'])} p95={_fmt_ms(report['p95'])} "
+            f"p99={_fmt_ms(report['p99'])} max={_fmt_ms(report['max'])}, "
+            f"errori {report['errors']}, saltati {report['skipped']}, inflight {inflight}, "
+            f"connesse {sum(c.connected.is_set() for c in connections)}/{len(connections)}"
+        )
+
+
+async def _run(config, lg_config):
+    loop = asyncio.get_running_loop()
+    stats = LoadStats()
+
+    devices = int(lg_config.get('devices', 100))
+    n_conn = max(1, min(int(lg_config.get('connections', 1)), devices))
+    interval = float(lg_config.get('interval', 5))
+    spread = float(lg_config.get('interval_spread', 0.0))
+    jitter = float(lg_config.get('jitter', 0.05))
+    qos = int(lg_config.get('qos', 1))
+    duration = float(lg_config.get('duration', 0))
+    report_interval = float(lg_config.get('report_interval', 10))
+    prefix = lg_config.get('device_prefix', 'loadgen-')
+    topic_template = lg_config.get('topic_template', 'devices/{device}/telemetry')
+
+    connections = []
+    tasks = []
+    try:
+        for index in range(n_conn):
+            conn = LoadConnection(loop, config, index, stats)
+            connections.append(conn)
+            conn.connect(config['mqtt']['broker'], config['mqtt']['port'])
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(c.connected.wait() for c in connections)), timeout=30
+            )
+        except asyncio.TimeoutError:
+            up = sum(c.connected.is_set() for c in connections)
+            logger.error(f"Loadgen: {up}/{n_conn} connessioni stabilite entro 30s")
+            if not up:
+                return
+            # Le altre continuano a ritentare; i loro device intanto sono `skipped`
+            for conn in connections:
+                if not conn.connected.is_set():
+                    conn.schedule_reconnect()
+        logger.info(
+            f"Loadgen: {devices} device su {n_conn} connessioni, "
+            f"intervallo {interval}s (spread {spread:.0%}, jitter {jitter:.0%}), QoS {qos}"
+        )
+
+        for index in range(devices):
+            device_id = f"{prefix}{index:05d}"
+            device_interval = interval * random.uniform(1 - spread, 1 + spread)
+            tasks.append(asyncio.create_task(_device_loop(
+                connections[index % n_conn],
+                device_id,
+                topic_template.format(device=device_id),
+                device_interval,
+                jitter,
+                qos
+            )))
+        tasks.append(asyncio.create_task(_report_loop(stats, connections, report_interval)))
+
+        if duration > 0:
+            await asyncio.sleep(duration)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if tasks:
+            # Lascia arrivare gli ultimi PUBACK prima di chiudere
+            await asyncio.sleep(min(2.0, report_interval))
+        for conn in connections:
+            conn.close()
+        elapsed = time.monotonic() - stats.started
+        lost = stats.total_published - stats.total_acked
+        logger.info(
+            f"Loadgen terminato in {elapsed:.0f}s: pubblicati {stats.total_published}, "
+            f"confermati {stats.total_acked}, senza PUBACK {lost}, "
+            f"errori {stats.total_errors}, saltati (connessione giù) {stats.total_skipped}, "
+            f"disconnessioni {stats.disconnects}, riconnessioni {stats.reconnects}, "
+            f"connessioni fallite {stats.connect_failures}"
+        )
+
+
+def run_loadgen(config):
+    """Esegue il load generator con la sezione `loadgen` di gateway.yaml."""
+    try:
+        asyncio.run(_run(config, config.get('loadgen') or {}))
+    except KeyboardInterrupt:
+        logger.info("Loadgen interrotto")
+    return 0
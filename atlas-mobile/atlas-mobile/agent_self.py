@@ -0,0 +1,172 @@
+"""
+Costo del client di telemetria su se stesso (`atlas_agent_self`).
+
+`AgentSelfMonitor` misura, tra due chiamate a `sample()`:
+- CPU user/sys del processo e dei figli già terminati (`os.times`), e la
+  percentuale sul tempo trascorso;
+- RSS attuale da `/proc/self/statm` (fd tenuto aperto, letto con pread;
+  ripiego su `ru_maxrss`, cioè il picco);
+- processi figli avviati, contati con un audit hook su `subprocess.Popen`,
+  `os.system` e `os.posix_spawn`: nessuna modifica ai punti di chiamata;
+- byte pubblicati (`record_published()`) e durata per collector
+  (`record_collector()`).
+
+Budget: con `cpu_percent` e/o `rss_mb` configurati, la CPU media su
+`window` secondi e l'RSS attuale vengono confrontati con i limiti. Oltre
+il budget `factor` cresce (x1.5 per passo, al massimo ogni `window / 6`
+secondi, fino a `max_factor`); sotto l'80% del budget scende di nuovo.
+Chi usa il monitor applica `factor` (intervallo più lungo, collector
+costosi spenti).
+
+La CPU spesa da Termux:API vive nel processo dell'app Android e non è
+inclusa: `spawned` resta l'indicatore del suo costo.
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+from collections import deque
+
+_SPAWN_EVENTS = frozenset(("subprocess.Popen", "os.system", "os.posix_spawn", "os.spawn"))
+_spawned = 0
+_hook_installed = False
+
+
+def _audit_hook(event, args):
+    global _spawned
+    if event in _SPAWN_EVENTS:
+        # Incremento non atomico: al peggio si perde un conteggio
+        _spawned += 1
+
+
+def install_spawn_counter():
+    """Installa (una volta sola) l'audit hook che conta i processi figli."""
+    global _hook_installed
+    if not _hook_installed:
+        sys.addaudithook(_audit_hook)
+        _hook_installed = True
+
+
+def spawned_processes():
+    return _spawned
+
+
+class AgentSelfMonitor:
+    STEP = 1.5
+
+    def __init__(self, budget=None, max_factor=8.0, clock=time.monotonic):
+        budget = budget or {}
+        self.max_cpu_percent = float(budget.get("cpu_percent") or 0)
+        self.max_rss = float(budget.get("rss_mb") or 0) * 1024 * 1024
+        self.window = float(budget.get("window") or 300)
+        self.max_factor = float(max_factor)
+        self.clock = clock
+        self.factor = 1.0
+        self.over_budget = False
+        self.published_bytes = 0
+        self._lock = threading.Lock()
+        self._collector_seconds = {}
+        self._collector_runs = {}
+        # (istante, secondi CPU cumulativi) per la media sulla finestra
+        self._samples = deque()
+        self._adjusted_at = None
+        self._prev = None
+        self._page_size = os.sysconf("SC_PAGE_SIZE")
+        try:
+            self._statm = os.open("/proc/self/statm", os.O_RDONLY)
+        except OSError:
+            self._statm = None
+        install_spawn_counter()
+
+    def close(self):
+        if self._statm is not None:
+            try:
+                os.close(self._statm)
+            except OSError:
+                pass
+            self._statm = None
+
+    def record_published(self, nbytes):
+        with self._lock:
+            self.published_bytes += nbytes
+
+    def record_collector(self, name, seconds):
+        with self._lock:
+            self._collector_seconds[name] = self._collector_seconds.get(name, 0.0) + seconds
+            self._collector_runs[name] = self._collector_runs.get(name, 0) + 1
+
+    def rss(self):
+        """RSS in byte (attuale da statm, altrimenti picco da getrusage)."""
+        if self._statm is not None:
+            try:
+                return int(os.pread(self._statm, 128, 0).split()[1]) * self._page_size
+            except (OSError, ValueError, IndexError):
+                self.close()
+        # ru_maxrss è in KiB su Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _update_budget(self, now, cpu_seconds, rss):
+        if self.max_cpu_percent <= 0 and self.max_rss <= 0:
+            return
+        self._samples.append((now, cpu_seconds))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+        first_at, first_cpu = self._samples[0]
+        elapsed = now - first_at
+        ratio = rss / self.max_rss if self.max_rss > 0 else 0.0
+        # La CPU conta solo con almeno un sesto di finestra di storia
+        if self.max_cpu_percent > 0 and elapsed >= self.window / 6:
+            cpu_percent = (cpu_seconds - first_cpu) / elapsed * 100.0
+            ratio = max(ratio, cpu_percent / self.max_cpu_percent)
+        self.over_budget = ratio > 1.0
+        if self._adjusted_at is not None and now - self._adjusted_at < self.window / 6:
+            return
+        if ratio > 1.0:
+            factor = min(self.factor * self.STEP, self.max_factor)
+        elif ratio < 0.8:
+            factor = max(1.0, self.factor / self.STEP)
+        else:
+            return
+        if factor != self.factor:
+            self.factor = factor
+            self._adjusted_at = now
+
+    def sample(self):
+        """Campi di `atlas_agent_self` dall'ultima chiamata; aggiorna `factor`."""
+        now = self.clock()
+        times = os.times()
+        rss = self.rss()
+        cpu_seconds = times.user + times.system + times.children_user + times.children_system
+        self._update_budget(now, cpu_seconds, rss)
+
+        with self._lock:
+            fields = {
+                "rss_bytes": rss,
+                "spawned": _spawned,
+                "published_bytes": self.published_bytes,
+            }
+            collectors = self._collector_seconds
+            runs = self._collector_runs
+            self._collector_seconds = {}
+            self._collector_runs = {}
+        for name, seconds in collectors.items():
+            fields[f"{name}_ms"] = seconds / runs[name] * 1000
+
+        previous, self._prev = self._prev, (now, times)
+        if previous is not None and now > previous[0]:
+            before = previous[1]
+            elapsed = now - previous[0]
+            user = times.user - before.user
+            system = times.system - before.system
+            children = (times.children_user - before.children_user) + (
+                times.children_system - before.children_system
+            )
+            fields["cpu_user_ms"] = user * 1000
+            fields["cpu_sys_ms"] = system * 1000
+            fields["children_cpu_ms"] = children * 1000
+            fields["cpu_percent"] = (user + system + children) / elapsed * 100.0
+        fields["budget_factor"] = self.factor
+        fields["over_budget"] = self.over_budget
+        return fields
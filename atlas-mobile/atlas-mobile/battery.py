@@ -0,0 +1,224 @@
+"""
+Provider dello stato batteria per mobile_sensors.py.
+
+`termux-battery-status` passa dall'app Termux:API (fork + binder + JVM): è la
+lettura più lenta e più costosa in energia del loop di telemetria. Il
+provider usa, in ordine:
+
+- `sysfs`: lettura diretta di `/sys/class/power_supply/<battery>/`
+  (capacity, temp, status, health, current_now) quando è leggibile. Su molti
+  Android SELinux la nega alle app: viene provata una volta all'avvio.
+- `termux`: `termux-battery-status` eseguito da un thread in background ogni
+  `cache_ttl` secondi. `read()` restituisce sempre l'ultimo valore in cache e
+  non blocca mai il loop; oltre `max_age` secondi il valore è considerato
+  scaduto e `read()` restituisce None.
+
+Il dict restituito ha le stesse chiavi di termux-battery-status
+(percentage, temperature, status, health, plugged, current).
+
+`stats()` espone il tempo risparmiato rispetto a una chiamata sincrona a
+termux-battery-status per ciclo, stimato dalla durata media (EWMA) delle
+chiamate reali al comando.
+"""
+
+import glob
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+POWER_SUPPLY_DIR = "/sys/class/power_supply"
+# Stima usata finché non c'è almeno una chiamata reale misurata
+DEFAULT_TERMUX_LATENCY = 1.0
+
+
+def termux_battery_status(timeout=5.0, retries=2):
+    """Legge stato batteria via termux-battery-status con retry"""
+    for attempt in range(retries):
+        try:
+            result = subprocess.run(
+                ["termux-battery-status"],
+                capture_output=True,
+                text=True,
+                timeout=timeout,
+            )
+            if result.returncode == 0 and result.stdout.strip():
+                return json.loads(result.stdout)
+        except subprocess.TimeoutExpired:
+            logger.warning(f"Timeout batteria (tentativo {attempt+1}/{retries})")
+            time.sleep(0.5)
+        except Exception as e:
+            logger.error(f"Errore batteria: {e}")
+            time.sleep(0.5)
+    return None
+
+
+def _read_sysfs(path):
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def find_sysfs_battery(base=POWER_SUPPLY_DIR):
+    """Directory della batteria in power_supply (type=Battery), o None."""
+    for path in sorted(glob.glob(os.path.join(base, "*"))):
+        try:
+            if _read_sysfs(os.path.join(path, "type")) == "Battery":
+                return path
+        except OSError:
+            continue
+    return None
+
+
+class BatteryProvider:
+    def __init__(self, source="auto", cache_ttl=60.0, max_age=300.0, timeout=5.0,
+                 base=POWER_SUPPLY_DIR, clock=time.monotonic):
+        self.cache_ttl = float(cache_ttl)
+        self.max_age = float(max_age)
+        self.timeout = float(timeout)
+        self.base = base
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._cached = None
+        self._cached_at = None
+        self._stop = threading.Event()
+        self._thread = None
+        self.reads = 0
+        self.read_seconds = 0.0
+        self.saved_seconds = 0.0
+        self.termux_calls = 0
+        self.termux_errors = 0
+        self.termux_latency = None
+        self.sysfs_path = None
+        self.source = self._select(source)
+
+    def _select(self, source):
+        if source in ("auto", "sysfs"):
+            path = find_sysfs_battery(self.base)
+            if path is not None:
+                self.sysfs_path = path
+                try:
+                    self._read_from_sysfs()
+                    logger.info(f"Batteria: lettura diretta da {path}")
+                    return "sysfs"
+                except (OSError, ValueError) as e:
+                    logger.info(f"Batteria: {path} non leggibile ({e}), uso termux-battery-status")
+                self.sysfs_path = None
+            elif source == "sysfs":
+                logger.warning("Batteria: nessuna batteria in sysfs, uso termux-battery-status")
+        if shutil.which("termux-battery-status") is None:
+            logger.warning("Batteria: termux-battery-status non trovato, nessuna lettura")
+            return "none"
+        return "termux"
+
+    def start(self):
+        """Avvia il refresher (modalità termux) o la misura di riferimento (sysfs)."""
+        if self.source == "termux":
+            target = self._refresh_loop
+        elif self.source == "sysfs" and shutil.which("termux-battery-status") is not None:
+            # Una sola chiamata per stimare quanto costerebbe il comando
+            target = self._refresh_once
+        else:
+            return
+        self._thread = threading.Thread(target=target, name="battery-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _read_from_sysfs(self):
+        path = self.sysfs_path
+        capacity = _read_sysfs(os.path.join(path, "capacity"))
+        status = {
+            "percentage": int(capacity),
+            "status": _read_sysfs(os.path.join(path, "status")).upper().replace(" ", "_"),
+        }
+        for name, key, scale in (("temp", "temperature", 10.0), ("current_now", "current", 1.0)):
+            try:
+                status[key] = int(_read_sysfs(os.path.join(path, name))) / scale
+            except (OSError, ValueError):
+                pass
+        try:
+            status["health"] = _read_sysfs(os.path.join(path, "health")).upper().replace(" ", "_")
+        except OSError:
+            pass
+        status["plugged"] = self._plugged()
+        return status
+
+    def _plugged(self):
+        for path in glob.glob(os.path.join(self.base, "*", "online")):
+            try:
+                if _read_sysfs(path) == "1":
+                    kind = os.path.basename(os.path.dirname(path)).upper()
+                    return f"PLUGGED_{kind}"
+            except OSError:
+                continue
+        return "UNPLUGGED"
+
+    def _call_termux(self):
+        started = self.clock()
+        result = termux_battery_status(self.timeout)
+        elapsed = self.clock() - started
+        with self._lock:
+            self.termux_calls += 1
+            if result is None:
+                self.termux_errors += 1
+            else:
+                # EWMA: una chiamata lenta isolata non falsa la stima
+                if self.termux_latency is None:
+                    self.termux_latency = elapsed
+                else:
+                    self.termux_latency += 0.2 * (elapsed - self.termux_latency)
+                self._cached = result
+                self._cached_at = self.clock()
+        return result
+
+    def _refresh_once(self):
+        self._call_termux()
+
+    def _refresh_loop(self):
+        while not self._stop.is_set():
+            self._call_termux()
+            self._stop.wait(self.cache_ttl)
+
+    def read(self):
+        """Ultimo stato batteria noto; non blocca mai più di una lettura sysfs."""
+        started = self.clock()
+        if self.source == "sysfs":
+            try:
+                status = self._read_from_sysfs()
+            except (OSError, ValueError) as e:
+                logger.warning(f"Errore lettura batteria sysfs: {e}")
+                status = None
+        else:
+            with self._lock:
+                status = self._cached
+                if status is not None and started - self._cached_at > self.max_age:
+                    status = None
+        elapsed = self.clock() - started
+        with self._lock:
+            self.reads += 1
+            self.read_seconds += elapsed
+            if self.source != "none":
+                baseline = self.termux_latency if self.termux_latency is not None else DEFAULT_TERMUX_LATENCY
+                self.saved_seconds += max(0.0, baseline - elapsed)
+        return status
+
+    def stats(self):
+        with self._lock:
+            fields = {
+                "reads": self.reads,
+                "read_ms": self.read_seconds / self.reads * 1000 if self.reads else 0.0,
+                "saved_ms": self.saved_seconds * 1000,
+                "termux_calls": self.termux_calls,
+                "termux_errors": self.termux_errors,
+            }
+            if self.termux_latency is not None:
+                fields["termux_ms"] = self.termux_latency * 1000
+            if self._cached_at is not None and self.source == "termux":
+                fields["cache_age_s"] = self.clock() - self._cached_at
+        return fields
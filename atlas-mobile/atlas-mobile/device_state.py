@@ -0,0 +1,142 @@
+"""
+Device status table for watcher.py, persisted across restarts.
+
+`DeviceStateTable` keeps one compact entry per device: status, since
+(epoch seconds of the last transition) and flap count. `update()` returns
+True only for a real transition, so retained messages replayed on every
+reconnect and repeated identical states are ignored.
+
+The table is written to a JSON snapshot (temporary file + rename) every
+`snapshot_interval` seconds when it changed, and on `stop()`; it is loaded
+back at start, so a restarted watcher does not alert for the whole fleet
+again. Counts by status are maintained on every transition: `summary()`
+does not scan the table.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+
+
+class DeviceStateTable:
+    def __init__(self, path=None, snapshot_interval=60.0, clock=time.time):
+        self.path = path
+        self.snapshot_interval = float(snapshot_interval)
+        self.clock = clock
+        self._lock = threading.Lock()
+        # device -> [status, since, flaps]
+        self._devices = {}
+        self._counts = {}
+        self._dirty = False
+        self._stop = threading.Event()
+        self._thread = None
+        if path:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.error(f"Ignoring device state snapshot {self.path}: {e}")
+            return
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            logger.warning(f"Ignoring device state snapshot {self.path}: unknown version")
+            return
+        with self._lock:
+            self._devices = {}
+            self._counts = {}
+            for device, (status, since, flaps) in (snapshot.get("devices") or {}).items():
+                self._devices[device] = [status, float(since), int(flaps)]
+                self._counts[status] = self._counts.get(status, 0) + 1
+        logger.info(f"Loaded state of {len(self._devices)} devices from {self.path}")
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = {"version": SNAPSHOT_VERSION, "devices": dict(self._devices)}
+            payload = json.dumps(snapshot, separators=(",", ":"))
+            self._dirty = False
+        tmp_path = f"{self.path}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w") as f:
+                f.write(payload)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            with self._lock:
+                self._dirty = True
+            logger.error(f"Failed to write device state snapshot: {e}")
+
+    def start(self):
+        if not self.path or self.snapshot_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="state-snapshot", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.save()
+
+    def _run(self):
+        while not self._stop.wait(self.snapshot_interval):
+            self.save()
+
+    def status(self, device):
+        entry = self._devices.get(device)
+        return entry[0] if entry is not None else None
+
+    def __contains__(self, device):
+        return device in self._devices
+
+    def update(self, device, status):
+        """Record `status` for `device`; True only if it is a transition."""
+        with self._lock:
+            entry = self._devices.get(device)
+            if entry is not None and entry[0] == status:
+                return False
+            if entry is None:
+                entry = self._devices[device] = [status, self.clock(), 0]
+            else:
+                self._counts[entry[0]] -= 1
+                entry[0] = status
+                entry[1] = self.clock()
+            self._counts[status] = self._counts.get(status, 0) + 1
+            self._dirty = True
+            return True
+
+    def flap(self, device):
+        with self._lock:
+            entry = self._devices.get(device)
+            if entry is not None:
+                entry[2] += 1
+                self._dirty = True
+
+    def get(self, device):
+        """{"status", "since", "flaps"} for `device`, or None."""
+        with self._lock:
+            entry = self._devices.get(device)
+            if entry is None:
+                return None
+            status, since, flaps = entry
+        return {"status": status, "since": since, "flaps": flaps}
+
+    def devices(self, status):
+        with self._lock:
+            return [device for device, entry in self._devices.items() if entry[0] == status]
+
+    def summary(self):
+        """Device counts by status (kept up to date on each transition)."""
+        with self._lock:
+            return {status: count for status, count in self._counts.items() if count}
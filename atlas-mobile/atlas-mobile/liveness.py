@@ -0,0 +1,200 @@
+"""
+Telemetry-silence detection for watcher.py.
+
+A device that hangs (or loses its network without the broker noticing)
+never sends its last will, so `devices/<id>/status` stays "online". The
+`SilenceDetector` records the last-seen time of every device from its
+telemetry/sensor traffic and flags it offline when it stays silent longer
+than `multiplier` times its usual gap between messages (EWMA, clamped to
+[`min_timeout`, `max_timeout`]); the next message flags it online again and
+resets the gap to the one just observed, so a device that moved to a
+slower cadence transitions once instead of flapping on every cycle.
+
+Deadlines live in a hashed `TimerWheel`: one slot per `tick` seconds, no
+per-device timer. A message only updates the device's last-seen time
+(O(1)); the wheel entry is checked lazily when its slot comes round and
+moved to the slot of the new deadline if the device was heard from in the
+meantime. Each device is in the wheel at most once, so the work per tick
+is proportional to the deadlines falling in that slot, not to the fleet.
+"""
+
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TimerWheel:
+    """Hashed timing wheel of keys; `advance()` returns the keys whose slot passed."""
+
+    def __init__(self, slots=1024, tick=1.0, now=0.0):
+        self.tick = float(tick)
+        self._slots = [set() for _ in range(int(slots))]
+        self._current = int(now // self.tick)
+
+    def _tick_of(self, deadline):
+        # Never in the past: an overdue deadline fires on the next advance
+        return max(self._current + 1, int(math.ceil(deadline / self.tick)))
+
+    def schedule(self, key, deadline):
+        """Add `key` to the slot of `deadline`.
+
+        Deadlines more than one revolution away land in an earlier lap of
+        the same slot; the caller re-checks and reschedules them.
+        """
+        self._slots[self._tick_of(deadline) % len(self._slots)].add(key)
+
+    def discard(self, key, deadline):
+        self._slots[self._tick_of(deadline) % len(self._slots)].discard(key)
+
+    def advance(self, now):
+        """Move the wheel to `now` and return the keys of every slot passed."""
+        target = int(now // self.tick)
+        expired = []
+        # After a long stall one full revolution visits every slot
+        steps = min(target - self._current, len(self._slots))
+        for step in range(1, steps + 1):
+            slot = self._slots[(self._current + step) % len(self._slots)]
+            if slot:
+                expired.extend(slot)
+                slot.clear()
+        self._current = max(self._current, target)
+        return expired
+
+    def __len__(self):
+        return sum(len(slot) for slot in self._slots)
+
+
+class _Device:
+    __slots__ = ("last_seen", "gap", "deadline", "silent")
+
+    def __init__(self, now):
+        self.last_seen = now
+        self.gap = None
+        # Deadline the wheel entry was scheduled for (None = not in the wheel)
+        self.deadline = None
+        self.silent = False
+
+
+class SilenceDetector:
+    # Messages closer than this belong to the same publish burst (battery,
+    # telemetry and sensor topics of one cycle) and do not update the gap
+    MIN_GAP = 1.0
+    ALPHA = 0.2
+
+    def __init__(self, on_change, multiplier=3.0, min_timeout=120.0, max_timeout=1800.0,
+                 tick=1.0, slots=1024, report_interval=300.0, clock=time.monotonic):
+        self.on_change = on_change
+        self.report_interval = float(report_interval)
+        self.multiplier = float(multiplier)
+        self.min_timeout = float(min_timeout)
+        self.max_timeout = float(max_timeout)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._devices = {}
+        self._wheel = TimerWheel(slots, tick, clock())
+        self._stop = threading.Event()
+        self._thread = None
+        self.expired = 0
+        self.recovered = 0
+
+    def timeout(self, device_state):
+        if device_state.gap is None:
+            return self.min_timeout
+        return min(self.max_timeout, max(self.min_timeout, self.multiplier * device_state.gap))
+
+    def seen(self, device):
+        """Record traffic from `device`; O(1) regardless of fleet size."""
+        now = self.clock()
+        recovered = False
+        with self._lock:
+            state = self._devices.get(device)
+            if state is None:
+                state = self._devices[device] = _Device(now)
+            else:
+                gap = now - state.last_seen
+                if state.silent:
+                    # First message after a silence: the cadence has most
+                    # likely changed (slower interval, power saving), so the
+                    # observed gap replaces the average instead of being
+                    # blended in; otherwise a device whose interval grew past
+                    # the timeout would flap offline/online on every cycle.
+                    # Capped so a long real outage does not leave a huge gap.
+                    state.gap = min(gap, self.max_timeout / self.multiplier)
+                    state.silent = False
+                    recovered = True
+                    self.recovered += 1
+                elif gap >= self.MIN_GAP:
+                    state.gap = gap if state.gap is None else state.gap + self.ALPHA * (gap - state.gap)
+                state.last_seen = now
+            if state.deadline is None:
+                state.deadline = now + self.timeout(state)
+                self._wheel.schedule(device, state.deadline)
+        if recovered:
+            self.on_change(device, "online")
+
+    def mark_offline(self, device):
+        """Explicit or persisted offline: stop watching until the device is heard again.
+
+        The next message from the device reports it online.
+        """
+        with self._lock:
+            state = self._devices.get(device)
+            if state is None:
+                state = self._devices[device] = _Device(self.clock())
+            state.silent = True
+            if state.deadline is not None:
+                self._wheel.discard(device, state.deadline)
+                state.deadline = None
+
+    def advance(self):
+        """Fire the deadlines up to now; returns the devices flagged offline."""
+        now = self.clock()
+        silent = []
+        with self._lock:
+            for device in self._wheel.advance(now):
+                state = self._devices.get(device)
+                if state is None or state.deadline is None:
+                    continue
+                deadline = state.last_seen + self.timeout(state)
+                if deadline > now:
+                    # Heard from since scheduling (or a later lap): move it on
+                    state.deadline = deadline
+                    self._wheel.schedule(device, deadline)
+                    continue
+                state.deadline = None
+                state.silent = True
+                self.expired += 1
+                silent.append((device, now - state.last_seen))
+        for device, quiet in silent:
+            logger.warning(f"{device}: no telemetry for {quiet:.0f}s")
+            self.on_change(device, "offline")
+        return [device for device, _ in silent]
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="liveness", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        next_report = self.clock() + self.report_interval
+        while not self._stop.wait(self._wheel.tick):
+            self.advance()
+            if self.report_interval > 0 and self.clock() >= next_report:
+                next_report = self.clock() + self.report_interval
+                logger.info(
+                    "Liveness: " + ", ".join(f"{key}={value}" for key, value in self.stats().items())
+                )
+
+    def stats(self):
+        with self._lock:
+            return {
+                "devices": len(self._devices),
+                "silent": sum(1 for state in self._devices.values() if state.silent),
+                "expired": self.expired,
+                "recovered": self.recovered,
+            }
@@ -21,10 +21,31 @@ import uuid
 import os
 import sys
 import fcntl
+import heapq
+import math
+import queue
 import shutil
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import paho.mqtt.client as mqtt
 
+# Moduli condivisi: sul telefono vanno copiati accanto a questo file,
+# nel repo stanno in atlas-common/
+_COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "atlas-common")
+if os.path.isdir(_COMMON_DIR):
+    sys.path.append(_COMMON_DIR)
+
+from asynclog import PeriodicSummary, setup_async_logging
+from deadband import DeadbandFilter
+import line_protocol
+from battery import BatteryProvider
+from spoolqueue import SpoolQueue
+from procsampler import ProcSampler
+from termux_streams import TermuxStreams
+from agent_self import AgentSelfMonitor
+
 
 # ----------------------------
 # Env loader (.env)
@@ -103,61 +124,6 @@ def resolve_topic(value, fallback):
     return value
 
 
-def _escape_measurement(value):
-    return str(value).replace("\\", "\\\\").replace(" ", "\\ ").replace(",", "\\,")
-
-
-def _escape_tag(value):
-    return (
-        str(value)
-        .replace("\\", "\\\\")
-        .replace(" ", "\\ ")
-        .replace(",", "\\,")
-        .replace("=", "\\=")
-    )
-
-
-def _escape_field_key(value):
-    return (
-        str(value)
-        .replace("\\", "\\\\")
-        .replace(" ", "\\ ")
-        .replace(",", "\\,")
-        .replace("=", "\\=")
-    )
-
-
-def _format_fields(fields):
-    parts = []
-    for key, value in fields.items():
-        if value is None:
-            continue
-        key = _escape_field_key(key)
-        if isinstance(value, bool):
-            parts.append(f"{key}={str(value).lower()}")
-        elif isinstance(value, int):
-            parts.append(f"{key}={value}i")
-        elif isinstance(value, float):
-            parts.append(f"{key}={value}")
-        else:
-            escaped = str(value).replace("\\", "\\\\").replace('"', '\\"')
-            parts.append(f'{key}="{escaped}"')
-    return ",".join(parts)
-
-
-def _format_line_protocol(measurement, tags, fields, timestamp_ns):
-    measurement = _escape_measurement(measurement)
-    tags_part = ",".join(
-        f"{_escape_tag(k)}={_escape_tag(v)}" for k, v in (tags or {}).items() if v is not None
-    )
-    fields_part = _format_fields(fields or {})
-    if not fields_part:
-        return None
-    if tags_part:
-        measurement = f"{measurement},{tags_part}"
-    return f"{measurement} {fields_part} {timestamp_ns}"
-
-
 # ----------------------------
 # Carica configurazione
 # ----------------------------
@@ -247,14 +213,34 @@ sensors_topics_cfg["sensor"] = resolve_topic(
 )
 
 
+deadband_cfg = config.get("deadband") or {}
+deadband = DeadbandFilter(
+    deadband_cfg.get("fields"),
+    heartbeat=coerce_int(deadband_cfg.get("heartbeat") or 300, "deadband.heartbeat"),
+)
+
+
+def _format_reported(measurement, tags, fields, timestamp_ns):
+    """Line protocol dei soli campi che superano il deadband (None se soppresso)."""
+    fields = deadband.filter(measurement, fields, tags)
+    return line_protocol.encode(measurement, tags, fields, timestamp_ns)
+
+
 # ----------------------------
 # Logging
 # ----------------------------
-logging.basicConfig(
-    level=getattr(logging, logging_cfg.get("level", "INFO")),
-    format="%(asctime)s - %(levelname)s - %(message)s",
+# I/O dei log nel thread del QueueListener, fuori dal loop di telemetria
+log_handler = setup_async_logging(
+    getattr(logging, logging_cfg.get("level", "INFO")),
+    [logging.StreamHandler()],
 )
 logger = logging.getLogger(__name__)
+# Riepilogo periodico al posto di una riga INFO per ciclo
+publish_summary = PeriodicSummary(
+    logger,
+    "messaggi inviati",
+    period=coerce_int(logging_cfg.get("summary_interval") or 60, "logging.summary_interval"),
+)
 
 if env_path:
     logger.info(f"Env caricato da: {env_path}")
@@ -291,70 +277,51 @@ logger.info(f"DISK_PATH: {DISK_PATH}")
 
 
 # ----------------------------
-# Sensori Termux (con retry)
+# Costo del client (atlas_agent_self)
 # ----------------------------
-def get_battery_status(retries: int = 2):
-    """Legge stato batteria via termux-battery-status con retry"""
-    for attempt in range(retries):
-        try:
-            result = subprocess.run(
-                ["termux-battery-status"],
-                capture_output=True,
-                text=True,
-                timeout=5,
-            )
-            if result.returncode == 0 and result.stdout.strip():
-                return json.loads(result.stdout)
-        except subprocess.TimeoutExpired:
-            logger.warning(f"Timeout batteria (tentativo {attempt+1}/{retries})")
-            time.sleep(0.5)
-        except Exception as e:
-            logger.error(f"Errore batteria: {e}")
-            time.sleep(0.5)
-    return None
-
-
-_prev_cpu_total = None
-_prev_cpu_idle = None
+# CPU, RSS, processi figli, byte pubblicati e durata dei collector; oltre
+# il budget la politica di campionamento allunga l'intervallo e spegne i
+# collector costosi. Creato prima dei sensori: l'audit hook deve già contare
+# i processi avviati dal refresher della batteria
+self_cfg = config.get("agent_self") or {}
+agent_monitor = AgentSelfMonitor(
+    budget=self_cfg.get("budget"),
+    max_factor=float(self_cfg.get("max_factor") or 8),
+)
 
 
-def _read_first_line(path):
-    try:
-        with open(path, "r") as f:
-            return f.readline().strip()
-    except Exception:
-        return None
+# ----------------------------
+# Sensori
+# ----------------------------
+# Batteria da sysfs se leggibile, altrimenti termux-battery-status in
+# background con cache: il loop non attende mai Termux:API
+battery_cfg = config.get("battery") or {}
+battery_provider = BatteryProvider(
+    source=battery_cfg.get("source", "auto"),
+    cache_ttl=coerce_int(battery_cfg.get("cache_ttl") or 60, "battery.cache_ttl"),
+    max_age=coerce_int(battery_cfg.get("max_age") or 300, "battery.max_age"),
+)
+battery_provider.start()
+logger.info(f"Sorgente batteria: {battery_provider.source}")
+
+# /proc con file tenuti aperti e riletti con pread: costa poco anche a 1 Hz
+proc_cfg = config.get("proc") or {}
+PROC_PERCPU = bool(proc_cfg.get("percpu", False))
+proc_sampler = ProcSampler(
+    interfaces=proc_cfg.get("interfaces"),
+    disks=proc_cfg.get("disks"),
+)
 
 
-def get_cpu_usage_active():
-    global _prev_cpu_total, _prev_cpu_idle
-    line = _read_first_line("/proc/stat")
-    if not line or not line.startswith("cpu "):
-        return get_cpu_usage_from_top()
-    parts = line.split()
-    try:
-        values = [int(x) for x in parts[1:]]
-    except ValueError:
-        return None
-    if len(values) < 4:
-        return None
-    idle = values[3] + (values[4] if len(values) > 4 else 0)
-    total = sum(values)
-    if _prev_cpu_total is None:
-        _prev_cpu_total = total
-        _prev_cpu_idle = idle
-        return None
-    delta_total = total - _prev_cpu_total
-    delta_idle = idle - _prev_cpu_idle
-    _prev_cpu_total = total
-    _prev_cpu_idle = idle
-    if delta_total <= 0:
-        return get_cpu_usage_from_top()
-    usage = 100.0 * (delta_total - delta_idle) / delta_total
-    if usage < 0:
-        return 0.0
-    if usage > 100:
-        return 100.0
+def get_cpu_usage():
+    """Utilizzo CPU in % per `cpu-total` (e per core con proc.percpu)."""
+    usage = proc_sampler.cpu()
+    if usage is None:
+        # /proc/stat negato (Android 8+): solo il totale, da top
+        total = get_cpu_usage_from_top()
+        return {"cpu-total": total} if total is not None else {}
+    if not PROC_PERCPU:
+        return {name: value for name, value in usage.items() if name == "cpu-total"}
     return usage
 
 
@@ -391,30 +358,8 @@ def get_cpu_usage_from_top():
 
 
 def get_mem_used_percent():
-    try:
-        meminfo = {}
-        with open("/proc/meminfo", "r") as f:
-            for line in f:
-                if ":" not in line:
-                    continue
-                key, value = line.split(":", 1)
-                value = value.strip().split()[0]
-                meminfo[key] = int(value)
-        mem_total = meminfo.get("MemTotal")
-        mem_available = meminfo.get("MemAvailable")
-        if mem_total is None:
-            return None
-        if mem_available is None:
-            mem_free = meminfo.get("MemFree", 0)
-            buffers = meminfo.get("Buffers", 0)
-            cached = meminfo.get("Cached", 0)
-            mem_available = mem_free + buffers + cached
-        used = mem_total - mem_available
-        if mem_total <= 0:
-            return None
-        return (used / mem_total) * 100.0
-    except Exception:
-        return None
+    memory = proc_sampler.memory()
+    return memory["used_percent"] if memory else None
 
 
 def get_disk_used_percent(path):
@@ -473,20 +418,11 @@ def _parse_uptime_line(line):
 
 
 def get_uptime_and_load():
-    uptime_seconds = None
-    load1 = None
-    line = _read_first_line("/proc/uptime")
-    if line:
-        try:
-            uptime_seconds = int(float(line.split()[0]))
-        except (ValueError, IndexError):
-            uptime_seconds = None
-    line = _read_first_line("/proc/loadavg")
-    if line:
-        try:
-            load1 = float(line.split()[0])
-        except (ValueError, IndexError):
-            load1 = None
+    uptime_seconds = proc_sampler.uptime()
+    if uptime_seconds is not None:
+        uptime_seconds = int(uptime_seconds)
+    load = proc_sampler.loadavg()
+    load1 = load[0] if load else None
     if uptime_seconds is not None or load1 is not None:
         return uptime_seconds, load1
     try:
@@ -503,11 +439,352 @@ def get_uptime_and_load():
         return None, None
 
 
+# ----------------------------
+# Raccolta concorrente
+# ----------------------------
+# I collector girano in parallelo su un pool piccolo con una deadline per
+# ciclo: un fallback lento (`top`, `uptime`, Termux:API) non ritarda gli
+# altri. Un collector che manca la deadline non viene rilanciato finché non
+# termina; il suo risultato esce nel ciclo successivo con il proprio
+# timestamp di campionamento (`late: carry`) oppure viene scartato
+# (`late: drop`).
+collectors_cfg = config.get("collectors") or {}
+COLLECTOR_DEADLINE = float(collectors_cfg.get("deadline") or 3)
+COLLECTOR_LATE_POLICY = collectors_cfg.get("late", "carry")
+if COLLECTOR_LATE_POLICY not in ("carry", "drop"):
+    raise SystemExit(f"Invalid collectors.late: {COLLECTOR_LATE_POLICY} (carry|drop)")
+
+COLLECTORS = {
+    "battery": battery_provider.read,
+    "cpu": get_cpu_usage,
+    "mem": get_mem_used_percent,
+    "disk": lambda: get_disk_used_percent(DISK_PATH),
+    "system": get_uptime_and_load,
+}
+if proc_cfg.get("net", True):
+    COLLECTORS["net"] = proc_sampler.net
+if proc_cfg.get("diskio", False):
+    COLLECTORS["diskio"] = proc_sampler.diskio
+collector_pool = ThreadPoolExecutor(
+    max_workers=coerce_int(collectors_cfg.get("workers") or 3, "collectors.workers"),
+    thread_name_prefix="collector",
+)
+# nome -> future non ancora consumato (in corso o in ritardo)
+_inflight = {}
+_late = set()
+collector_stats = {"late": 0, "carried": 0, "dropped": 0, "skipped": 0, "errors": 0}
+
+
+def _sample(name, func):
+    started = time.monotonic()
+    try:
+        value = func()
+    finally:
+        agent_monitor.record_collector(name, time.monotonic() - started)
+    return time.time_ns(), value
+
+
+def collect_cycle(deadline, enabled):
+    """Lancia i collector `enabled` liberi e attende fino a `deadline` (monotonic).
+
+    Ritorna {nome: (timestamp_ns, valore)} con il timestamp di quando il
+    valore è stato letto.
+    """
+    for name in enabled:
+        if name in _inflight:
+            collector_stats["skipped"] += 1
+            continue
+        _inflight[name] = collector_pool.submit(_sample, name, COLLECTORS[name])
+    wait(list(_inflight.values()), timeout=max(0.0, deadline - time.monotonic()))
+
+    results = {}
+    for name, future in list(_inflight.items()):
+        if not future.done():
+            if name not in _late:
+                _late.add(name)
+                collector_stats["late"] += 1
+                logger.warning(f"Collector {name} oltre la deadline del ciclo")
+            continue
+        del _inflight[name]
+        late = name in _late
+        _late.discard(name)
+        try:
+            sampled = future.result()
+        except Exception as e:
+            collector_stats["errors"] += 1
+            logger.error(f"Errore collector {name}: {e}")
+            continue
+        if late:
+            if COLLECTOR_LATE_POLICY == "drop":
+                collector_stats["dropped"] += 1
+                continue
+            collector_stats["carried"] += 1
+        results[name] = sampled
+    return results
+
+
+# ----------------------------
+# Politica di campionamento (batteria/carica/budget)
+# ----------------------------
+class PowerPolicy:
+    """
+    Intervallo e collector attivi in funzione di batteria, carica e budget.
+
+    Le regole sono valutate in ordine e vince la prima che corrisponde
+    (`charging`, `below`/`above` sulla percentuale); senza regole valide si
+    usa `sensors.interval` con tutti i collector. Il collector `battery`
+    resta sempre attivo: serve a rivalutare la politica.
+
+    Budget energetico: a batteria il calo viene misurato su una finestra di
+    `window` secondi; se supera `max_drain_per_hour` punti percentuali l'ora
+    l'intervallo viene allungato (x1.25 per passo, al massimo ogni
+    `window / 6` secondi, fino a `max_interval`) e ridotto di nuovo quando il
+    consumo rientra sotto l'80% del budget.
+
+    Budget del processo: `set_self_factor()` (da AgentSelfMonitor) moltiplica
+    l'intervallo, fino a `max_interval`, e finché è > 1 spegne i collector
+    `expensive`.
+    """
+
+    STEP = 1.25
+
+    def __init__(self, rules, default_interval, collectors, budget=None, expensive=None,
+                 clock=time.monotonic):
+        self.rules = list(rules or [])
+        self.default_interval = float(default_interval)
+        self.all_collectors = tuple(collectors)
+        budget = budget or {}
+        self.max_drain = float(budget.get("max_drain_per_hour") or 0)
+        self.window = float(budget.get("window") or 1800)
+        self.max_interval = float(budget.get("max_interval") or 600)
+        self.clock = clock
+        # (istante, percentuale) mentre il telefono è a batteria
+        self._samples = deque()
+        self._adjusted_at = None
+        self.rule = None
+        self.charging = None
+        self.drain_per_hour = None
+        self.budget_factor = 1.0
+        self.expensive = frozenset(expensive or ()) - {"battery"}
+        self.self_factor = 1.0
+        self._percentage = None
+        self.interval = self.default_interval
+        self.collectors = self.all_collectors
+
+    @staticmethod
+    def is_charging(battery):
+        status = str(battery.get("status") or "").upper()
+        plugged = str(battery.get("plugged") or "UNPLUGGED").upper()
+        return status in ("CHARGING", "FULL") or plugged != "UNPLUGGED"
+
+    @staticmethod
+    def _matches(when, percentage, charging):
+        if "charging" in when and bool(when["charging"]) != charging:
+            return False
+        if "below" in when and (percentage is None or percentage >= float(when["below"])):
+            return False
+        if "above" in when and (percentage is None or percentage <= float(when["above"])):
+            return False
+        return True
+
+    def _update_budget(self, now, percentage, charging):
+        if charging or percentage is None or self.max_drain <= 0:
+            self._samples.clear()
+            self.drain_per_hour = None
+            self.budget_factor = 1.0
+            return
+        self._samples.append((now, float(percentage)))
+        while len(self._samples) > 2 and now - self._samples[1][0] >= self.window:
+            self._samples.popleft()
+        first_at, first_pct = self._samples[0]
+        elapsed = now - first_at
+        # La percentuale ha passo 1%: sotto qualche minuto la stima è solo rumore
+        if elapsed < min(600.0, self.window):
+            return
+        self.drain_per_hour = max(0.0, (first_pct - percentage) * 3600.0 / elapsed)
+        if self._adjusted_at is not None and now - self._adjusted_at < self.window / 6:
+            return
+        if self.drain_per_hour > self.max_drain:
+            factor = min(self.budget_factor * self.STEP, self.max_interval / self.default_interval)
+        elif self.drain_per_hour < 0.8 * self.max_drain:
+            factor = max(1.0, self.budget_factor / self.STEP)
+        else:
+            return
+        if factor != self.budget_factor:
+            self.budget_factor = factor
+            self._adjusted_at = now
+
+    def update(self, battery):
+        """Rivaluta la politica con l'ultima lettura batteria; True se è cambiata."""
+        if not battery:
+            return False
+        percentage = battery.get("percentage")
+        percentage = float(percentage) if percentage is not None else None
+        charging = self.is_charging(battery)
+        self.charging = charging
+        self._percentage = percentage
+        self._update_budget(self.clock(), percentage, charging)
+        return self._evaluate()
+
+    def set_self_factor(self, factor):
+        """Applica il fattore di backoff del budget di processo; True se cambia."""
+        if factor == self.self_factor:
+            return False
+        self.self_factor = float(factor)
+        return self._evaluate()
+
+    def _evaluate(self):
+        before = (self.rule, self.interval, self.collectors)
+        percentage = self._percentage
+        charging = self.charging
+        self.rule = None
+        interval = self.default_interval
+        collectors = self.all_collectors
+        for index, rule in enumerate(self.rules):
+            if self._matches(rule.get("when") or {}, percentage, charging):
+                self.rule = index
+                interval = float(rule.get("interval") or interval)
+                if rule.get("collectors"):
+                    wanted = set(rule["collectors"]) | {"battery"}
+                    collectors = tuple(name for name in self.all_collectors if name in wanted)
+                break
+        factor = self.budget_factor * self.self_factor
+        if factor > 1.0:
+            interval = max(interval, min(self.max_interval, interval * factor))
+        if self.self_factor > 1.0 and self.expensive:
+            collectors = tuple(name for name in collectors if name not in self.expensive)
+        self.interval = interval
+        self.collectors = collectors
+        return (self.rule, self.interval, self.collectors) != before
+
+    def fields(self):
+        fields = {
+            "interval": self.interval,
+            "rule": -1 if self.rule is None else self.rule,
+            "collectors": len(self.collectors),
+            "budget_factor": self.budget_factor,
+            "self_factor": self.self_factor,
+        }
+        if self.charging is not None:
+            fields["charging"] = self.charging
+        if self.drain_per_hour is not None:
+            fields["drain_per_hour"] = self.drain_per_hour
+        return fields
+
+
+policy_cfg = config.get("power_policy") or {}
+power_policy = PowerPolicy(
+    policy_cfg.get("rules") if policy_cfg.get("enabled", True) else None,
+    sensors_cfg["interval"],
+    COLLECTORS,
+    budget=policy_cfg.get("budget") if policy_cfg.get("enabled", True) else None,
+    expensive=self_cfg.get("expensive"),
+)
+
+
+# ----------------------------
+# Cadenze per collector (multi-rate)
+# ----------------------------
+class MultiRateScheduler:
+    """
+    Min-heap delle prossime scadenze (clock monotono), una per collector.
+
+    `wait()` dorme fino alla prima scadenza e restituisce insieme tutte le
+    voci scadute entro `slack` secondi, così i collector con periodi
+    multipli (10s/30s/300s) finiscono nello stesso tick e nello stesso
+    payload. Le deadline avanzano a multipli del periodo (niente drift); i
+    tick persi per un ciclo lungo vengono saltati e contati in `overruns`.
+    """
+
+    def __init__(self, slack=0.25, clock=time.monotonic):
+        self.slack = float(slack)
+        self.clock = clock
+        self.overruns = 0
+        self.wakeups = 0
+        self._origin = None
+        self._periods = {}
+        self._heap = []
+
+    def configure(self, periods):
+        """Imposta {nome: periodo}; le voci nuove o cambiate si riallineano."""
+        now = self.clock()
+        if self._origin is None:
+            self._origin = now
+        deadlines = {name: deadline for deadline, name in self._heap}
+        previous = self._periods
+        self._periods = {name: float(period) for name, period in periods.items()}
+        self._heap = []
+        for name, period in self._periods.items():
+            deadline = deadlines.get(name)
+            if deadline is None or previous.get(name) != period:
+                # Prossimo multiplo del periodo dall'origine comune: periodi
+                # multipli tra loro continuano a cadere nello stesso tick
+                steps = math.ceil((now - self._origin) / period - 1e-9)
+                deadline = self._origin + steps * period
+            self._heap.append((deadline, name))
+        heapq.heapify(self._heap)
+
+    def periods(self):
+        return dict(self._periods)
+
+    def wait(self):
+        """Blocca fino alla prossima scadenza; ritorna (tick, voci scadute)."""
+        tick = self._heap[0][0]
+        delay = tick - self.clock()
+        if delay > 0:
+            time.sleep(delay)
+        self.wakeups += 1
+        now = self.clock()
+        due = []
+        rescheduled = []
+        while self._heap and self._heap[0][0] <= max(tick, now) + self.slack:
+            deadline, name = heapq.heappop(self._heap)
+            due.append(name)
+            period = self._periods[name]
+            deadline += period
+            if deadline <= now:
+                skipped = int((now - deadline) // period) + 1
+                self.overruns += skipped
+                deadline += skipped * period
+            rescheduled.append((deadline, name))
+        # Reinserite dopo il giro: non possono rientrare in questo tick
+        for entry in rescheduled:
+            heapq.heappush(self._heap, entry)
+        return tick, due
+
+
+# Periodi per collector (`sensors.periods`), riferiti a `sensors.interval`;
+# senza voce il collector segue l'intervallo della politica di campionamento
+MIN_COLLECTOR_PERIOD = 1.0
+COLLECTOR_PERIODS = {
+    name: float(period) for name, period in (sensors_cfg.get("periods") or {}).items()
+    if name in COLLECTORS
+}
+scheduler = MultiRateScheduler()
+
+
+def effective_periods():
+    """
+    Periodi correnti per collector. Quelli configurati scalano con la
+    politica (periodo x intervallo corrente / `sensors.interval`): a batteria
+    piena un periodo più corto dell'intervallo resta più corto (risoluzione
+    maggiore dove serve), con una regola da 300s tutti rallentano in
+    proporzione.
+    """
+    base = power_policy.interval
+    factor = base / sensors_cfg["interval"]
+    return {
+        name: max(COLLECTOR_PERIODS[name] * factor, MIN_COLLECTOR_PERIOD)
+        if name in COLLECTOR_PERIODS else base
+        for name in power_policy.collectors
+    }
+
+
 # ----------------------------
 # Comandi (async)
 # ----------------------------
 def execute_command_async(command_data: dict):
-    """Esegue comando in thread separato per non bloccare loop MQTT"""
+    """Esegue un comando in un worker di CommandExecutor, fuori dal loop MQTT"""
     action = command_data.get("action")
     try:
         if action == "vibrate":
@@ -546,37 +823,272 @@ def execute_command_async(command_data: dict):
         logger.error(f"Errore comando ({action}): {e}")
 
 
+class TokenBucket:
+    """`rate` token/s con riserva massima `burst`."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def take(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            return True
+        return False
+
+
+class CommandExecutor:
+    """
+    Pool fisso di worker con coda limitata per i comandi MQTT.
+
+    Prima di accodare un comando:
+    - i duplicati (stesso JSON) entro `dedupe_window` secondi vengono unificati;
+    - ogni azione ha un token bucket (`limits`, con `default` per le altre);
+    - a coda piena il comando viene scartato invece di creare altri thread.
+    La latenza va dalla ricezione alla fine dell'esecuzione.
+    """
+
+    def __init__(self, handler, workers=2, queue_size=32, dedupe_window=5.0,
+                 limits=None, clock=time.monotonic):
+        self.handler = handler
+        self.dedupe_window = float(dedupe_window)
+        self.clock = clock
+        self._queue = queue.Queue(maxsize=int(queue_size))
+        self._lock = threading.Lock()
+        self._recent = {}
+        limits = dict(limits or {})
+        default = limits.pop("default", None) or {"rate": 1.0, "burst": 5}
+        self._default_limit = default
+        self._buckets = {
+            action: TokenBucket(limit.get("rate", 1.0), limit.get("burst", 1), clock)
+            for action, limit in limits.items()
+        }
+        self.stats = {
+            "received": 0,
+            "executed": 0,
+            "deduped": 0,
+            "rate_limited": 0,
+            "rejected": 0,
+            "errors": 0,
+        }
+        self._latencies = []
+        for index in range(int(workers)):
+            threading.Thread(target=self._worker, name=f"command-{index}", daemon=True).start()
+
+    def _bucket(self, action):
+        bucket = self._buckets.get(action)
+        if bucket is None:
+            bucket = TokenBucket(
+                self._default_limit.get("rate", 1.0), self._default_limit.get("burst", 5), self.clock
+            )
+            self._buckets[action] = bucket
+        return bucket
+
+    def submit(self, command):
+        """Accoda `command`; False se unificato, limitato o a coda piena."""
+        action = command.get("action")
+        key = json.dumps(command, sort_keys=True)
+        now = self.clock()
+        with self._lock:
+            self.stats["received"] += 1
+            if len(self._recent) > 256:
+                self._recent = {k: t for k, t in self._recent.items() if now - t < self.dedupe_window}
+            seen = self._recent.get(key)
+            if seen is not None and now - seen < self.dedupe_window:
+                self.stats["deduped"] += 1
+                return False
+            if not self._bucket(action).take():
+                self.stats["rate_limited"] += 1
+                logger.debug("Comando %s oltre il rate limit, scartato", action)
+                return False
+            try:
+                self._queue.put_nowait((now, command))
+            except queue.Full:
+                self.stats["rejected"] += 1
+                logger.debug("Coda comandi piena, %s scartato", action)
+                return False
+            self._recent[key] = now
+        return True
+
+    def _worker(self):
+        while True:
+            received, command = self._queue.get()
+            try:
+                self.handler(command)
+            except Exception as e:
+                with self._lock:
+                    self.stats["errors"] += 1
+                logger.error(f"Errore comando: {e}")
+            latency = self.clock() - received
+            with self._lock:
+                self.stats["executed"] += 1
+                if len(self._latencies) < 1000:
+                    self._latencies.append(latency)
+
+    def fields(self):
+        """Contatori cumulativi, coda attuale e latenze dall'ultima chiamata."""
+        with self._lock:
+            fields = dict(self.stats)
+            latencies = sorted(self._latencies)
+            self._latencies = []
+        fields["queue_depth"] = self._queue.qsize()
+        if latencies:
+            fields["latency_p50_ms"] = latencies[len(latencies) // 2] * 1000
+            fields["latency_max_ms"] = latencies[-1] * 1000
+        return fields
+
+
+commands_cfg = config.get("commands") or {}
+command_executor = CommandExecutor(
+    execute_command_async,
+    workers=coerce_int(commands_cfg.get("workers") or 2, "commands.workers"),
+    queue_size=coerce_int(commands_cfg.get("queue_size") or 32, "commands.queue_size"),
+    dedupe_window=float(commands_cfg.get("dedupe_window") or 5),
+    limits=commands_cfg.get("limits"),
+)
+
+
 # ----------------------------
 # Callback MQTT
 # ----------------------------
 def on_connect(client, userdata, flags, rc, properties=None):
+    global mqtt_connected
     if rc == 0:
         logger.info("Connesso al broker MQTT")
+        mqtt_connected = True
         client.subscribe(topics_cfg["commands"], qos=1)
         logger.info(f"Sottoscritto a {topics_cfg['commands']} (QoS 1)")
+        if spool is not None:
+            spool.set_connected(True)
     else:
         logger.error(f"Connessione fallita: rc={rc}")
 
 
-def on_disconnect(client, userdata, rc, properties=None, reason_code=None):
+def on_disconnect(client, userdata, flags, rc, properties=None):
+    global mqtt_connected
+    mqtt_connected = False
+    if spool is not None:
+        spool.set_connected(False)
     if rc != 0:
         logger.warning(f"Disconnesso in modo inatteso (rc={rc}). Il loop tenterà reconnect.")
     else:
         logger.info("Disconnesso dal broker (rc=0)")
 
 
+_publish_lock = threading.Lock()
+_pending_acks = {}
+# mid -> istante del PUBACK arrivato prima della registrazione del mid;
+# oltre EARLY_ACKS_MAX si scartano i più vecchi (publish non tracciati)
+_early_acks = {}
+EARLY_ACKS_MAX = 256
+mqtt_connected = False
+
+
+def publish_tracked(topic, payload):
+    """Publish QoS 1 con misura della latenza fino al PUBACK (spool se offline)."""
+    if spool is not None and not mqtt_connected:
+        # Non passa da paho: la sua coda in memoria si perde al restart
+        spool.append(payload, topic)
+        return None
+    # publish fuori da _publish_lock: paho chiama on_publish tenendo il
+    # proprio mutex dei messaggi in uscita, che client.publish() prende a sua
+    # volta; tenerli entrambi qui invertirebbe l'ordine (deadlock). Il
+    # PUBACK può quindi arrivare prima della registrazione: _early_acks.
+    sent_at = time.monotonic()
+    info = client.publish(topic, payload, qos=1)
+    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+        with _publish_lock:
+            acked_at = _early_acks.pop(info.mid, None)
+            if acked_at is None:
+                _pending_acks[info.mid] = sent_at
+        if acked_at is not None:
+            publish_summary.latency(acked_at - sent_at)
+        publish_summary.record(1, len(payload))
+        agent_monitor.record_published(len(payload))
+    else:
+        publish_summary.error()
+        if spool is not None:
+            spool.append(payload, topic)
+    return info
+
+
+def on_publish(client, userdata, mid, reason_code=None, properties=None):
+    now = time.monotonic()
+    with _publish_lock:
+        sent_at = _pending_acks.pop(mid, None)
+        if sent_at is None:
+            # Mid non (ancora) registrato: publish_tracked lo ritrova qui
+            if len(_early_acks) >= EARLY_ACKS_MAX:
+                del _early_acks[next(iter(_early_acks))]
+            _early_acks[mid] = now
+    if sent_at is not None:
+        publish_summary.latency(now - sent_at)
+
+
 def on_message(client, userdata, msg):
-    """Gestione comandi con threading"""
+    """Gestione comandi: accodati al pool di CommandExecutor"""
     payload = msg.payload.decode(errors="replace")
     logger.info(f"Comando: {payload}")
     try:
         command = json.loads(payload)
-        thread = threading.Thread(
-            target=execute_command_async, args=(command,), daemon=True
-        )
-        thread.start()
+        if not isinstance(command, dict):
+            raise ValueError("il comando deve essere un oggetto JSON")
     except Exception as e:
         logger.error(f"Errore parsing comando: {e}")
+        return
+    command_executor.submit(command)
+
+
+# ----------------------------
+# Stream termux-sensor / termux-location
+# ----------------------------
+# Un processo figlio per sorgente, ridotto per finestra sul telefono e
+# pubblicato a lotti sui topic sensors.sensor / sensors.location
+termux_streams = TermuxStreams(
+    config.get("streams") or {},
+    publish_tracked,
+    sensors_topics_cfg["sensor"],
+    sensors_topics_cfg["location"],
+)
+
+
+# ----------------------------
+# Ring buffer su disco (offline)
+# ----------------------------
+# I batch non inviati finiscono in SQLite nella home Termux e vengono
+# rinviati dopo on_connect in payload coalescenti, con banda limitata
+def _replay_publish(topic, payload):
+    info = client.publish(topic, payload, qos=1)
+    if info.rc == mqtt.MQTT_ERR_SUCCESS:
+        agent_monitor.record_published(len(payload))
+    return info
+
+
+spool_cfg = config.get("spool") or {}
+spool = None
+if spool_cfg.get("enabled", True):
+    try:
+        spool = SpoolQueue(
+            os.path.expanduser(spool_cfg.get("path") or "~/.atlas-spool/mobile.db"),
+            _replay_publish,
+            max_bytes=coerce_int(spool_cfg.get("max_bytes") or 16 * 1024 * 1024, "spool.max_bytes"),
+            replay_batch_bytes=coerce_int(
+                spool_cfg.get("replay_batch_bytes") or 65536, "spool.replay_batch_bytes"
+            ),
+            replay_rate=float(spool_cfg.get("replay_rate") or 2),
+            replay_bandwidth=coerce_int(
+                spool_cfg.get("replay_bandwidth") or 0, "spool.replay_bandwidth"
+            ),
+        )
+        logger.info(f"Spool attivo: {spool.path} ({spool.records} record in coda)")
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Spool disabilitato: {e}")
 
 
 # ----------------------------
@@ -591,6 +1103,7 @@ client = mqtt.Client(
 client.on_connect = on_connect
 client.on_disconnect = on_disconnect
 client.on_message = on_message
+client.on_publish = on_publish
 
 if mqtt_cfg.get("username"):
     client.username_pw_set(mqtt_cfg["username"], mqtt_cfg.get("password"))
@@ -614,8 +1127,86 @@ BROKER = mqtt_cfg["broker"]
 PORT = mqtt_cfg["port"]
 
 logger.info(f"Connessione a {BROKER}:{PORT}")
-client.connect(BROKER, PORT, 60)
+try:
+    client.connect(BROKER, PORT, 60)
+except OSError as e:
+    # Con lo spool attivo si parte comunque: il loop di paho ritenta
+    if spool is None:
+        raise
+    logger.warning(f"Broker non raggiungibile ({e}), telemetria in spool")
 client.loop_start()
+termux_streams.start()
+
+
+def status_lines(timestamp_ns, cycle_started):
+    """Righe di stato del client (provider, politica, spool, comandi, collector)."""
+    lines = []
+    provider_line = _format_reported(
+        "mobile_battery_provider",
+        {"source": battery_provider.source},
+        battery_provider.stats(),
+        timestamp_ns,
+    )
+    if provider_line:
+        lines.append(provider_line)
+
+    policy_line = _format_reported(
+        "mobile_power_policy",
+        None,
+        power_policy.fields(),
+        timestamp_ns,
+    )
+    if policy_line:
+        lines.append(policy_line)
+
+    if spool is not None:
+        spool_line = _format_reported(
+            "mobile_spool",
+            None,
+            {
+                "records": spool.records,
+                "bytes": spool.bytes,
+                "dropped": spool.dropped,
+                "replayed": spool.replayed,
+            },
+            timestamp_ns,
+        )
+        if spool_line:
+            lines.append(spool_line)
+
+    if termux_streams.enabled:
+        streams_line = _format_reported(
+            "mobile_streams",
+            None,
+            termux_streams.fields(),
+            timestamp_ns,
+        )
+        if streams_line:
+            lines.append(streams_line)
+
+    commands_line = _format_reported(
+        "mobile_commands",
+        None,
+        command_executor.fields(),
+        timestamp_ns,
+    )
+    if commands_line:
+        lines.append(commands_line)
+
+    collectors_fields = dict(collector_stats)
+    collectors_fields["inflight"] = len(_inflight)
+    collectors_fields["wakeups"] = scheduler.wakeups
+    collectors_fields["overruns"] = scheduler.overruns
+    collectors_fields["cycle_ms"] = (time.monotonic() - cycle_started) * 1000
+    collectors_line = _format_reported(
+        "mobile_collectors",
+        None,
+        collectors_fields,
+        timestamp_ns,
+    )
+    if collectors_line:
+        lines.append(collectors_line)
+    return lines
 
 
 # ----------------------------
@@ -623,14 +1214,23 @@ client.loop_start()
 # ----------------------------
 try:
     iteration = 0
+    scheduler.configure(effective_periods())
     while True:
-        iteration += 1
-        timestamp_ns = int(time.time() * 1_000_000_000)
-        battery = get_battery_status()
+        _, due = scheduler.wait()
+        cycle_started = time.monotonic()
+        timestamp_ns = time.time_ns()
+        periods = scheduler.periods()
+        deadline = cycle_started + min([COLLECTOR_DEADLINE] + [periods[name] for name in due])
+        results = collect_cycle(deadline, due)
+        # mobile_telemetry e le righe di stato seguono la cadenza della batteria
+        status_due = "battery" in due
+        if status_due:
+            iteration += 1
         percentage = None
         temperature = None
         status = None
 
+        battery_ns, battery = results.get("battery", (timestamp_ns, None))
         if battery:
             percentage = battery.get("percentage")
             temperature = battery.get("temperature")
@@ -642,114 +1242,153 @@ try:
             if temperature is not None:
                 battery_fields["temperature"] = float(temperature)
 
-            battery_line = _format_line_protocol(
+            battery_line = _format_reported(
                 "mobile_battery",
                 {"status": status},
                 battery_fields,
-                timestamp_ns,
+                battery_ns,
             )
             if battery_line:
-                client.publish(
-                    sensors_topics_cfg["battery"],
-                    battery_line,
-                    qos=1,
-                )
+                publish_tracked(sensors_topics_cfg["battery"], battery_line)
 
+            logger.debug("Telemetria #%d - Batteria: %s%%", iteration, percentage)
+        elif "battery" in results:
+            logger.warning(f"Telemetria #{iteration} - Batteria: N/A ({battery_provider.source})")
+
+        self_fields = agent_monitor.sample() if status_due else None
+        policy_changed = power_policy.update(battery)
+        if self_fields is not None and power_policy.set_self_factor(agent_monitor.factor):
+            policy_changed = True
             logger.info(
-                f"Telemetria #{iteration} - Batteria: {battery.get('percentage')}%"
+                f"Budget del processo: fattore {agent_monitor.factor:.2f} "
+                f"(CPU {self_fields.get('cpu_percent', 0.0):.1f}%, "
+                f"RSS {self_fields['rss_bytes'] / 1048576:.0f} MB)"
+            )
+        if policy_changed:
+            scheduler.configure(effective_periods())
+            logger.info(
+                f"Politica di campionamento: regola {power_policy.rule}, "
+                f"intervallo {power_policy.interval:.0f}s, "
+                f"collector {', '.join(power_policy.collectors)}"
             )
-        else:
-            logger.warning(f"Telemetria #{iteration} - Batteria: N/A (timeout)")
 
         lines = []
-        telemetry_fields = {"iteration": int(iteration)}
-        if percentage is not None:
-            telemetry_fields["battery_percent"] = float(percentage)
-        if temperature is not None:
-            telemetry_fields["battery_temp"] = float(temperature)
+        if self_fields is not None:
+            self_line = _format_reported("atlas_agent_self", None, self_fields, timestamp_ns)
+            if self_line:
+                lines.append(self_line)
+        if status_due:
+            telemetry_fields = {"iteration": int(iteration)}
+            if percentage is not None:
+                telemetry_fields["battery_percent"] = float(percentage)
+            if temperature is not None:
+                telemetry_fields["battery_temp"] = float(temperature)
 
-        telemetry_tags = {"status": status} if status else None
-        telemetry_line = _format_line_protocol(
-            "mobile_telemetry",
-            telemetry_tags,
-            telemetry_fields,
-            timestamp_ns,
-        )
-        if telemetry_line:
-            lines.append(telemetry_line)
+            telemetry_tags = {"status": status} if status else None
+            telemetry_line = _format_reported(
+                "mobile_telemetry",
+                telemetry_tags,
+                telemetry_fields,
+                timestamp_ns,
+            )
+            if telemetry_line:
+                lines.append(telemetry_line)
 
-        cpu_usage = get_cpu_usage_active()
-        if cpu_usage is not None:
-            cpu_line = _format_line_protocol(
+        cpu_ns, cpu_usage = results.get("cpu", (None, None))
+        for cpu_name, usage in (cpu_usage or {}).items():
+            cpu_line = _format_reported(
                 "cpu",
-                {"cpu": "cpu-total"},
-                {"usage_active": float(cpu_usage)},
-                timestamp_ns,
+                {"cpu": cpu_name},
+                {"usage_active": float(usage)},
+                cpu_ns,
             )
             if cpu_line:
                 lines.append(cpu_line)
 
-        mem_used = get_mem_used_percent()
+        mem_ns, mem_used = results.get("mem", (None, None))
         if mem_used is not None:
-            mem_line = _format_line_protocol(
+            mem_line = _format_reported(
                 "mem",
                 None,
                 {"used_percent": float(mem_used)},
-                timestamp_ns,
+                mem_ns,
             )
             if mem_line:
                 lines.append(mem_line)
 
-        disk_used = get_disk_used_percent(DISK_PATH)
+        disk_ns, disk_used = results.get("disk", (None, None))
         if disk_used is not None:
-            disk_line = _format_line_protocol(
+            disk_line = _format_reported(
                 "disk",
                 {"path": DISK_PATH},
                 {"used_percent": float(disk_used)},
-                timestamp_ns,
+                disk_ns,
             )
             if disk_line:
                 lines.append(disk_line)
 
         system_fields = {}
-        uptime_seconds, load1 = get_uptime_and_load()
+        system_ns, (uptime_seconds, load1) = results.get("system", (None, (None, None)))
         if uptime_seconds is not None:
             system_fields["uptime"] = int(uptime_seconds)
         if load1 is not None:
             system_fields["load1"] = float(load1)
         if system_fields:
-            system_line = _format_line_protocol(
+            system_line = _format_reported(
                 "system",
                 None,
                 system_fields,
-                timestamp_ns,
+                system_ns,
             )
             if system_line:
                 lines.append(system_line)
 
+        net_ns, net = results.get("net", (None, None))
+        for interface, (counters, rates) in (net or {}).items():
+            net_fields = dict(counters)
+            if rates:
+                net_fields["bytes_recv_per_s"] = rates["bytes_recv"]
+                net_fields["bytes_sent_per_s"] = rates["bytes_sent"]
+            net_line = _format_reported("net", {"interface": interface}, net_fields, net_ns)
+            if net_line:
+                lines.append(net_line)
+
+        diskio_ns, diskio = results.get("diskio", (None, None))
+        for disk_name, (counters, rates) in (diskio or {}).items():
+            diskio_fields = dict(counters)
+            if rates:
+                diskio_fields["read_bytes_per_s"] = rates["read_bytes"]
+                diskio_fields["write_bytes_per_s"] = rates["write_bytes"]
+            diskio_line = _format_reported("diskio", {"name": disk_name}, diskio_fields, diskio_ns)
+            if diskio_line:
+                lines.append(diskio_line)
+
         if temperature is not None:
-            temp_line = _format_line_protocol(
+            temp_line = _format_reported(
                 "temp",
                 {"sensor": "battery"},
                 {"temp": float(temperature)},
-                timestamp_ns,
+                battery_ns,
             )
             if temp_line:
                 lines.append(temp_line)
 
+        if status_due:
+            lines.extend(status_lines(timestamp_ns, cycle_started))
+
         if lines:
             payload = "\n".join(lines)
-            client.publish(
-                topics_cfg["telemetry"],
-                payload,
-                qos=1,
-            )
+            publish_tracked(topics_cfg["telemetry"], payload)
 
-        time.sleep(sensors_cfg["interval"])
 
 except KeyboardInterrupt:
     logger.info("Shutdown (CTRL+C)")
 finally:
+    termux_streams.stop()
+    battery_provider.stop()
+    collector_pool.shutdown(wait=False, cancel_futures=True)
+    proc_sampler.close()
+    agent_monitor.close()
     try:
         client.loop_stop()
         client.disconnect()
@@ -0,0 +1,261 @@
+"""
+Background notification dispatcher for watcher.py.
+
+`submit()` only records the latest status per device and returns; the
+blocking `termux-notification` calls run on the dispatcher thread, so the
+MQTT network thread never waits on Termux:API.
+
+- Transitions only: the last notified status of each device lives in a
+  DeviceStateTable (device_state.py); retained or repeated states are
+  ignored. A device seen for the first time is recorded without a
+  notification unless it is not "online".
+- Debounce: a status change is notified once it has been stable for
+  `debounce` seconds. A device that flaps back to its last notified status
+  inside the window produces no notification at all (counted as a flap).
+- Coalescing: when `burst` or more devices settle on the same status in one
+  flush they are collapsed into one summary ("7 devices offline").
+- Rule alerts (`alert()`) share the same thread; alerts of one rule firing
+  or resolving on `burst` or more devices in one flush become one summary.
+- Backlog: `stats()` reports pending devices and the age of the oldest
+  pending change, plus cumulative counters; it is logged every
+  `report_interval` seconds.
+"""
+
+import logging
+import subprocess
+import threading
+import time
+from collections import deque
+
+from device_state import DeviceStateTable
+
+logger = logging.getLogger(__name__)
+
+# Names listed in the body of a summary notification
+SUMMARY_NAMES = 10
+# Rule alerts waiting for the dispatcher thread; beyond this they are dropped
+ALERT_QUEUE_MAX = 1024
+
+
+def termux_notify(title, text, color, notification_id=None, timeout=10.0):
+    argv = [
+        "termux-notification",
+        "--title", title,
+        "--content", text,
+        "--led-color", color,
+        "--priority", "high",
+        "--vibrate", "500,500",
+    ]
+    if notification_id:
+        argv += ["--id", notification_id]
+    subprocess.run(argv, check=True, capture_output=True, timeout=timeout)
+
+
+def status_color(status):
+    return "ff0000" if status == "offline" else "00ff00"
+
+
+class NotificationDispatcher:
+    def __init__(self, send=termux_notify, state=None, debounce=30.0, burst=3,
+                 report_interval=300.0, clock=time.monotonic):
+        self.send = send
+        self.state = state if state is not None else DeviceStateTable()
+        self.debounce = float(debounce)
+        self.burst = max(2, int(burst))
+        self.report_interval = float(report_interval)
+        self.clock = clock
+        self._cond = threading.Condition()
+        # device -> (status, monotonic time of the last change)
+        self._pending = {}
+        # (rule name, device, text, firing)
+        self._alerts = deque()
+        self._stop = False
+        self._thread = None
+        self.stats_counters = {
+            "received": 0,
+            "notifications": 0,
+            "coalesced": 0,
+            "suppressed": 0,
+            "alerts": 0,
+            "alerts_dropped": 0,
+            "errors": 0,
+        }
+        self.send_seconds = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="notify", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        with self._cond:
+            self._stop = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def submit(self, device, status):
+        """Record a status change; never blocks on the notification itself."""
+        now = self.clock()
+        with self._cond:
+            self.stats_counters["received"] += 1
+            pending = self._pending.get(device)
+            if pending is not None and pending[0] == status:
+                # Repeated status: keep the original change time
+                return
+            if pending is not None:
+                # Flap inside the window: the previous change is never shown
+                self.stats_counters["suppressed"] += 1
+                self.state.flap(device)
+            if device not in self.state and status == "online":
+                # First sighting: baseline, not an alert
+                self._pending.pop(device, None)
+                self.state.update(device, status)
+                return
+            if status == self.state.status(device):
+                self._pending.pop(device, None)
+                return
+            self._pending[device] = (status, now)
+            self._cond.notify()
+
+    def alert(self, name, device, text, firing):
+        """Queue a rule alert (or its resolution); never blocks."""
+        with self._cond:
+            if len(self._alerts) >= ALERT_QUEUE_MAX:
+                self.stats_counters["alerts_dropped"] += 1
+                return
+            self._alerts.append((name, device, text, firing))
+            self._cond.notify()
+
+    def _due(self, now):
+        """Pop the changes stable for `debounce` seconds, grouped by status."""
+        groups = {}
+        for device, (status, changed_at) in list(self._pending.items()):
+            if now - changed_at >= self.debounce:
+                del self._pending[device]
+                if self.state.update(device, status):
+                    groups.setdefault(status, []).append(device)
+        return groups
+
+    def _next_wakeup(self, now):
+        if not self._pending:
+            return None
+        oldest = min(changed_at for _, changed_at in self._pending.values())
+        return max(0.0, oldest + self.debounce - now)
+
+    def _run(self):
+        next_report = self.clock() + self.report_interval
+        while True:
+            with self._cond:
+                if self._stop:
+                    return
+                now = self.clock()
+                timeout = self._next_wakeup(now)
+                if self.report_interval > 0:
+                    until_report = max(0.0, next_report - now)
+                    timeout = until_report if timeout is None else min(timeout, until_report)
+                if self._alerts:
+                    timeout = 0.0
+                if timeout is None or timeout > 0:
+                    self._cond.wait(timeout)
+                    if self._stop:
+                        return
+                groups = self._due(self.clock())
+                alerts = list(self._alerts)
+                self._alerts.clear()
+            for status, devices in groups.items():
+                self._dispatch(status, sorted(devices))
+            if alerts:
+                self._dispatch_alerts(alerts)
+            if self.report_interval > 0 and self.clock() >= next_report:
+                next_report = self.clock() + self.report_interval
+                self._report()
+
+    def _report(self):
+        fields = self.stats()
+        logger.info(
+            "Notification dispatcher: "
+            + ", ".join(
+                f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                for key, value in fields.items()
+            )
+        )
+
+    def _dispatch(self, status, devices):
+        if len(devices) >= self.burst:
+            names = ", ".join(devices[:SUMMARY_NAMES])
+            if len(devices) > SUMMARY_NAMES:
+                names += f" (+{len(devices) - SUMMARY_NAMES})"
+            logger.warning(f"NOTIFY: {len(devices)} devices {status}: {names}")
+            with self._cond:
+                self.stats_counters["coalesced"] += len(devices) - 1
+            self._send(
+                f"Atlas Alert: {len(devices)} devices {status}",
+                names,
+                status,
+                f"atlas-watcher-{status}",
+            )
+            return
+        for device in devices:
+            logger.warning(f"NOTIFY: {device} is {status}")
+            self._send(f"Atlas Alert: {device}", f"Device is now {status.upper()}", status)
+
+    def _dispatch_alerts(self, alerts):
+        grouped = {}
+        for name, device, text, firing in alerts:
+            grouped.setdefault((name, firing), []).append((device, text))
+        for (name, firing), entries in grouped.items():
+            state = "firing" if firing else "resolved"
+            color_status = "offline" if firing else "online"
+            with self._cond:
+                self.stats_counters["alerts"] += len(entries)
+            if len(entries) >= self.burst:
+                devices = sorted(device for device, _ in entries)
+                names = ", ".join(devices[:SUMMARY_NAMES])
+                if len(devices) > SUMMARY_NAMES:
+                    names += f" (+{len(devices) - SUMMARY_NAMES})"
+                logger.warning(f"ALERT {name} {state} on {len(devices)} devices: {names}")
+                with self._cond:
+                    self.stats_counters["coalesced"] += len(entries) - 1
+                self._send(
+                    f"Atlas Alert: {name} {state} on {len(devices)} devices",
+                    names,
+                    color_status,
+                    f"atlas-rule-{name}",
+                )
+                continue
+            for device, text in entries:
+                logger.warning(f"ALERT {name} {state} on {device}: {text}")
+                self._send(
+                    f"Atlas Alert: {name} {state} on {device}",
+                    text,
+                    color_status,
+                    f"atlas-rule-{name}-{device}",
+                )
+
+    def _send(self, title, text, status, notification_id=None):
+        started = self.clock()
+        counter = "notifications"
+        try:
+            self.send(title, text, status_color(status), notification_id)
+        except Exception as e:
+            counter = "errors"
+            logger.error(f"Failed to send notification: {e}")
+        with self._cond:
+            self.stats_counters[counter] += 1
+            self.send_seconds += self.clock() - started
+
+    def stats(self):
+        now = self.clock()
+        with self._cond:
+            fields = dict(self.stats_counters)
+            fields["pending"] = len(self._pending)
+            fields["alerts_pending"] = len(self._alerts)
+            if self._pending:
+                oldest = min(changed_at for _, changed_at in self._pending.values())
+                fields["oldest_pending_s"] = now - oldest
+            sent = fields["notifications"] + fields["errors"]
+            if sent:
+                fields["send_ms"] = self.send_seconds / sent * 1000
+        for status, count in self.state.summary().items():
+            fields[f"fleet_{status}"] = count
+        return fields
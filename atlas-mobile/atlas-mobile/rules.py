@@ -0,0 +1,272 @@
+"""
+Local threshold alerts for watcher.py on line-protocol telemetry.
+
+A rule is `<measurement>.<field> <op> <threshold> [for <duration>]`, e.g.
+`mem.used_percent > 90 for 2m` or `mobile_battery.percentage < 15`, with
+an optional MQTT topic filter (`+`/`#` wildcards) and required tags.
+
+Rules are indexed by measurement and then field. For each line only the
+measurement is extracted first (`line_protocol.measurement_of`); lines
+whose measurement has no rule are skipped without decoding, and a decoded
+line is checked only against the rules of its own fields. Topic filters are
+resolved once per topic and cached.
+
+Window state is incremental: one entry per (rule, device, series) holding
+when the condition started to hold and whether the alert is firing. A rule
+with `for` fires on the first message after the condition has held for
+the whole duration; it resolves on the first message where it no longer
+holds.
+
+A series is identified by the values of the rule's `group_by` tags only
+(default: the tags the rule filters on), never by every tag of the point:
+a tag that changes value (e.g. `status` of mobile_battery when the charger
+is plugged in) must not open a second series and leave the first one
+firing forever. A series whose condition holds but which stops being
+evaluated (device silent, tag gone) expires after `expire_periods` times
+its usual gap between evaluations (EWMA), and never before `expire_after`
+seconds; a firing series that expires is resolved.
+"""
+
+import logging
+import operator
+import re
+import threading
+import time
+
+import line_protocol
+
+logger = logging.getLogger(__name__)
+
+_OPERATORS = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600}
+_EXPR = re.compile(
+    r"^\s*(?P<measurement>[^.\s]+)\.(?P<field>\S+)\s*(?P<op>>=|<=|==|!=|>|<)\s*"
+    r"(?P<threshold>[-+]?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)"
+    r"(?:\s+for\s+(?P<duration>\d+(?:\.\d+)?)(?P<unit>[smh]?))?\s*$"
+)
+_TOPIC_CACHE_MAX = 4096
+
+
+def topic_matches(pattern, topic):
+    """MQTT subscription match with `+` and `#` wildcards."""
+    pattern_parts = pattern.split("/")
+    topic_parts = topic.split("/")
+    for index, part in enumerate(pattern_parts):
+        if part == "#":
+            return True
+        if index >= len(topic_parts):
+            return False
+        if part != "+" and part != topic_parts[index]:
+            return False
+    return len(pattern_parts) == len(topic_parts)
+
+
+class Rule:
+    __slots__ = ("name", "expr", "measurement", "field", "op", "compare", "threshold",
+                 "duration", "topic", "tags", "group_by")
+
+    def __init__(self, expr, name=None, topic=None, tags=None, group_by=None):
+        match = _EXPR.match(expr)
+        if match is None:
+            raise ValueError(f"invalid rule expression: {expr!r}")
+        self.expr = expr.strip()
+        self.measurement = match["measurement"]
+        self.field = match["field"]
+        self.op = match["op"]
+        self.compare = _OPERATORS[self.op]
+        self.threshold = float(match["threshold"])
+        self.duration = float(match["duration"] or 0) * _UNITS[match["unit"] or ""]
+        self.name = name or f"{self.measurement}.{self.field}{self.op}{match['threshold']}"
+        self.topic = topic
+        self.tags = {str(k): str(v) for k, v in (tags or {}).items()}
+        # Tags identifying a series of this rule on one device
+        self.group_by = tuple(str(k) for k in (group_by if group_by is not None else sorted(self.tags)))
+
+
+def load_rules(specs):
+    """Rules from a list of dicts (`expr`, optional `name`, `topic`, `tags`, `group_by`) or strings."""
+    rules = []
+    for spec in specs or []:
+        if isinstance(spec, str):
+            spec = {"expr": spec}
+        rules.append(Rule(spec["expr"], spec.get("name"), spec.get("topic"), spec.get("tags"),
+                          spec.get("group_by")))
+    return rules
+
+
+class _Series:
+    __slots__ = ("since", "firing", "last_seen", "gap", "tags", "value")
+
+    def __init__(self, now):
+        self.since = now
+        self.firing = False
+        self.last_seen = now
+        # Usual gap between evaluations (None until the second one)
+        self.gap = None
+        self.tags = {}
+        self.value = None
+
+
+class RuleEngine:
+    # Evaluations closer than this come from the same publish burst
+    MIN_GAP = 1.0
+    ALPHA = 0.2
+
+    def __init__(self, rules, on_alert, expire_periods=5.0, expire_after=900.0,
+                 sweep_interval=10.0, clock=time.monotonic):
+        self.rules = list(rules)
+        self.on_alert = on_alert
+        self.expire_periods = float(expire_periods)
+        self.expire_after = float(expire_after)
+        self.sweep_interval = float(sweep_interval)
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        # measurement -> field -> [rule]
+        self._index = {}
+        for rule in self.rules:
+            self._index.setdefault(rule.measurement, {}).setdefault(rule.field, []).append(rule)
+        self.topics = sorted({rule.topic for rule in self.rules if rule.topic})
+        # topic -> topic filters that match it (None = rules without a filter)
+        self._topic_cache = {}
+        # (rule, device, group_by tag values) -> _Series
+        self._state = {}
+        self.stats = {
+            "messages": 0,
+            "lines": 0,
+            "skipped": 0,
+            "evaluations": 0,
+            "fired": 0,
+            "resolved": 0,
+            "expired": 0,
+            "errors": 0,
+        }
+
+    def _filters_for(self, topic):
+        filters = self._topic_cache.get(topic)
+        if filters is None:
+            filters = frozenset(
+                [None] + [pattern for pattern in self.topics if topic_matches(pattern, topic)]
+            )
+            if len(self._topic_cache) >= _TOPIC_CACHE_MAX:
+                self._topic_cache.clear()
+            self._topic_cache[topic] = filters
+        return filters
+
+    def process(self, topic, payload):
+        """Evaluate the rules that can match the lines of one MQTT message."""
+        if not self._index:
+            return
+        if isinstance(payload, bytes):
+            payload = payload.decode(errors="replace")
+        parts = topic.split("/")
+        device = parts[1] if len(parts) > 1 and parts[0] == "devices" else topic
+        filters = self._filters_for(topic)
+        now = self.clock()
+        alerts = []
+        with self._lock:
+            self.stats["messages"] += 1
+            for line in payload.split("\n"):
+                if not line or line.startswith("#"):
+                    continue
+                self.stats["lines"] += 1
+                by_field = self._index.get(line_protocol.measurement_of(line))
+                if by_field is None:
+                    self.stats["skipped"] += 1
+                    continue
+                try:
+                    _, tags, fields, _ = line_protocol.decode(line)
+                except ValueError as e:
+                    self.stats["errors"] += 1
+                    logger.debug("Unparsable line on %s: %s", topic, e)
+                    continue
+                for field, value in fields.items():
+                    rules = by_field.get(field)
+                    if rules is None or isinstance(value, (str, bool)):
+                        continue
+                    for rule in rules:
+                        if rule.topic not in filters:
+                            continue
+                        if rule.tags and any(tags.get(k) != v for k, v in rule.tags.items()):
+                            continue
+                        alert = self._evaluate(rule, device, tags, value, now)
+                        if alert is not None:
+                            alerts.append(alert)
+        for rule, alert_device, tags, value, firing in alerts:
+            self.on_alert(rule, alert_device, tags, value, firing)
+
+    def _evaluate(self, rule, device, tags, value, now):
+        self.stats["evaluations"] += 1
+        key = (rule, device, tuple(tags.get(k) for k in rule.group_by))
+        state = self._state.get(key)
+        if rule.compare(value, rule.threshold):
+            if state is None:
+                state = self._state[key] = _Series(now)
+            else:
+                gap = now - state.last_seen
+                if gap >= self.MIN_GAP:
+                    state.gap = gap if state.gap is None else state.gap + self.ALPHA * (gap - state.gap)
+                state.last_seen = now
+            state.tags = tags
+            state.value = value
+            if not state.firing and now - state.since >= rule.duration:
+                state.firing = True
+                self.stats["fired"] += 1
+                return rule, device, tags, value, True
+            return None
+        if state is None:
+            return None
+        del self._state[key]
+        if state.firing:
+            self.stats["resolved"] += 1
+            return rule, device, tags, value, False
+        return None
+
+    def _expires_at(self, state):
+        timeout = self.expire_after
+        if state.gap is not None:
+            timeout = max(timeout, self.expire_periods * state.gap)
+        return state.last_seen + timeout
+
+    def expire(self):
+        """Drop series not evaluated for too long; firing ones are resolved (value None)."""
+        now = self.clock()
+        alerts = []
+        with self._lock:
+            for key, state in list(self._state.items()):
+                if now < self._expires_at(state):
+                    continue
+                del self._state[key]
+                self.stats["expired"] += 1
+                if state.firing:
+                    self.stats["resolved"] += 1
+                    rule, device, _ = key
+                    alerts.append((rule, device, state.tags, None, False))
+        for rule, device, tags, value, firing in alerts:
+            self.on_alert(rule, device, tags, value, firing)
+        return len(alerts)
+
+    def start(self):
+        if self.sweep_interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="rules-expire", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.sweep_interval):
+            self.expire()
+
+    def firing(self):
+        with self._lock:
+            return sum(1 for state in self._state.values() if state.firing)
@@ -0,0 +1,312 @@
+"""
+Ingestione in streaming di termux-sensor e termux-location.
+
+Un solo processo figlio per sorgente, sempre attivo (`termux-sensor -d <ms>`,
+`termux-location -r updates`), invece di un subprocess per lettura: l'avvio
+di Termux:API costa centinaia di ms e accende ogni volta i sensori.
+L'output è una sequenza di oggetti JSON su più righe, letta a blocchi e
+decodificata in modo incrementale (`JsonStreamParser`).
+
+Le letture vengono ridotte sul dispositivo:
+- sensori: per finestra (`window` s) e per sensore media e massimo di ogni
+  asse e del modulo, più il numero di campioni (`mobile_sensor`);
+- posizione: l'ultima fix della finestra (`mobile_location`).
+Le righe line protocol vengono accumulate e pubblicate in un unico payload
+per topic ogni `publish_interval` secondi.
+"""
+
+import codecs
+import json
+import logging
+import math
+import os
+import subprocess
+import threading
+import time
+
+import line_protocol
+
+logger = logging.getLogger(__name__)
+
+
+class JsonStreamParser:
+    """Decodifica incrementale di oggetti JSON concatenati (anche multi-riga)."""
+
+    def __init__(self, max_buffer=1024 * 1024):
+        self.max_buffer = int(max_buffer)
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self.errors = 0
+
+    def feed(self, text):
+        self._buffer += text
+        objects = []
+        while True:
+            start = self._buffer.find("{")
+            if start < 0:
+                self._buffer = ""
+                break
+            try:
+                obj, end = self._decoder.raw_decode(self._buffer, start)
+            except json.JSONDecodeError:
+                if len(self._buffer) - start > self.max_buffer:
+                    # Oggetto mai chiuso: si riparte dalla prossima graffa
+                    self.errors += 1
+                    self._buffer = self._buffer[start + 1:]
+                    continue
+                self._buffer = self._buffer[start:]
+                break
+            objects.append(obj)
+            self._buffer = self._buffer[end:]
+        return objects
+
+
+class TermuxStream:
+    """Processo figlio Termux:API con lettura continua e riavvio con backoff."""
+
+    def __init__(self, name, argv, on_object, cleanup_argv=None, restart_delay=5.0):
+        self.name = name
+        self.argv = list(argv)
+        self.on_object = on_object
+        self.cleanup_argv = cleanup_argv
+        self.restart_delay = float(restart_delay)
+        self.restarts = 0
+        self._stop = threading.Event()
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"stream-{self.name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.terminate()
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if self.cleanup_argv:
+            # termux-sensor lascia i listener registrati finché non si fa cleanup
+            try:
+                subprocess.run(self.cleanup_argv, capture_output=True, timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+
+    def _run(self):
+        delay = self.restart_delay
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self._process = subprocess.Popen(
+                    self.argv, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0
+                )
+            except OSError as e:
+                logger.error(f"Stream {self.name}: avvio fallito ({e})")
+            else:
+                self._read(self._process)
+                self._process.wait()
+            if self._stop.is_set():
+                return
+            # Backoff solo se il processo muore subito (permessi, API assente)
+            if time.monotonic() - started > 60:
+                delay = self.restart_delay
+            else:
+                delay = min(delay * 2, 300.0)
+            self.restarts += 1
+            logger.warning(f"Stream {self.name} terminato, riavvio tra {delay:.0f}s")
+            self._stop.wait(delay)
+
+    def _read(self, process):
+        parser = JsonStreamParser()
+        # Un carattere UTF-8 può essere spezzato tra due blocchi
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        fd = process.stdout.fileno()
+        while True:
+            chunk = os.read(fd, 8192)
+            if not chunk:
+                return
+            for obj in parser.feed(decoder.decode(chunk)):
+                try:
+                    self.on_object(obj)
+                except Exception as e:
+                    logger.error(f"Stream {self.name}: lettura scartata ({e})")
+
+
+class SensorDownsampler:
+    """Media/massimo per asse e per sensore su finestre fisse."""
+
+    AXES = ("x", "y", "z")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # sensore -> [count, somme per asse, massimi per asse, somma modulo, max modulo]
+        self._window = {}
+        self.samples = 0
+
+    def add(self, reading):
+        with self._lock:
+            for sensor, data in reading.items():
+                values = (data or {}).get("values") if isinstance(data, dict) else None
+                if not values:
+                    continue
+                values = [float(v) for v in values[:3]]
+                magnitude = math.sqrt(sum(v * v for v in values))
+                stats = self._window.get(sensor)
+                if stats is None:
+                    self._window[sensor] = [1, list(values), list(values), magnitude, magnitude]
+                    continue
+                stats[0] += 1
+                for i, value in enumerate(values[:len(stats[1])]):
+                    stats[1][i] += value
+                    if value > stats[2][i]:
+                        stats[2][i] = value
+                stats[3] += magnitude
+                if magnitude > stats[4]:
+                    stats[4] = magnitude
+            self.samples += 1
+
+    def drain(self, timestamp_ns):
+        with self._lock:
+            window = self._window
+            self._window = {}
+        lines = []
+        for sensor, (count, sums, maxima, mag_sum, mag_max) in window.items():
+            fields = {"count": count}
+            for axis, total, maximum in zip(self.AXES, sums, maxima):
+                fields[f"{axis}_mean"] = total / count
+                fields[f"{axis}_max"] = maximum
+            if len(sums) > 1:
+                fields["magnitude_mean"] = mag_sum / count
+                fields["magnitude_max"] = mag_max
+            line = line_protocol.encode("mobile_sensor", {"sensor": sensor}, fields, timestamp_ns)
+            if line:
+                lines.append(line)
+        return lines
+
+
+class LocationSampler:
+    """Ultima fix di termux-location per finestra."""
+
+    FIELDS = ("latitude", "longitude", "altitude", "accuracy", "vertical_accuracy", "bearing", "speed")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._last = None
+        self.samples = 0
+
+    def add(self, fix):
+        if fix.get("latitude") is None or fix.get("longitude") is None:
+            return
+        with self._lock:
+            self._last = fix
+            self.samples += 1
+
+    def drain(self, timestamp_ns):
+        with self._lock:
+            fix, self._last = self._last, None
+        if fix is None:
+            return []
+        fields = {key: float(fix[key]) for key in self.FIELDS if fix.get(key) is not None}
+        line = line_protocol.encode(
+            "mobile_location", {"provider": fix.get("provider") or "unknown"}, fields, timestamp_ns
+        )
+        return [line] if line else []
+
+
+class TermuxStreams:
+    """Avvia gli stream configurati, riduce per finestra e pubblica a lotti."""
+
+    def __init__(self, cfg, publish_fn, sensor_topic, location_topic):
+        self.publish_fn = publish_fn
+        self.publish_interval = float(cfg.get("publish_interval") or 10)
+        self._streams = []
+        # (topic, sampler, finestra)
+        self._samplers = []
+        self._pending = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+        sensors_cfg = cfg.get("sensors") or {}
+        if sensors_cfg.get("enabled", False):
+            self.sensors = SensorDownsampler()
+            argv = ["termux-sensor", "-d", str(int(sensors_cfg.get("delay_ms") or 100))]
+            names = sensors_cfg.get("names")
+            if names:
+                argv += ["-s", ",".join(names)]
+            self._streams.append(TermuxStream(
+                "sensor", argv, self.sensors.add, cleanup_argv=["termux-sensor", "-c"]
+            ))
+            self._samplers.append((sensor_topic, self.sensors, float(sensors_cfg.get("window") or 1)))
+
+        location_cfg = cfg.get("location") or {}
+        if location_cfg.get("enabled", False):
+            self.location = LocationSampler()
+            argv = ["termux-location", "-p", location_cfg.get("provider") or "network", "-r", "updates"]
+            self._streams.append(TermuxStream("location", argv, self.location.add))
+            self._samplers.append((location_topic, self.location, float(location_cfg.get("window") or 30)))
+
+    @property
+    def enabled(self):
+        return bool(self._streams)
+
+    def start(self):
+        if not self._streams:
+            return
+        for stream in self._streams:
+            stream.start()
+        self._thread = threading.Thread(target=self._loop, name="streams", daemon=True)
+        self._thread.start()
+        logger.info(f"Stream Termux attivi: {', '.join(s.name for s in self._streams)}")
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        # Attende il _flush() finale prima che il chiamante fermi il client MQTT
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                logger.warning("Thread stream non terminato, ultimo lotto perso")
+        for stream in self._streams:
+            stream.stop()
+
+    def _loop(self):
+        now = time.monotonic()
+        next_drain = [now + window for _, _, window in self._samplers]
+        next_publish = now + self.publish_interval
+        while not self._stop.is_set():
+            wake = min(next_drain + [next_publish])
+            if self._stop.wait(max(0.0, wake - time.monotonic())):
+                break
+            now = time.monotonic()
+            for index, (topic, sampler, window) in enumerate(self._samplers):
+                if now >= next_drain[index]:
+                    next_drain[index] += window
+                    lines = sampler.drain(time.time_ns())
+                    if lines:
+                        self._pending.setdefault(topic, []).extend(lines)
+            if now >= next_publish:
+                next_publish += self.publish_interval
+                self._flush()
+        # Finestra in corso: ridotta e pubblicata con l'ultimo lotto
+        for topic, sampler, _ in self._samplers:
+            lines = sampler.drain(time.time_ns())
+            if lines:
+                self._pending.setdefault(topic, []).extend(lines)
+        self._flush()
+
+    def _flush(self):
+        pending, self._pending = self._pending, {}
+        for topic, lines in pending.items():
+            try:
+                self.publish_fn(topic, "\n".join(lines))
+            except Exception as e:
+                logger.error(f"Errore publish stream su {topic}: {e}")
+
+    def fields(self):
+        fields = {"restarts": sum(stream.restarts for stream in self._streams)}
+        for _, sampler, _ in self._samplers:
+            name = "sensor" if isinstance(sampler, SensorDownsampler) else "location"
+            fields[f"{name}_samples"] = sampler.samples
+        return fields
@@ -0,0 +1,61 @@
+"""Tests for liveness.py (run with `python -m pytest` from this directory)."""
+
+from liveness import SilenceDetector
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def run(detector, clock, until, interval, start):
+    """Deliver one message every `interval` seconds from `start`, ticking every second."""
+    next_message = start
+    while clock.now < until:
+        clock.now += 1.0
+        detector.advance()
+        if clock.now >= next_message:
+            detector.seen("phone")
+            next_message = clock.now + interval
+    return next_message
+
+
+def test_slower_cadence_transitions_once():
+    clock = FakeClock()
+    changes = []
+    detector = SilenceDetector(
+        lambda device, status: changes.append(status),
+        multiplier=3.0, min_timeout=120.0, max_timeout=1800.0, clock=clock,
+    )
+    detector.seen("phone")
+    run(detector, clock, clock.now + 300, 10.0, clock.now + 10)
+    assert changes == []
+
+    # Interval grows from 10s to 300s (e.g. low battery power policy)
+    run(detector, clock, clock.now + 3600, 300.0, clock.now + 300)
+    assert changes == ["offline", "online"]
+    assert detector.stats()["silent"] == 0
+
+
+def test_silence_still_detected_after_recovery():
+    clock = FakeClock()
+    changes = []
+    detector = SilenceDetector(
+        lambda device, status: changes.append(status),
+        multiplier=3.0, min_timeout=120.0, max_timeout=1800.0, clock=clock,
+    )
+    detector.seen("phone")
+    run(detector, clock, clock.now + 300, 10.0, clock.now + 10)
+    run(detector, clock, clock.now + 1200, 300.0, clock.now + 300)
+    assert changes == ["offline", "online"]
+
+    # Device stops publishing: flagged after multiplier x the new gap
+    last_seen = clock.now
+    while not detector.stats()["silent"]:
+        clock.now += 1.0
+        detector.advance()
+    assert changes == ["offline", "online", "offline"]
+    assert 900.0 <= clock.now - last_seen <= 1200.0
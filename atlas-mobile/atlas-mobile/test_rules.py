@@ -0,0 +1,90 @@
+"""Tests for rules.py (run with `python -m pytest` from this directory)."""
+
+import os
+import sys
+
+_COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "atlas-common")
+if os.path.isdir(_COMMON_DIR) and _COMMON_DIR not in sys.path:
+    sys.path.insert(0, _COMMON_DIR)
+
+from rules import RuleEngine, load_rules  # noqa: E402
+
+TOPIC = "devices/phone/sensors/battery"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_engine(specs, clock, **kwargs):
+    alerts = []
+    engine = RuleEngine(
+        load_rules(specs),
+        lambda rule, device, tags, value, firing: alerts.append((rule.name, dict(tags), value, firing)),
+        clock=clock,
+        **kwargs,
+    )
+    return engine, alerts
+
+
+def battery(status, percentage):
+    return f"mobile_battery,status={status} percentage={percentage}"
+
+
+def test_tag_change_keeps_one_series():
+    clock = FakeClock()
+    engine, alerts = make_engine(
+        [{"name": "battery-low", "expr": "mobile_battery.percentage < 15", "topic": TOPIC}], clock
+    )
+    engine.process(TOPIC, battery("DISCHARGING", 12))
+    clock.now += 60
+    engine.process(TOPIC, battery("CHARGING", 13))
+    clock.now += 60
+    engine.process(TOPIC, battery("CHARGING", 40))
+
+    assert [(name, firing) for name, _, _, firing in alerts] == [
+        ("battery-low", True),
+        ("battery-low", False),
+    ]
+    assert engine.firing() == 0
+    assert engine.stats["fired"] == engine.stats["resolved"] == 1
+
+
+def test_group_by_separates_series():
+    clock = FakeClock()
+    engine, alerts = make_engine([{"expr": "disk.used_percent > 95", "group_by": ["path"]}], clock)
+    engine.process("devices/phone/telemetry", "disk,path=/data used_percent=97\ndisk,path=/sdcard used_percent=99")
+    clock.now += 60
+    engine.process("devices/phone/telemetry", "disk,path=/data used_percent=50\ndisk,path=/sdcard used_percent=99")
+
+    assert [(tags["path"], firing) for _, tags, _, firing in alerts] == [
+        ("/data", True),
+        ("/sdcard", True),
+        ("/data", False),
+    ]
+    assert engine.firing() == 1
+
+
+def test_silent_series_expires_and_resolves():
+    clock = FakeClock()
+    engine, alerts = make_engine(
+        ["mobile_battery.percentage < 15"], clock, expire_periods=5.0, expire_after=300.0
+    )
+    for _ in range(3):
+        engine.process(TOPIC, battery("DISCHARGING", 10))
+        clock.now += 120
+
+    # Still within 5 x 120s of the last evaluation
+    clock.now += 300
+    assert engine.expire() == 0
+    assert engine.firing() == 1
+
+    clock.now += 200
+    assert engine.expire() == 1
+    assert alerts[-1][2:] == (None, False)
+    assert engine.firing() == 0
+    assert engine.stats["expired"] == 1
@@ -4,13 +4,37 @@ Atlas Mobile Watcher
 
 Subscribes to status topics and triggers Termux notifications 
 when a device goes offline or online.
+
+Notifications are sent by a background NotificationDispatcher
+(notifications.py): on_message only records the status, so a slow
+termux-notification never blocks the MQTT network thread.
+
+Telemetry and sensor topics feed a SilenceDetector (liveness.py): a
+device that stops publishing without sending its last will is flagged
+offline, and online again on its next message.
+
+Threshold rules from ATLAS_MOBILE_WATCHER_RULES (default watcher_rules.yaml)
+are evaluated locally on the line-protocol telemetry by a RuleEngine
+(rules.py), so alerts fire within a second of the offending message.
 """
 
 import os
+import sys
 import json
 import logging
-import subprocess
 import paho.mqtt.client as mqtt
+import yaml
+
+# Shared modules: copied next to this file on the phone, in atlas-common/
+# in the repo
+_COMMON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "atlas-common")
+if os.path.isdir(_COMMON_DIR):
+    sys.path.append(_COMMON_DIR)
+
+from device_state import DeviceStateTable
+from liveness import SilenceDetector
+from notifications import NotificationDispatcher
+from rules import RuleEngine, load_rules, topic_matches
 
 # --- Reuse Env Loading (Simplified for brevity but compatible) ---
 def load_env():
@@ -20,7 +44,7 @@ def load_env():
                 for line in f:
                     if "=" in line and not line.startswith("#"):
                         k, v = line.strip().split("=", 1)
-                        os.environ.setdefault(k, v.strip("'""))
+                        os.environ.setdefault(k, v.strip("'\""))
             return True
     return False
 
@@ -31,44 +55,97 @@ BROKER = os.getenv("ATLAS_MOBILE_MQTT_BROKER_HOST")
 PORT = int(os.getenv("ATLAS_MOBILE_MQTT_BROKER_PORT", 8883))
 CLIENT_ID = f"atlas-watcher-{os.uname().nodename}"
 STATUS_TOPIC = "devices/+/status"
+# Any traffic on these counts as a sign of life
+LIVENESS_TOPICS = ["devices/+/telemetry", "devices/+/sensors/#"]
+# Seconds a status must hold before it is notified (flap suppression)
+DEBOUNCE = float(os.getenv("ATLAS_MOBILE_WATCHER_DEBOUNCE", 30))
+# Devices settling on the same status at once -> one summary notification
+BURST = int(os.getenv("ATLAS_MOBILE_WATCHER_BURST", 3))
+REPORT_INTERVAL = float(os.getenv("ATLAS_MOBILE_WATCHER_REPORT_INTERVAL", 300))
+# Silence timeout: SILENCE_MULTIPLIER x the device's usual gap between
+# messages, clamped to [SILENCE_MIN, SILENCE_MAX] seconds
+SILENCE_MULTIPLIER = float(os.getenv("ATLAS_MOBILE_WATCHER_SILENCE_MULTIPLIER", 3))
+SILENCE_MIN = float(os.getenv("ATLAS_MOBILE_WATCHER_SILENCE_MIN", 120))
+SILENCE_MAX = float(os.getenv("ATLAS_MOBILE_WATCHER_SILENCE_MAX", 1800))
+# Device status table snapshot (restart without re-alerting the fleet)
+STATE_PATH = os.path.expanduser(
+    os.getenv("ATLAS_MOBILE_WATCHER_STATE", "~/.atlas-watcher/state.json")
+)
+SNAPSHOT_INTERVAL = float(os.getenv("ATLAS_MOBILE_WATCHER_SNAPSHOT_INTERVAL", 60))
+RULES_PATH = os.getenv(
+    "ATLAS_MOBILE_WATCHER_RULES",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "watcher_rules.yaml"),
+)
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(message)s")
 logger = logging.getLogger(__name__)
 
-def notify(device, status):
-    title = f"Atlas Alert: {device}"
-    text = f"Device is now {status.upper()}"
-    color = "ff0000" if status == "offline" else "00ff00"
-    
-    logger.warning(f"NOTIFY: {device} is {status}")
-    
-    try:
-        subprocess.run([
-            "termux-notification",
-            "--title", title,
-            "--content", text,
-            "--led-color", color,
-            "--priority", "high",
-            "--vibrate", "500,500"
-        ], check=True)
-    except Exception as e:
-        logger.error(f"Failed to send notification: {e}")
+device_state = DeviceStateTable(STATE_PATH, snapshot_interval=SNAPSHOT_INTERVAL)
+dispatcher = NotificationDispatcher(
+    state=device_state,
+    debounce=DEBOUNCE,
+    burst=BURST,
+    report_interval=REPORT_INTERVAL,
+)
+liveness = SilenceDetector(
+    dispatcher.submit,
+    multiplier=SILENCE_MULTIPLIER,
+    min_timeout=SILENCE_MIN,
+    max_timeout=SILENCE_MAX,
+    report_interval=REPORT_INTERVAL,
+)
+
+def load_rule_engine(path):
+    if not os.path.isfile(path):
+        logger.info(f"No alert rules ({path} not found)")
+        return None
+    with open(path, "r") as f:
+        rules = load_rules((yaml.safe_load(f) or {}).get("rules"))
+    logger.info(f"Loaded {len(rules)} alert rules from {path}")
+    return RuleEngine(rules, on_rule_alert) if rules else None
+
+def on_rule_alert(rule, device, tags, value, firing):
+    series = ",".join(f"{k}={v}" for k, v in tags.items())
+    # value None: series expired without new data
+    reading = "no data" if value is None else f"value {value:g}"
+    text = f"{rule.expr} ({reading}{', ' + series if series else ''})"
+    dispatcher.alert(rule.name, device, text, firing)
+
+rule_engine = load_rule_engine(RULES_PATH)
+
+# Devices left offline by the previous run report "online" on their next message
+for device in device_state.devices("offline"):
+    liveness.mark_offline(device)
 
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
         logger.info(f"Connected to broker. Subscribing to {STATUS_TOPIC}")
         client.subscribe(STATUS_TOPIC, qos=1)
+        for topic in LIVENESS_TOPICS:
+            client.subscribe(topic, qos=0)
+        if rule_engine is not None:
+            for topic in rule_engine.topics:
+                # Overlapping subscriptions could deliver a message twice
+                if not any(topic_matches(sub, topic) for sub in LIVENESS_TOPICS):
+                    client.subscribe(topic, qos=0)
     else:
         logger.error(f"Connection failed with code {rc}")
 
 def on_message(client, userdata, msg):
     try:
-        # Topic format: devices/<device_id>/status
+        # Topic format: devices/<device_id>/status|telemetry|sensors/...
         parts = msg.topic.split("/")
-        if len(parts) >= 2:
+        if len(parts) >= 3 and parts[0] == "devices":
             device = parts[1]
-            status = msg.payload.decode().strip()
-            notify(device, status)
+            if parts[2] == "status":
+                status = msg.payload.decode().strip()
+                if status == "offline":
+                    liveness.mark_offline(device)
+                dispatcher.submit(device, status)
+                return
+            liveness.seen(device)
+        if rule_engine is not None:
+            rule_engine.process(msg.topic, msg.payload)
     except Exception as e:
         logger.error(f"Error processing message: {e}")
 
@@ -93,5 +170,17 @@ if ca_cert and os.path.exists(ca_cert):
     logger.info("TLS Enabled for Watcher")
 
 logger.info(f"Starting Watcher on {BROKER}:{PORT}...")
-client.connect(BROKER, PORT, 60)
-client.loop_forever()
+device_state.start()
+dispatcher.start()
+liveness.start()
+if rule_engine is not None:
+    rule_engine.start()
+try:
+    client.connect(BROKER, PORT, 60)
+    client.loop_forever()
+finally:
+    liveness.stop()
+    if rule_engine is not None:
+        rule_engine.stop()
+    dispatcher.stop()
+    device_state.stop()